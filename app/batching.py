@@ -0,0 +1,67 @@
+"""
+Group commit support for the coordinator.
+Commits that arrive within a short window of each other are pushed through a single 2PC round.
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, List
+
+
+class GroupCommitter:
+    """
+    Collects items submitted within a short window, or until a size limit is hit, and hands them
+    to a flush coroutine as one batch. Each submitter gets back its own result for its item.
+    flush = coroutine taking the list of items and returning a list of results in the same order
+    window = seconds to wait for more items after the first item of a batch arrives
+    max_batch = number of items that triggers a flush without waiting for the window
+    """
+
+    def __init__(self, flush: Callable[[List[Any]], Awaitable[List[Any]]], window: float, max_batch: int):
+        self.flush = flush
+        self.window = window
+        self.max_batch = max(1, max_batch)
+        self.pending = []
+        self.timer = None
+
+    async def submit(self, item: Any) -> Any:
+        """
+        Add an item to the next batch and wait for the batch to be committed.
+        :param item: The item to commit.
+        :return: The result of the flush for this item.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((item, future))
+        if len(self.pending) >= self.max_batch:
+            self._start_flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.window, self._start_flush)
+        return await future
+
+    def _start_flush(self):
+        """
+        Take the pending items as a batch and start committing them in the background.
+        :return: None
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch: list):
+        """
+        Commit a batch and hand every submitter its result.
+        :param batch: List of (item, future) pairs.
+        :return: None
+        """
+        try:
+            results = await self.flush([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
@@ -0,0 +1,43 @@
+"""
+Shared HTTP client used for all 2PC traffic between the data servers and the coordinator.
+One client is created per process on startup so that connections to each server are kept alive
+and reused across transactions instead of paying for a new TCP connection on every request.
+"""
+
+import httpx
+
+"""
+Defaults for the [http] table of the server config.
+"""
+DEFAULT_HTTP_CONFIG = {
+    'max_connections': 100,
+    'max_keepalive_connections': 20,
+    'keepalive_expiry': 60.0,
+    'timeout': 5.0,
+    'connect_timeout': 5.0,
+    'replica_timeout': 2.0,
+    'http2': False,
+}
+
+
+def http_config(conf: dict) -> dict:
+    """
+    Merge the [http] table of the server config with the defaults.
+    :param conf: The full server config.
+    :return: The HTTP client settings to use.
+    """
+    return {**DEFAULT_HTTP_CONFIG, **conf.get('http', {})}
+
+
+def create_client(conf: dict) -> httpx.AsyncClient:
+    """
+    Create the long lived, connection pooled HTTP client for this process.
+    :param conf: The full server config.
+    :return: The HTTP client to use for all 2PC requests.
+    """
+    settings = http_config(conf)
+    limits = httpx.Limits(max_connections=settings['max_connections'],
+                          max_keepalive_connections=settings['max_keepalive_connections'],
+                          keepalive_expiry=settings['keepalive_expiry'])
+    timeout = httpx.Timeout(settings['timeout'], connect=settings['connect_timeout'])
+    return httpx.AsyncClient(limits=limits, timeout=timeout, http2=settings['http2'])
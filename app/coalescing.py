@@ -0,0 +1,93 @@
+"""
+Write coalescing for hot pages on the coordinator.
+While a transaction on a page is in flight, every later edit of that page is folded into one follow-up
+transaction that commits only the newest content.
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+from .locks import LockManager
+
+
+class FollowUp:
+    """
+    The transaction waiting to run once the in-flight transaction on its key finishes.
+    item = the newest item submitted for the key, the only one that will be committed
+    submitted = how many items have been folded into this follow-up so far
+    future = resolved with the commit result once the follow-up has run
+    """
+
+    def __init__(self, future: asyncio.Future):
+        self.item = None
+        self.submitted = 0
+        self.future = future
+
+
+class WriteCoalescer:
+    """
+    Folds writes to the same key that queue up behind an in-flight transaction into one follow-up.
+    locks = the lock manager that serializes transactions per key
+    commit = coroutine committing an item and returning its result
+    follow_ups = the follow-up waiting for each locked key
+    """
+
+    def __init__(self, locks: LockManager, commit: Callable[[Any], Awaitable[Any]]):
+        self.locks = locks
+        self.commit = commit
+        self.follow_ups: Dict[Hashable, FollowUp] = {}
+        self.submitted = 0
+        self.transactions = 0
+
+    async def submit(self, key: Hashable, item: Any) -> Tuple[Any, bool]:
+        """
+        Commit an item, folding it into the pending follow-up for its key if there is one.
+        :param key: The object being written, e.g. ('page', name).
+        :param item: The item to commit.
+        :return: The commit result of the transaction that carried the item's key, and whether the item
+                 itself was the one committed (False if a newer item replaced it).
+        """
+        self.submitted += 1
+        follow_up = self.follow_ups.get(key)
+        if follow_up is None:
+            follow_up = FollowUp(asyncio.get_running_loop().create_future())
+            self.follow_ups[key] = follow_up
+            asyncio.ensure_future(self._run(key, follow_up))
+        follow_up.item = item
+        follow_up.submitted += 1
+        position = follow_up.submitted
+        # shielded so that one caller going away does not cancel the result for the others
+        result = await asyncio.shield(follow_up.future)
+        return result, position == follow_up.submitted
+
+    async def _run(self, key: Hashable, follow_up: FollowUp):
+        """
+        Wait for the key's lock, then commit the newest item of the follow-up.
+        :param key: The object being written.
+        :param follow_up: The follow-up to run.
+        :return: None
+        """
+        acquired = await self.locks.acquire(key)
+        # from now on new writes start the next follow-up instead of changing this one
+        if self.follow_ups.get(key) is follow_up:
+            del self.follow_ups[key]
+        if not acquired:
+            follow_up.future.set_result(None)
+            return
+        try:
+            self.transactions += 1
+            follow_up.future.set_result(await self.commit(follow_up.item))
+        except Exception as e:
+            follow_up.future.set_exception(e)
+        finally:
+            self.locks.release(key)
+
+    def stats(self) -> dict:
+        """
+        :return: Coalescing statistics.
+        """
+        return {
+            'submitted': self.submitted,
+            'transactions': self.transactions,
+            'pending_follow_ups': len(self.follow_ups),
+        }
@@ -0,0 +1,134 @@
+"""
+Background compaction of the Log table.
+Finished transactions are only needed in the log for a while after they finish. The compactor periodically
+deletes the ones that have fallen behind a horizon of recent tids and gives the space back, so that the log,
+and the time it takes to look things up in it, stay bounded however long the server runs.
+"""
+
+import asyncio
+from time import perf_counter
+from typing import Optional
+
+from app import crud
+
+from .database import SessionLocal, run_db
+
+
+class LogCompactor:
+    """
+    Periodically deletes finished transactions behind the horizon from the Log table.
+    horizon = how many of the newest tids are always kept in the log
+    interval = seconds between compactions
+    batch = the most transactions deleted per db transaction, requests are served between batches
+    """
+
+    def __init__(self, horizon: int, interval: float, batch: int):
+        self.horizon = horizon
+        self.interval = interval
+        self.batch = max(1, batch)
+        self.task = None
+        self.runs = 0
+        self.removed = 0
+        self.last_duration = 0.0
+
+    def start(self):
+        """
+        Start compacting in the background.
+        :return: None
+        """
+        self.task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """
+        Stop compacting.
+        :return: None
+        """
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        """
+        Compact every interval until stopped.
+        :return: None
+        """
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.compact()
+            except Exception as e:
+                print('Log compaction failed', repr(e))
+
+    async def compact(self) -> int:
+        """
+        Delete every finished transaction behind the horizon, one batch at a time, then reclaim the space.
+        :return: How many transactions were deleted.
+        """
+        start = perf_counter()
+        removed = 0
+        while True:
+            deleted = await run_db(self._compact_batch, write=True)
+            removed += deleted
+            if deleted < self.batch:
+                break
+            await asyncio.sleep(0)
+        if removed:
+            await run_db(self._reclaim_space, write=True)
+            print('Compacted', removed, 'transactions from the log')
+        self.runs += 1
+        self.removed += removed
+        self.last_duration = perf_counter() - start
+        return removed
+
+    def _compact_batch(self) -> int:
+        """
+        :return: How many transactions were deleted by compacting one batch.
+        """
+        with SessionLocal() as db:
+            return crud.compact_log(db, self.horizon, self.batch)
+
+    @staticmethod
+    def _reclaim_space():
+        """
+        Give the space freed by compaction back to the file system.
+        :return: None
+        """
+        with SessionLocal() as db:
+            crud.reclaim_space(db)
+
+    @staticmethod
+    def _log_size() -> int:
+        """
+        :return: The number of transactions in the log.
+        """
+        with SessionLocal() as db:
+            return crud.log_size(db)
+
+    async def stats(self) -> dict:
+        """
+        :return: Compaction statistics and the current size of the log.
+        """
+        size = await run_db(self._log_size)
+        return {
+            'log_size': size,
+            'horizon': self.horizon,
+            'runs': self.runs,
+            'removed': self.removed,
+            'last_duration': self.last_duration,
+        }
+
+
+def create_compactor(conf: dict) -> Optional[LogCompactor]:
+    """
+    Create the log compactor from the [compaction] table of the server config.
+    :param conf: The full server config.
+    :return: The log compactor, None if compaction is disabled.
+    """
+    compaction = conf.get('compaction', {})
+    if not compaction.get('enabled', False):
+        return None
+    return LogCompactor(compaction.get('horizon', 10000), compaction.get('interval', 60.0),
+                        compaction.get('batch', 1000))
@@ -4,9 +4,12 @@ Coordinates the distributed transaction to keep all data servers in sync.
 """
 
 import asyncio
+from typing import Callable, Dict, List, NamedTuple, Optional
+
 import httpx
 from fastapi import FastAPI
 from fastapi.param_functions import Depends
+from pydantic import BaseModel
 from sqlalchemy.orm.session import Session
 from starlette.responses import Response
 from starlette import status
@@ -15,13 +18,23 @@ from time import perf_counter
 import start
 from app import crud, models
 
-from .database import SessionLocal, engine
-from .schemas import PageCommit, UserCommit, CommitReply, DoCommit, HaveCommit, RequestUserCommit, RequestPageCommit
-
-models.Base.metadata.create_all(bind=engine)
+from .batching import GroupCommitter
+from .client import create_client, http_config
+from .coalescing import WriteCoalescer
+from .compaction import create_compactor
+from .locks import LockManager
+from .sharding import coordinators, shard_of, this_shard
+from .txlog import create_txlog
+from .wire import CompressResponses, WireRoute, create_wire
+from .database import SessionLocal, engine, configure_storage, run_db, start_db_executors, \
+    stop_db_executors
+from .schemas import PageCommit, UserCommit, CommitReply, DoCommit, HaveCommit, RequestUserCommit, RequestPageCommit, \
+    PageCommitBatch, CommitReplyBatch, DoCommitBatch, HaveCommitBatch, PageCommitResult, Inquiry, MaxTid
 
 """ The webapp """
 app = FastAPI()
+app.router.route_class = WireRoute
+app.add_middleware(CompressResponses, wire=lambda: CONFIG.get('WIRE'))
 
 """ Dictionary of useful config data """
 CONFIG = {}
@@ -70,6 +83,38 @@ def get_coordinator():
     return CONFIG['COORD']
 
 
+def get_page_batcher():
+    """
+    FastAPI Dependency Injection
+    :return: The group committer that batches page commits.
+    """
+    return CONFIG['PAGE_BATCHER']
+
+
+def get_locks():
+    """
+    FastAPI Dependency Injection
+    :return: The lock manager serializing transactions on the same page or user.
+    """
+    return CONFIG['LOCKS']
+
+
+def get_coalescer():
+    """
+    FastAPI Dependency Injection
+    :return: The write coalescer for hot pages, or None if coalescing is disabled.
+    """
+    return CONFIG['COALESCER']
+
+
+def get_client():
+    """
+    FastAPI Dependency Injection
+    :return: The shared HTTP client used to talk to the data servers.
+    """
+    return CONFIG['CLIENT']
+
+
 @app.on_event('startup')
 async def startup_event():
     """
@@ -78,155 +123,520 @@ async def startup_event():
     """
     # read in config
     conf = start.read_config()
+    configure_storage(conf)
+    models.create_schema(engine)
+    start_db_executors(conf)
     CONFIG['IP'] = conf['this_ip']
     CONFIG['PORT'] = conf['port']
-    CONFIG['COORD'] = conf['coordinator']
+    CONFIG['COORD'] = conf['this_ip']
+    CONFIG['COORDS'] = coordinators(conf)
+    CONFIG['SHARD'] = this_shard(conf)
     CONFIG['SERVERS'] = conf['replicas']
-    # TODO check db log table for anything in a weird state and resolve it
+    CONFIG['CLIENT'] = create_client(conf)
+    CONFIG['TXLOG'] = create_txlog(conf)
+    twopc = conf.get('twopc', {})
+    CONFIG['PRESUMED_ABORT'] = twopc.get('protocol', 'standard') == 'presumed_abort'
+    CONFIG['ONE_PHASE'] = twopc.get('one_phase', False)
+    CONFIG['COMMIT_STATS'] = {'transactions': 0, 'latency': 0.0}
+    CONFIG['REPLICA_TIMEOUT'] = http_config(conf)['replica_timeout']
+    CONFIG['WIRE'] = create_wire(conf)
+    CONFIG['COMPACTOR'] = create_compactor(conf)
+    if CONFIG['COMPACTOR'] is not None:
+        CONFIG['COMPACTOR'].start()
+    group_commit = conf.get('group_commit', {})
+    CONFIG['PAGE_BATCHER'] = GroupCommitter(commit_page_batch, group_commit.get('window', 0.0),
+                                            group_commit.get('max_batch', 1))
+    locks = conf.get('locks', {})
+    CONFIG['LOCKS'] = LockManager(locks.get('wait_timeout', 2.0))
+    CONFIG['COALESCER'] = None
+    if locks.get('coalesce', False):
+        CONFIG['COALESCER'] = WriteCoalescer(CONFIG['LOCKS'], CONFIG['PAGE_BATCHER'].submit)
+    # finish anything left in flight by the last run once the data servers are reachable, new transactions wait
+    CONFIG['RECOVERED'] = asyncio.Event()
+    asyncio.ensure_future(recover())
+
+
+@app.on_event('shutdown')
+async def shutdown_event():
+    """
+    Handles events that should occur on server shutdown.
+    :return: None
+    """
+    await CONFIG['CLIENT'].aclose()
+    await CONFIG['TXLOG'].close()
+    if CONFIG['COMPACTOR'] is not None:
+        await CONFIG['COMPACTOR'].stop()
+    stop_db_executors()
 
-# This is used when a server forwards a client edit for a page request
-@app.post("/request_page_commit")
-async def request_page_commit(commit: RequestPageCommit, db: Session = Depends(get_db),
-                              data_servers=Depends(get_servers)):
+
+async def fan_out(client: httpx.AsyncClient, data_servers: List[str], path: str, data: dict, reply_model,
+                  is_veto: Callable[[Optional[BaseModel]], bool] = lambda reply: False) -> List[Optional[BaseModel]]:
     """
-    Route handler for data servers requesting to commit a change to a page.
-    :param commit: The page commit JSON message to attempt to commit.
-    :param db: The database to store the log in.
-    :param data_servers: The data servers participating in the 2PC.
-    :return: The response indicating the success of the commit.
+    Send the same message to every data server concurrently.
+    A data server that does not answer within the replica timeout, fails or sends an invalid reply
+    does not hold up the others: its reply comes back as None.
+    :param client: The shared HTTP client to reach the data servers with.
+    :param data_servers: The data servers to send the message to.
+    :param path: The route on the data servers to post the message to.
+    :param data: The message, sent in the configured wire encoding.
+    :param reply_model: The pydantic model of the reply.
+    :param is_veto: Predicate on a reply (None for a failed data server). As soon as one reply is a veto the
+                    requests still outstanding are cancelled and their replies come back as None.
+    :return: The reply of each data server, in the order of the data servers.
     """
-    start = perf_counter()
-    # Log table is basically a list of all commits we have attempted
-    # PendingCommits tracks the status of any in-progress commits for each server participating (so pk is (tid, sender) )
-    if crud.log_has_open_tranaction(db, 'page', commit.page):
-        print('Aborting due to active transaction')
-        return Response(status_code=status.HTTP_409_CONFLICT)
+    async def send(server_ip: str) -> Optional[BaseModel]:
+        try:
+            server_response = await CONFIG['WIRE'].post(client, 'http://' + server_ip + ':8000' + path, data,
+                                                        timeout=CONFIG['REPLICA_TIMEOUT'])
+            server_response.raise_for_status()
+            return reply_model.parse_obj(server_response.json())
+        except (httpx.HTTPError, ValueError) as e:
+            print('No valid reply from', server_ip, 'to', path, repr(e))
+            return None
+
+    tasks = [asyncio.ensure_future(send(server_ip)) for server_ip in data_servers]
+    try:
+        for next_reply in asyncio.as_completed(tasks):
+            if is_veto(await next_reply):
+                break
+    finally:
+        for task in tasks:
+            task.cancel()
+    return [task.result() if task.done() and not task.cancelled() else None for task in tasks]
+
+
+class PageOutcome(NamedTuple):
+    """
+    How a page commit of a batch ended.
+    transaction_id = the tid of the commit if it was committed, None if it was aborted
+    stale_base = if a data server refused the commit because it is a delta against a version it does not have
+    """
+    transaction_id: Optional[int]
+    stale_base: bool
 
-    tid = crud.new_page_commit_to_log(db, commit)
 
-    can_commit = True
-    requests = []
-    for server_ip in data_servers:
-        crud.new_commit_to_pending(db, tid, server_ip, 'requested')
-        server_url = 'http://' + server_ip + ':8000' + '/can_page_commit'
-        can_commit_data = PageCommit(transaction_id=tid, page=commit.page, content=commit.content).dict()
-        requests.append((server_url, can_commit_data))
+async def commit_page_batch(commits: List[RequestPageCommit]) -> List[PageOutcome]:
+    """
+    Run a single 2PC round for a batch of page commits. Every commit gets its own transaction id and
+    its own vote from each data server, so one conflicting commit does not abort the rest of the batch.
+    Both phases fan out to all data servers concurrently. A data server that fails to vote aborts the whole batch
+    right away, without waiting for the remaining votes.
+    With a single data server and one-phase commit enabled, the data server promises and applies the batch in
+    one round trip instead.
+    :param commits: The page commits to attempt to commit together.
+    :return: How each commit ended, in the order of the commits.
+    """
+    txlog = CONFIG['TXLOG']
+    client = CONFIG['CLIENT']
+    data_servers = CONFIG['SERVERS']
+    start = perf_counter()
+    stale = set()
+    tids = await txlog.begin([{'type': 'page', 'name': commit.page, 'content': commit.content, 'admin': False,
+                               'base': commit.base} for commit in commits], data_servers)
+    can_commit = {tid: True for tid in tids}
+
+    can_commit_data = PageCommitBatch(commits=[
+        PageCommit(transaction_id=tid, page=commit.page, content=commit.content, base=commit.base)
+        for tid, commit in zip(tids, commits)]).dict()
+
+    if CONFIG['ONE_PHASE'] and len(data_servers) == 1:
+        send_commit = perf_counter()
+        [have_commit_reply] = await fan_out(client, data_servers, '/one_phase_page_commit_batch', can_commit_data,
+                                            HaveCommitBatch)
+        got_commit = perf_counter()
+        if have_commit_reply is not None:
+            can_commit = {reply.transaction_id: reply.commit for reply in have_commit_reply.replies}
+            stale = {reply.transaction_id for reply in have_commit_reply.replies if reply.stale_base}
+        else:
+            # the outcome is up to the data server, recovery resends the abort if it did not commit
+            can_commit = {tid: False for tid in tids}
+        await finish_one_phase(can_commit, have_commit_reply is not None)
+        done = perf_counter()
+        record_commit_stats(len(tids), done - start)
+        print(f"""One phase batch of {len(tids)} ({sum(can_commit.values())} committed)
+Start took: {send_commit - start}
+Commit took: {got_commit - send_commit}
+Finishing took: {done - got_commit}""")
+        return [PageOutcome(tid if can_commit[tid] else None, tid in stale) for tid in tids]
 
     send_can_commit = perf_counter()
-    async with httpx.AsyncClient() as client:
-        res = await asyncio.gather(*[client.post(url, json=req) for (url, req) in requests])
+    res = await fan_out(client, data_servers, '/can_page_commit_batch', can_commit_data, CommitReplyBatch,
+                        is_veto=lambda reply: reply is None)
     got_can_commit = perf_counter()
 
-    for server_response, server_ip in zip(res, data_servers):
-        commit_reply = CommitReply.parse_obj(server_response.json())
-        if commit_reply:
-            can_commit = can_commit and commit_reply.commit
-            if not commit_reply.commit:
-                print('Aborting because', server_ip, 'aborted')
-            crud.update_status_in_pending(db, tid, server_ip, 'promised')
-        else:
-            print('Aborting because', server_ip, 'sent invalid response')
-            crud.update_status_in_pending(db, tid, server_ip, 'aborted')
+    if any(commit_reply is None for commit_reply in res):
+        print('Aborting batch because not every data server voted')
+        can_commit = {tid: False for tid in tids}
+    votes = {}
+    for commit_reply, server_ip in zip(res, data_servers):
+        if commit_reply is None:
+            votes[server_ip] = {tid: False for tid in tids}
+            continue
+        for reply in commit_reply.replies:
+            if not reply.commit:
+                print('Aborting', reply.transaction_id, 'because', server_ip, 'aborted')
+            if reply.stale_base:
+                stale.add(reply.transaction_id)
+            can_commit[reply.transaction_id] = can_commit[reply.transaction_id] and reply.commit
+        votes[server_ip] = {reply.transaction_id: reply.commit for reply in commit_reply.replies}
+    await txlog.voted(votes)
+
+    committed = [tid for tid in tids if can_commit[tid]]
+    await txlog.decided(committed, [tid for tid in tids if not can_commit[tid]], data_servers)
+
+    send_do_commit = perf_counter()
+    await finish_transactions(client, data_servers, can_commit)
+    done = perf_counter()
+    record_commit_stats(len(tids), done - start)
+
+    print(f"""Batch of {len(tids)} ({len(committed)} committed)
+Start took: {send_can_commit - start}
+Can commit took: {got_can_commit - send_can_commit}
+Decision took: {send_do_commit - got_can_commit}
+Do commit took: {done - send_do_commit}""")
+    return [PageOutcome(tid if can_commit[tid] else None, tid in stale) for tid in tids]
 
-    requests = []
-    if can_commit:
-        have_committed = True
-        crud.update_in_log(db, tid, 'page', 'promised', commit.page, commit.content, False)
-        for server_ip in data_servers:
-            crud.update_status_in_pending(db, tid, server_ip, 'started')
-            server_url = 'http://' + server_ip + ':8000' + '/do_commit'
-            do_commit_data = DoCommit(transaction_id=tid, commit=True).dict()
-            requests.append((server_url, do_commit_data))
 
-        send_do_commit = perf_counter()
+async def send_decisions(client: httpx.AsyncClient, data_servers: List[str], decisions: Dict[int, bool]) -> bool:
+    """
+    Send the coordinator's decisions to every data server and log the acknowledgements.
+    :param client: The shared HTTP client to reach the data servers with.
+    :param data_servers: The data servers participating in the 2PC.
+    :param decisions: If each transaction should be committed, by tid.
+    :return: If every data server has acknowledged every decision.
+    """
+    txlog = CONFIG['TXLOG']
+    committed = [tid for tid, commit in decisions.items() if commit]
+    aborted = [tid for tid, commit in decisions.items() if not commit]
+    do_commit_data = DoCommitBatch(commits=[DoCommit(transaction_id=tid, commit=commit)
+                                            for tid, commit in decisions.items()]).dict()
+    res = await fan_out(client, data_servers, '/do_commit_batch', do_commit_data, HaveCommitBatch)
+    await txlog.acknowledged([server_ip for have_commit_reply, server_ip in zip(res, data_servers)
+                              if have_commit_reply is not None], committed, aborted)
+    # a data server that did not acknowledge keeps its transactions open, so the decision is resent on recovery
+    return all(have_commit_reply is not None for have_commit_reply in res)
+
+
+async def finish_transactions(client: httpx.AsyncClient, data_servers: List[str], decisions: Dict[int, bool]):
+    """
+    Send the logged decisions to every data server, then log the end of the transactions once every data server
+    has acknowledged them. With presumed abort an abort needs no acknowledgement, so aborts are finished right
+    away and a round with nothing to commit does not wait for the data servers at all.
+    :param client: The shared HTTP client to reach the data servers with.
+    :param data_servers: The data servers participating in the 2PC.
+    :param decisions: If each transaction should be committed, by tid.
+    :return: None
+    """
+    txlog = CONFIG['TXLOG']
+    committed = [tid for tid, commit in decisions.items() if commit]
+    aborted = [tid for tid, commit in decisions.items() if not commit]
+    if CONFIG['PRESUMED_ABORT'] and not committed:
+        asyncio.ensure_future(send_decisions(client, data_servers, decisions))
+        await txlog.finished([], aborted)
+    elif await send_decisions(client, data_servers, decisions):
+        await txlog.finished(committed, aborted)
+    elif CONFIG['PRESUMED_ABORT']:
+        await txlog.finished([], aborted)
+
+
+async def finish_one_phase(outcomes: Dict[int, bool], replied: bool):
+    """
+    Log the outcome of a one-phase commit. The data server decided the outcome itself, so the decision is not
+    forced to the log.
+    :param outcomes: If the data server committed each transaction, by tid.
+    :param replied: If the data server replied; if not, the transactions stay open so recovery resends an abort.
+    :return: None
+    """
+    txlog = CONFIG['TXLOG']
+    committed = [tid for tid, commit in outcomes.items() if commit]
+    aborted = [tid for tid, commit in outcomes.items() if not commit]
+    if replied:
+        await txlog.decided(committed, aborted, CONFIG['SERVERS'], force=False)
+        await txlog.finished(committed, aborted)
+
+
+def record_commit_stats(transactions: int, latency: float):
+    """
+    Add finished transactions to the commit statistics.
+    :param transactions: How many transactions finished.
+    :param latency: How long the transactions took, in seconds.
+    :return: None
+    """
+    CONFIG['COMMIT_STATS']['transactions'] += transactions
+    CONFIG['COMMIT_STATS']['latency'] += latency * transactions
+
 
-        async with httpx.AsyncClient() as client:
-            res = await asyncio.gather(*[client.post(url, json=req) for (url, req) in requests])
+async def recover():
+    """
+    Finish the transactions that were in flight when the coordinator last stopped. Transactions that were never
+    decided are aborted. The decisions are resent until every data server has acknowledged them, and only then
+    are new transactions started, so a recovered commit never reaches a data server after a newer one.
+    :return: None
+    """
+    try:
+        await raise_tid_floor()
+        await recover_unfinished()
+    finally:
+        CONFIG['RECOVERED'].set()
 
-        got_do_commit = perf_counter()
 
-        for server_response, server_ip in zip(res, data_servers):
-            have_commit_reply = HaveCommit.parse_obj(server_response.json())
-            have_committed = have_committed and have_commit_reply.commit
-            crud.update_status_in_pending(db, tid, server_ip, 'done')  # remove from PendingCommits db table
-        crud.update_in_log(db, tid, 'page', 'done', commit.page, commit.content, False)
+async def wait_for_recovery() -> bool:
+    """
+    Wait for the transactions of the last run to be finished before starting a new one.
+    :return: If recovery finished within the lock wait deadline.
+    """
+    if CONFIG['RECOVERED'].is_set():
+        return True
+    try:
+        await asyncio.wait_for(CONFIG['RECOVERED'].wait(), CONFIG['LOCKS'].wait_timeout)
+    except asyncio.TimeoutError:
+        return False
+    return True
 
-        done = perf_counter()
 
-        print(f"""Start took: {send_can_commit - start}
-Can commit took: {got_can_commit - send_can_commit}
-Decision took: {send_do_commit - got_can_commit}
-Do commit took: {got_do_commit - send_do_commit}
-Finishing took: {done - got_do_commit}""")
-        return Response(status_code=status.HTTP_200_OK)
+async def raise_tid_floor():
+    """
+    Hand out only tids above the highest one the data servers have seen. When the list of coordinators changes,
+    a page can move to a shard whose own log is far behind the page's version, and the data servers refuse
+    commits older than the page.
+    :return: None
+    """
+    while True:
+        replies = await fan_out(CONFIG['CLIENT'], CONFIG['SERVERS'], '/max_tid', {}, MaxTid)
+        # every committed tid was promised by every data server, so any one of them has seen the highest
+        seen = [reply.transaction_id for reply in replies if reply is not None]
+        if seen:
+            break
+        print('No data server answered with its highest tid, retrying')
+        await asyncio.sleep(CONFIG['REPLICA_TIMEOUT'])
+    CONFIG['TXLOG'].raise_floor(max(seen))
+    print('New tids start above', max(seen))
+
+
+async def recover_unfinished():
+    """
+    Finish the unfinished transactions in the transaction log.
+    :return: None
+    """
+    txlog = CONFIG['TXLOG']
+    unfinished = await txlog.unfinished()
+    if not unfinished:
+        return
+    print('Recovering', len(unfinished), 'unfinished transactions')
+    undecided = [tid for tid, decision in unfinished.items() if decision is None]
+    await txlog.decided([], undecided, CONFIG['SERVERS'])
+    decisions = {tid: bool(decision) for tid, decision in unfinished.items()}
+    while not await send_decisions(CONFIG['CLIENT'], CONFIG['SERVERS'], decisions):
+        print('Not every data server acknowledged the recovered decisions, retrying')
+        await asyncio.sleep(CONFIG['REPLICA_TIMEOUT'])
+    await txlog.finished([tid for tid, commit in decisions.items() if commit],
+                         [tid for tid, commit in decisions.items() if not commit])
+    print('Recovered', len(unfinished), 'transactions')
+
+
+def owns(name: str) -> bool:
+    """
+    :param name: The name of a page or user.
+    :return: If this coordinator's shard owns the name. Transactions on names of other shards are refused so
+             that every name is only ever locked and committed by one coordinator.
+    """
+    return shard_of(name, len(CONFIG['COORDS'])) == CONFIG['SHARD']
+
 
+# This is used when a server forwards a client edit for a page request
+@app.post("/request_page_commit")
+async def request_page_commit(commit: RequestPageCommit, batcher: GroupCommitter = Depends(get_page_batcher),
+                              locks: LockManager = Depends(get_locks),
+                              coalescer: Optional[WriteCoalescer] = Depends(get_coalescer)):
+    """
+    Route handler for data servers requesting to commit a change to a page.
+    Waits for any active transaction on the page to finish, then groups the commit with other page commits
+    arriving around the same time into one 2PC round. With write coalescing, edits waiting on the same page
+    are folded into a single transaction that commits the newest content. A delta only applies to the version
+    it was made against, so deltas are never folded.
+    :param commit: The page commit JSON message to attempt to commit.
+    :param batcher: The group committer for page commits.
+    :param locks: The lock manager for active transactions.
+    :param coalescer: The write coalescer for hot pages, None if coalescing is disabled.
+    :return: The response indicating the success of the commit, with the tid of the winning version. A delta
+             refused by a data server that does not have its base version is answered with 412.
+    """
+    if not owns(commit.page):
+        return Response(status_code=status.HTTP_421_MISDIRECTED_REQUEST)
+    if not await wait_for_recovery():
+        return Response(status_code=status.HTTP_409_CONFLICT)
+    key = ('page', commit.page)
+    if coalescer is not None and commit.base is None:
+        outcome, won = await coalescer.submit(key, commit)
     else:
-        crud.update_in_log(db, tid, 'page', 'aborted', commit.page, commit.content, False)
-        for server_ip in data_servers:
-            crud.update_status_in_pending(db, tid, server_ip, 'aborting')
-            async with httpx.AsyncClient() as client:
-                server_url = 'http://' + server_ip + ':8000' + '/do_commit'
-                do_commit_data = DoCommit(transaction_id=tid, commit=False).dict()
-                server_response = await client.post(server_url, json=do_commit_data)
-            have_commit_reply = HaveCommit.parse_obj(server_response.json())
-            crud.update_status_in_pending(db, tid, server_ip, 'done')  # remove from PendingCommits db table
-        crud.update_in_log(db, tid, 'page', 'aborted', commit.page, commit.content, False)
+        if not await locks.acquire(key):
+            print('Aborting due to active transaction')
+            return Response(status_code=status.HTTP_409_CONFLICT)
+        try:
+            outcome, won = await batcher.submit(commit), True
+        finally:
+            locks.release(key)
+
+    # the coalescer has no outcome if the lock wait timed out
+    if outcome is None or outcome.transaction_id is None:
+        if outcome is not None and outcome.stale_base:
+            return Response(status_code=status.HTTP_412_PRECONDITION_FAILED)
         return Response(status_code=status.HTTP_409_CONFLICT)
+    return PageCommitResult(transaction_id=outcome.transaction_id, page=commit.page, coalesced=not won)
 
 
 @app.post("/request_user_commit")
-async def request_user_commit(commit: RequestUserCommit, db: Session = Depends(get_db),
-                              data_servers=Depends(get_servers)):
+async def request_user_commit(commit: RequestUserCommit, data_servers=Depends(get_servers),
+                              client: httpx.AsyncClient = Depends(get_client), locks: LockManager = Depends(get_locks)):
     """
     Route handler for data servers requesting to commit a change to a user.
+    Waits for any active transaction on the user to finish before starting the 2PC.
     :param commit: The user commit JSON message to attempt to commit.
-    :param db: The database to store the log in.
     :param data_servers: The data servers participating in the 2PC.
+    :param client: The shared HTTP client to reach the data servers with.
+    :param locks: The lock manager for active transactions.
     :return: The response indicating the success of the commit.
     """
-    if crud.log_has_open_tranaction(db, 'user', commit.name):
+    if not owns(commit.name):
+        return Response(status_code=status.HTTP_421_MISDIRECTED_REQUEST)
+    if not await wait_for_recovery():
         return Response(status_code=status.HTTP_409_CONFLICT)
+    key = ('user', commit.name)
+    if not await locks.acquire(key):
+        return Response(status_code=status.HTTP_409_CONFLICT)
+
+    try:
+        return await commit_user(client, data_servers, commit)
+    finally:
+        locks.release(key)
 
-    tid = crud.new_user_commit_to_log(db, commit)
-
-    can_commit = True
-    for server_ip in data_servers:
-        crud.new_commit_to_pending(db, tid, server_ip, 'requested')
-        async with httpx.AsyncClient() as client:
-            server_url = 'http://' + server_ip + ':8000' + '/can_user_commit'
-            can_commit_data = UserCommit(transaction_id=tid, name=commit.name, admin=commit.admin).dict()
-            server_response = await client.post(server_url, json=can_commit_data)
-        commit_reply = CommitReply.parse_obj(server_response.json())
-        can_commit = can_commit and commit_reply.commit
-        if commit_reply:
-            crud.update_status_in_pending(db, tid, server_ip, 'promised')
+
+async def commit_user(client: httpx.AsyncClient, data_servers: List[str], commit: RequestUserCommit) -> Response:
+    """
+    Run the 2PC for a change to a user.
+    Both phases fan out to all data servers concurrently. The first data server to refuse or fail to vote
+    aborts the transaction right away, without waiting for the remaining votes.
+    :param client: The shared HTTP client to reach the data servers with.
+    :param data_servers: The data servers participating in the 2PC.
+    :param commit: The user commit to attempt to commit.
+    :return: The response indicating the success of the commit.
+    """
+    txlog = CONFIG['TXLOG']
+    start = perf_counter()
+    [tid] = await txlog.begin([{'type': 'user', 'name': commit.name, 'content': '', 'admin': commit.admin}],
+                              data_servers)
+
+    can_commit_data = UserCommit(transaction_id=tid, name=commit.name, admin=commit.admin).dict()
+    if CONFIG['ONE_PHASE'] and len(data_servers) == 1:
+        [have_commit_reply] = await fan_out(client, data_servers, '/one_phase_user_commit', can_commit_data,
+                                            HaveCommit)
+        can_commit = have_commit_reply is not None and have_commit_reply.commit
+        await finish_one_phase({tid: can_commit}, have_commit_reply is not None)
+    else:
+        res = await fan_out(client, data_servers, '/can_user_commit', can_commit_data, CommitReply,
+                            is_veto=lambda reply: reply is None or not reply.commit)
+        votes = {server_ip: {tid: commit_reply is not None and commit_reply.commit}
+                 for commit_reply, server_ip in zip(res, data_servers)}
+        can_commit = all(vote[tid] for vote in votes.values())
+        await txlog.voted(votes)
+
+        if can_commit:
+            await txlog.decided([tid], [], data_servers)
         else:
-            crud.update_status_in_pending(db, tid, server_ip, 'aborted')
+            await txlog.decided([], [tid], data_servers)
+        await finish_transactions(client, data_servers, {tid: can_commit})
+    record_commit_stats(1, perf_counter() - start)
 
     if can_commit:
-        have_committed = True
-        crud.update_in_log(db, tid, 'user', 'promised', commit.name, '', commit.admin)
-        for server_ip in data_servers:
-            crud.update_status_in_pending(db, tid, server_ip, 'started')
-            async with httpx.AsyncClient() as client:
-                server_url = 'http://' + server_ip + ':8000' + '/do_commit'
-                do_commit_data = DoCommit(transaction_id=tid, commit=True).dict()
-                server_response = await client.post(server_url, json=do_commit_data)
-            have_commit_reply = HaveCommit.parse_obj(server_response.json())
-            have_committed = have_committed and have_commit_reply.commit
-            crud.update_status_in_pending(db, tid, server_ip, 'done')  # remove from PendingCommits db table
-        crud.update_in_log(db, tid, 'user', 'done', commit.name, '', commit.admin)
         return Response(status_code=status.HTTP_200_OK)
-
     else:
-        crud.update_in_log(db, tid, 'user', 'aborted', commit.name, '', commit.admin)
-        for server_ip in data_servers:
-            crud.update_status_in_pending(db, tid, server_ip, 'aborting')
-            async with httpx.AsyncClient() as client:
-                server_url = 'http://' + server_ip + ':8000' + '/do_commit'
-                do_commit_data = DoCommit(transaction_id=tid, commit=False).dict()
-                server_response = await client.post(server_url, json=do_commit_data)
-            have_commit_reply = HaveCommit.parse_obj(server_response.json())
-            crud.update_status_in_pending(db, tid, server_ip, 'done')  # remove from PendingCommits db table
-        crud.update_in_log(db, tid, 'user', 'aborted', commit.name, '', commit.admin)
         return Response(status_code=status.HTTP_409_CONFLICT)
+
+
+@app.post("/inquire")
+async def inquire(inquiry: Inquiry, db: Session = Depends(get_db)):
+    """
+    Route handler for a data server asking for the decision on transactions it promised long ago without
+    hearing back. A transaction this coordinator has no record of was aborted: with presumed abort, aborts are
+    forgotten and the start of a transaction that was never decided can be lost.
+    :param inquiry: The Inquiry JSON message with the tids.
+    :param db: The database with the transaction log.
+    :return: JSON DoCommitBatch with the decision for each transaction that is decided. A transaction still
+             being decided, or from another coordinator's stripe of tids, is left out.
+    """
+    tids = [tid for tid in inquiry.transaction_ids if tid % len(CONFIG['COORDS']) == CONFIG['SHARD']]
+    unfinished = await CONFIG['TXLOG'].unfinished()
+    logs = await run_db(crud.get_logs, db, tids)
+    decisions = []
+    for tid in tids:
+        if tid in unfinished:
+            if unfinished[tid] is None:
+                continue
+            commit = unfinished[tid]
+        else:
+            commit = tid in logs and logs[tid].status == 'done'
+        decisions.append(DoCommit(transaction_id=tid, commit=commit))
+    print('Inquiry from', inquiry.sender, 'about', len(tids), 'transactions,', len(decisions), 'decided')
+    return DoCommitBatch(commits=decisions)
+
+
+@app.get("/lock_stats")
+async def lock_stats(locks: LockManager = Depends(get_locks),
+                     coalescer: Optional[WriteCoalescer] = Depends(get_coalescer)):
+    """
+    Route handler exposing the lock table statistics, such as queue depth and wait times.
+    :param locks: The lock manager for active transactions.
+    :param coalescer: The write coalescer for hot pages, None if coalescing is disabled.
+    :return: JSON with the lock (and write coalescing) statistics.
+    """
+    stats = locks.stats()
+    if coalescer is not None:
+        stats['coalescing'] = coalescer.stats()
+    return stats
+
+
+@app.get("/commit_stats")
+async def commit_stats():
+    """
+    Route handler exposing the commit latency, transaction log writes and bytes sent per transaction for the
+    configured commit protocol.
+    :return: JSON with the commit statistics.
+    """
+    stats = CONFIG['TXLOG'].stats()
+    transactions = CONFIG['COMMIT_STATS']['transactions']
+    stats['protocol'] = 'presumed_abort' if CONFIG['PRESUMED_ABORT'] else 'standard'
+    stats['one_phase'] = CONFIG['ONE_PHASE'] and len(CONFIG['SERVERS']) == 1
+    stats['transactions'] = transactions
+    if transactions:
+        stats['avg_latency'] = CONFIG['COMMIT_STATS']['latency'] / transactions
+        stats['writes_per_transaction'] = stats['writes'] / transactions
+        stats['syncs_per_transaction'] = stats['syncs'] / transactions
+        if 'statements' in stats:
+            stats['statements_per_transaction'] = stats['statements'] / transactions
+        sent = CONFIG['WIRE'].stats()['sent'].values()
+        stats['wire_bytes_per_transaction'] = sum(peer['wire_bytes'] for peer in sent) / transactions
+        stats['raw_bytes_per_transaction'] = sum(peer['raw_bytes'] for peer in sent) / transactions
+        stats['compression_cpu_per_transaction'] = sum(peer['cpu'] for peer in sent) / transactions
+    return stats
+
+
+@app.get("/wire_stats")
+async def wire_stats():
+    """
+    Route handler exposing the bytes and compression CPU time of the messages exchanged with each data server,
+    to tune the wire encoding and compression per link.
+    :return: JSON with the wire statistics.
+    """
+    return CONFIG['WIRE'].stats()
+
+
+@app.get("/log_stats")
+async def log_stats(db: Session = Depends(get_db)):
+    """
+    Route handler exposing the size of the Log table and the log compaction statistics.
+    :param db: The database with the commit log.
+    :return: JSON with the log statistics.
+    """
+    if CONFIG['COMPACTOR'] is None:
+        return {'log_size': await run_db(crud.log_size, db)}
+    return await CONFIG['COMPACTOR'].stats()
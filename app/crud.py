@@ -1,10 +1,17 @@
 """
 Holds the common database operations that are used.
 """
+from typing import Dict, List, Optional, Tuple, Union
+
+from sqlalchemy import and_, case, func
 from sqlalchemy.orm import Session
 
 from . import models, schemas
-from .schemas import RequestPageCommit, RequestUserCommit
+from .delta import apply_delta
+from .history import HISTORY, stage_revision
+from .page_store import StoredPage, memory_store
+from .sharding import next_in_stripe
+from .schemas import RequestPageCommit, RequestUserCommit, PageCommit, UserCommit, DoCommit
 
 
 def no_users(db: Session) -> bool:
@@ -73,16 +80,45 @@ def update_admin(db: Session, user: str, admin: bool):
     db.commit()
 
 
-def search_page(db: Session, name: str) -> models.Page:
+def search_page(db: Session, name: str, offset: int = 0, limit: Optional[int] = None) -> List[str]:
     """
     Search for a page in the db with a name similar to the name argument.
     :param db: The db session to use.
     :param name: The name of the page to search for.
-    :return: The pages with a name similar to the searched name.
+    :param offset: How many of the matching pages to skip, in name order.
+    :param limit: The most pages to return, None for all of them.
+    :return: The names of the pages with a name similar to the searched name.
+    """
+    store = memory_store()
+    if store is not None:
+        return store.search_names(name, offset, limit)
+    query = db.query(models.Page.name).filter(models.Page.name.like('%' + name + '%'))\
+        .order_by(models.Page.name).offset(offset).limit(limit)
+    return [page_name for page_name, in query]
+
+
+def list_page_names(db: Session, prefix: str = '', after: Optional[str] = None, limit: int = 100) -> List[str]:
     """
-    print("Query: " + str(db.query(models.Page)))
-    print("All: " + str(db.query(models.Page).all()))
-    return db.query(models.Page).filter(models.Page.name.like('%' + name + '%')).all()
+    List page names in name order, one page of the listing at a time. The listing continues from the last name
+    of the previous page, so every page of it is an index range scan no matter how far into the listing it is.
+    :param db: The db session to use.
+    :param prefix: Only list the pages whose name starts with the prefix.
+    :param after: The last name of the previous page of the listing, None for the first page.
+    :param limit: The most names to return.
+    :return: The page names.
+    """
+    store = memory_store()
+    if store is not None:
+        return store.list_names(prefix, after, limit)
+    query = db.query(models.Page.name)
+    if prefix:
+        # a range on the name index, unlike LIKE which SQLite only runs on the index for case-insensitive names
+        query = query.filter(models.Page.name >= prefix)
+        if prefix[-1] < chr(0x10ffff):
+            query = query.filter(models.Page.name < prefix[:-1] + chr(ord(prefix[-1]) + 1))
+    if after is not None:
+        query = query.filter(models.Page.name > after)
+    return [name for name, in query.order_by(models.Page.name).limit(limit)]
 
 
 def all_pages(db: Session) -> models.Page:
@@ -91,6 +127,9 @@ def all_pages(db: Session) -> models.Page:
     :param db: The db session to use.
     :return: The list of all pages in the db.
     """
+    store = memory_store()
+    if store is not None:
+        return list(store.pages.values())
     return db.query(models.Page).all()
 
 
@@ -99,11 +138,47 @@ def get_page(db: Session, name: str) -> models.Page:
     Get the page with the given name.
     :param db: The db session to check.
     :param name: The name of the page to find.
-    :return: The desired page in the db, or None if DNE.
+    :return: The desired page in the db, or None if DNE. A StoredPage with the in-memory page store.
     """
+    store = memory_store()
+    if store is not None:
+        return store.get(name)
     return db.query(models.Page).filter(models.Page.name == name).first()
 
 
+def page_version(db: Session, name: str) -> Optional[int]:
+    """
+    Get the version of the page with the given name, which is the tid of the last commit applied to it.
+    :param db: The db session to check.
+    :param name: The name of the page.
+    :return: The version of the page, or None if the page has never been committed.
+    """
+    store = memory_store()
+    if store is not None:
+        page = store.get(name)
+        return page.version if page is not None else None
+    return db.query(models.Page.version).filter(models.Page.name == name).scalar()
+
+
+def page_content_from(db: Session, commit: PageCommit) -> Optional[str]:
+    """
+    Get the full content a page commit sets the page to, applying its delta if it has one.
+    :param db: The db session to check.
+    :param commit: The page commit.
+    :return: The new content of the page, or None if the page is not at the version the delta applies to.
+    """
+    if commit.base is None:
+        return commit.content
+    page = get_page(db, commit.page)
+    if page is None or page.version != commit.base:
+        return None
+    try:
+        return apply_delta(page.content, commit.content)
+    except ValueError as e:
+        print('Bad delta for', commit.page, repr(e))
+        return None
+
+
 def create_page(db: Session, page: schemas.Page) -> models.Page:
     """
     Create a page and add it to the db.
@@ -111,6 +186,10 @@ def create_page(db: Session, page: schemas.Page) -> models.Page:
     :param page: The name of the page to create.
     :return: The created page.
     """
+    store = memory_store()
+    if store is not None:
+        store.write([StoredPage(page.name, page.content, None)])
+        return store.get(page.name)
     db_page = models.Page(name=page.name, content=page.content)
     db.add(db_page)
     db.commit()
@@ -184,21 +263,25 @@ def update_page_content(db: Session, page_name: str, page_content: str):
     :return: None.
     """
     print('update page', page_name, 'with', page_content)
+    store = memory_store()
+    if store is not None:
+        page = store.get(page_name)
+        if page is not None:
+            store.write([page._replace(content=page_content)])
+        return
     db.query(models.Page)\
         .filter(models.Page.name == page_name)\
         .update({models.Page.content: page_content}, synchronize_session=False)
     db.commit()
 
 
-def create_or_update_user(db: Session, tid: int):
+def stage_user(db: Session, to_commit: models.Log):
     """
-    Commit the user commit to the db.
+    Stage the user change described by a log entry without committing it.
     :param db: The db session to use.
-    :param tid: The tid of the entry in the log to commit.
+    :param to_commit: The log entry of the user commit.
     :return: None
     """
-    db_user = None
-    to_commit = get_log(db, tid)
     existing_user = get_user_by_name(db, to_commit.name)
     if existing_user:
         db.query(models.User)\
@@ -207,31 +290,59 @@ def create_or_update_user(db: Session, tid: int):
     else:
         db_user = models.User(name=to_commit.name, admin=to_commit.admin)
         db.add(db_user)
-    db.commit()
-    # if db_user:
-    #     db.refresh(db_user)
 
 
-def create_or_update_page(db: Session, tid: int):
+def create_or_update_user(db: Session, tid: int):
     """
-    Commit the page commit to the db.
+    Commit the user commit to the db.
     :param db: The db session to use.
     :param tid: The tid of the entry in the log to commit.
-    :return: None.
+    :return: None
+    """
+    stage_user(db, get_log(db, tid))
+    db.commit()
+
+
+def stage_page(db: Session, to_commit: models.Log) -> bool:
     """
-    db_page = None
-    to_commit = get_log(db, tid)
+    Stage the page change described by a log entry without committing it. A commit older than the version the
+    page is at is skipped so that the page never goes back.
+    :param db: The db session to use.
+    :param to_commit: The log entry of the page commit.
+    :return: If the change was staged, False if it was skipped.
+    """
+    version = page_version(db, to_commit.name)
+    if version is not None and to_commit.tid < version:
+        print('Skipping commit', to_commit.tid, 'of page', to_commit.name, 'older than version', version)
+        return False
+    if HISTORY:
+        stage_revision(db, to_commit.name, to_commit.content, to_commit.tid)
+    store = memory_store()
+    if store is not None:
+        store.stage(db, StoredPage(to_commit.name, to_commit.content, to_commit.tid))
+        return True
     existing_page = get_page(db, to_commit.name)
     if existing_page:
         db.query(models.Page)\
             .filter(models.Page.name == to_commit.name)\
-            .update({models.Page.content: to_commit.content}, synchronize_session=False)
+            .update({models.Page.content: to_commit.content, models.Page.version: to_commit.tid},
+                    synchronize_session=False)
     else:
-        db_page = models.Page(name=to_commit.name, content=to_commit.content)
+        db_page = models.Page(name=to_commit.name, content=to_commit.content, version=to_commit.tid)
         db.add(db_page)
+        db.flush()  # later commits in the same batch must see the new page
+    return True
+
+
+def create_or_update_page(db: Session, tid: int):
+    """
+    Commit the page commit to the db.
+    :param db: The db session to use.
+    :param tid: The tid of the entry in the log to commit.
+    :return: None.
+    """
+    stage_page(db, get_log(db, tid))
     db.commit()
-    # if db_page:
-    #     db.refresh(db_page)
 
 
 def new_page_commit_to_log(db: Session, commit: RequestPageCommit):
@@ -266,6 +377,256 @@ def new_user_commit_to_log(db: Session, commit: RequestUserCommit):
     return tid
 
 
+def new_commits_to_log(db: Session, entries: List[dict], shard: int = 0, shards: int = 1,
+                       floor: int = 0) -> List[int]:
+    """
+    Stage a new pending commit entry in the log for each of the given entries with a single statement,
+    without committing it.
+    :param db: The db session to use.
+    :param entries: The commits to log, as dicts with the type, name, content, admin and base of each commit.
+    :param shard: The shard of the coordinator, the new tids are taken from its stripe.
+    :param shards: The number of coordinator shards.
+    :param floor: A tid the new tids must be above, besides every tid in the log.
+    :return: The tids of the newly created transaction log entries, in the order of the entries.
+    """
+    first = next_in_stripe(max(max_tid(db), floor) + 1, shard, shards)
+    tids = [first + i * shards for i in range(len(entries))]
+    db.bulk_insert_mappings(models.Log, [{'tid': tid, 'status': 'pending', **entry}
+                                         for tid, entry in zip(tids, entries)])
+    return tids
+
+
+def project_to_log(db: Session, entries: List[dict]):
+    """
+    Write finished transactions into the log, replacing any entry already stored for their tids.
+    Used to checkpoint the coordinator's write-ahead log into the db.
+    :param db: The db session to use.
+    :param entries: The finished commits, as dicts with the tid, type, status, name, content, admin and base of each.
+    :return: None
+    """
+    if not entries:
+        return
+    db.query(models.Log)\
+        .filter(models.Log.tid.in_([entry['tid'] for entry in entries]))\
+        .delete(synchronize_session=False)
+    db.bulk_insert_mappings(models.Log, entries)
+    db.commit()
+
+
+def max_tid(db: Session) -> int:
+    """
+    :param db: The db session to check.
+    :return: The highest tid in the log, 0 if the log is empty.
+    """
+    return db.query(func.max(models.Log.tid)).scalar() or 0
+
+
+def unfinished_in_log(db: Session) -> Dict[int, str]:
+    """
+    Find the transactions that the coordinator had not finished, e.g. because it crashed.
+    :param db: The db session to check.
+    :return: The status of each unfinished transaction by tid: pending (undecided), promised (decided to commit)
+             or aborted (decided to abort, but not every data server acknowledged).
+    """
+    unfinished = {db_log.tid: db_log.status for db_log in db.query(models.Log)
+                  .filter(models.Log.status.in_(['pending', 'promised']))}
+    aborting = db.query(models.PendingCommits.tid).filter(models.PendingCommits.status == 'aborting').distinct()
+    for (tid,) in aborting:
+        unfinished[tid] = 'aborted'
+    return unfinished
+
+
+def promised_in_log(db: Session) -> List[int]:
+    """
+    Find the transactions this data server promised without hearing the coordinator's decision yet.
+    :param db: The db session to check.
+    :return: The tids of the promised transactions.
+    """
+    return [tid for (tid,) in db.query(models.Log.tid).filter(models.Log.status == 'promised')]
+
+
+def update_statuses_in_log(db: Session, statuses: Dict[int, str]):
+    """
+    Stage new statuses for several commits in the log with a single statement, without committing it.
+    :param db: The db session to update in.
+    :param statuses: The new status of each commit, by tid.
+    :return: None
+    """
+    if not statuses:
+        return
+    db.query(models.Log) \
+        .filter(models.Log.tid.in_(statuses)) \
+        .update({models.Log.status: case(statuses, value=models.Log.tid)}, synchronize_session=False)
+
+
+def compact_log(db: Session, horizon: int, limit: int) -> int:
+    """
+    Delete finished transactions that are more than horizon tids behind the newest one from the log, along with
+    their pending commits. Unfinished transactions are kept for recovery, and so is the last committed
+    transaction of each page since it holds the page's version.
+    :param db: The db session to use.
+    :param horizon: How many of the newest tids are never deleted, at least 1.
+    :param limit: The most transactions to delete at once.
+    :return: How many transactions were deleted.
+    """
+    cutoff = max_tid(db) - max(1, horizon)
+    if cutoff <= 0:
+        return 0
+    versions = db.query(func.max(models.Log.tid))\
+        .filter(models.Log.type == 'page', models.Log.status == 'committed')\
+        .group_by(models.Log.name)
+    aborting = db.query(models.PendingCommits.tid).filter(models.PendingCommits.status == 'aborting')
+    tids = [tid for (tid,) in db.query(models.Log.tid)
+            .filter(models.Log.tid <= cutoff, models.Log.status.in_(['done', 'committed', 'aborted']),
+                    ~models.Log.tid.in_(versions), ~models.Log.tid.in_(aborting))
+            .limit(limit)]
+    if not tids:
+        return 0
+    db.query(models.Log).filter(models.Log.tid.in_(tids)).delete(synchronize_session=False)
+    db.query(models.PendingCommits).filter(models.PendingCommits.tid.in_(tids)).delete(synchronize_session=False)
+    db.commit()
+    return len(tids)
+
+
+def reclaim_space(db: Session):
+    """
+    Give the space freed by deleted rows back to the file system.
+    :param db: The db session to use.
+    :return: None
+    """
+    db.commit()
+    # executescript steps the pragma to completion, a plain execute only frees a single page
+    db.connection().connection.executescript('PRAGMA incremental_vacuum;')
+
+
+def log_size(db: Session) -> int:
+    """
+    :param db: The db session to check.
+    :return: How many transactions are in the log.
+    """
+    return db.query(func.count(models.Log.tid)).scalar()
+
+
+def get_logs(db: Session, tids: List[int]) -> Dict[int, models.Log]:
+    """
+    Get the commit logs with the given tids.
+    :param db: The db session to check.
+    :param tids: The tids to look up.
+    :return: The logs that exist, keyed by tid.
+    """
+    return {db_log.tid: db_log for db_log in db.query(models.Log).filter(models.Log.tid.in_(tids))}
+
+
+def stage_promises(db: Session, commits: List[Union[PageCommit, UserCommit]]) -> List[bool]:
+    """
+    Stage phase 1 of 2PC for page and user commits without committing it. Every commit that is not yet known
+    is added to the log as promised, page commits with their full content. A page commit older than the version
+    the page is at, or whose delta applies to a version of the page this data server does not have, is refused.
+    :param db: The db session to use.
+    :param commits: The page and user commits the coordinator wants to perform.
+    :return: If this data server is willing to commit, for each of the commits.
+    """
+    existing = get_logs(db, [commit.transaction_id for commit in commits])
+    promises = []
+    for commit in commits:
+        if commit.transaction_id in existing:
+            promises.append(existing[commit.transaction_id].status == 'promised')
+        elif isinstance(commit, PageCommit):
+            version = page_version(db, commit.page)
+            if version is not None and commit.transaction_id < version:
+                print('Refusing', commit.transaction_id, 'because', commit.page, 'is already at version', version)
+                promises.append(False)
+                continue
+            content = page_content_from(db, commit)
+            if content is None:
+                print('Refusing', commit.transaction_id, 'because', commit.page, 'is not at version', commit.base)
+                promises.append(False)
+                continue
+            db.add(models.Log(tid=commit.transaction_id, type='page', status='promised', name=commit.page,
+                              content=content, admin=False))
+            promises.append(True)
+        else:
+            db.add(models.Log(tid=commit.transaction_id, type='user', status='promised', name=commit.name,
+                              content='', admin=commit.admin))
+            promises.append(True)
+    return promises
+
+
+def promise_commits(db: Session, commits: List[Union[PageCommit, UserCommit]]) -> List[bool]:
+    """
+    Phase 1 of 2PC for a batch of page and user commits on a data server. Every commit that is not yet known is
+    added to the log as promised. All of it happens in a single db transaction.
+    :param db: The db session to use.
+    :param commits: The page and user commits the coordinator wants to perform.
+    :return: If this data server is willing to commit, for each of the commits.
+    """
+    promises = stage_promises(db, commits)
+    db.commit()
+    return promises
+
+
+def stage_decisions(db: Session, decisions: List[DoCommit]) -> List[bool]:
+    """
+    Stage phase 2 of 2PC for a batch of commits without committing it. Commits or aborts every transaction
+    as decided by the coordinator and stages the committed changes. A promised page commit that has become
+    older than the version the page is at is aborted, a decision resent for a commit already made is not.
+    :param db: The db session to use.
+    :param decisions: The coordinator's decision for each transaction.
+    :return: If this data server has committed, for each of the transactions.
+    """
+    existing = get_logs(db, [decision.transaction_id for decision in decisions])
+    applied = []
+    for decision in decisions:
+        db_log = existing.get(decision.transaction_id)
+        if db_log is None:
+            db.add(models.Log(tid=decision.transaction_id, type='', status='aborted', name='', content='',
+                              admin=False))
+            applied.append(False)
+        elif decision.commit and db_log.status in ('promised', 'committed'):
+            resent = db_log.status == 'committed'
+            db_log.status = 'committed'
+            if db_log.type == 'user':
+                stage_user(db, db_log)
+            elif db_log.type == 'page' and not stage_page(db, db_log) and not resent:
+                db_log.status = 'aborted'
+                applied.append(False)
+                continue
+            applied.append(True)
+        else:
+            db_log.status = 'aborted'
+            applied.append(False)
+    return applied
+
+
+def apply_commits(db: Session, decisions: List[DoCommit]) -> List[bool]:
+    """
+    Phase 2 of 2PC for a batch of commits on a data server. Commits or aborts every transaction as decided
+    by the coordinator and applies the committed changes, all in a single db transaction.
+    :param db: The db session to use.
+    :param decisions: The coordinator's decision for each transaction.
+    :return: If this data server has committed, for each of the transactions.
+    """
+    applied = stage_decisions(db, decisions)
+    db.commit()
+    return applied
+
+
+def commit_one_phase(db: Session, commits: List[Union[PageCommit, UserCommit]]) -> List[bool]:
+    """
+    One-phase commit for when this data server is the only participant: promises and applies every commit
+    it is willing to commit, all in a single db transaction.
+    :param db: The db session to use.
+    :param commits: The page and user commits the coordinator wants to perform.
+    :return: If this data server has committed, for each of the commits.
+    """
+    promises = stage_promises(db, commits)
+    db.flush()  # the decisions below must see the promised log entries
+    applied = stage_decisions(db, [DoCommit(transaction_id=commit.transaction_id, commit=promise)
+                                   for commit, promise in zip(commits, promises)])
+    db.commit()
+    return applied
+
+
 def new_commit_to_pending(db: Session, tid: int, sender: str, status: str):
     """
     Adds a new in-progress commit to the PendingCommits table.
@@ -280,6 +641,38 @@ def new_commit_to_pending(db: Session, tid: int, sender: str, status: str):
     db.commit()
 
 
+def new_commits_to_pending(db: Session, tids: List[int], senders: List[str], status: str):
+    """
+    Stages a pending entry for every transaction of a batch on every data server with a single statement,
+    without committing it.
+    :param db: The database where the PendingCommits are stored.
+    :param tids: The transaction ids of the commits that are pending.
+    :param senders: The data server ips participating in the commits.
+    :param status: The status of the commits.
+    :return: None.
+    """
+    db.bulk_insert_mappings(models.PendingCommits, [{'tid': tid, 'sender': sender, 'status': status}
+                                                    for tid in tids for sender in senders])
+
+
+def update_statuses_in_pending(db: Session, statuses: Dict[Tuple[int, str], str]):
+    """
+    Stages new statuses for the pending commits of several data servers with a single statement, without
+    committing it.
+    :param db: The database where the PendingCommits are stored.
+    :param statuses: The new status of the pending commits, by tid and sender ip.
+    :return: None.
+    """
+    if not statuses:
+        return
+    pending = models.PendingCommits
+    db.query(pending)\
+        .filter(pending.tid.in_({tid for tid, _ in statuses}), pending.sender.in_({sender for _, sender in statuses}))\
+        .update({pending.status: case(*[(and_(pending.tid == tid, pending.sender == sender), status)
+                                        for (tid, sender), status in statuses.items()], else_=pending.status)},
+                synchronize_session=False)
+
+
 def update_status_in_pending(db: Session, tid: int, sender: str, status: str):
     """
     Updates the status of a pending commit in the PendingCommits table.
@@ -290,7 +683,7 @@ def update_status_in_pending(db: Session, tid: int, sender: str, status: str):
     :return: None.
     """
     db.query(models.PendingCommits)\
-        .filter(models.PendingCommits.tid == tid and models.PendingCommits.sender == sender)\
+        .filter(models.PendingCommits.tid == tid, models.PendingCommits.sender == sender)\
         .update({models.PendingCommits.status: status}, synchronize_session=False)
 
 def log_has_open_tranaction(db: Session, type: str, name: str) -> bool:
@@ -2,11 +2,19 @@
 Database setup for the webapp.
 """
 
+import asyncio
+import fcntl
 import os
 import sys
-from sqlalchemy import create_engine
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, TypeVar
+
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
 """
 Where the Sqlite database can be found.
@@ -15,12 +23,87 @@ SQLALCHEMY_DATABASE_URL = f"sqlite:///./sql_app_{os.path.basename(sys.argv[1])}.
 # SQLALCHEMY_DATABASE_URL = f"sqlite://"
 
 """
-The db engine.
+The db engine. Connections are kept open between sessions so that their settings and page cache are reused.
+A session never waits for a connection: past the pool size, connections are opened and closed per session.
 """
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}, poolclass=QueuePool, pool_size=5,
+    max_overflow=-1
 )
 
+
+"""
+The SQLite settings of each storage profile, as pragmas. The default profile keeps SQLite's own settings:
+a rollback journal with every commit synced to disk.
+"""
+STORAGE_PROFILES = {
+    'default': {},
+    # a write-ahead log with every commit synced to disk, reads no longer wait for writes
+    'durable': {'journal_mode': 'WAL', 'synchronous': 'FULL', 'mmap_size': 0, 'cache_size': -16384,
+                'busy_timeout': 5000},
+    # commits are only synced at checkpoints, the last commits can be lost on power loss but not on a crash
+    'fast': {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'mmap_size': 268435456, 'cache_size': -65536,
+             'busy_timeout': 5000},
+}
+
+""" The values SQLite accepts for the pragmas that are not numbers """
+PRAGMA_CHOICES = {
+    'journal_mode': ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'),
+    'synchronous': ('OFF', 'NORMAL', 'FULL', 'EXTRA'),
+}
+
+""" The storage pragmas set on every new connection to the db """
+STORAGE = {}
+
+
+def configure_storage(conf: dict) -> dict:
+    """
+    Choose the SQLite settings from the optional [storage] table of the server config: a profile, and
+    any of its pragmas set one by one. Connections opened from now on use the settings.
+    :param conf: The full server config.
+    :return: The storage pragmas.
+    """
+    storage = dict(conf.get('storage', {}))
+    profile = storage.pop('profile', 'default')
+    if profile not in STORAGE_PROFILES:
+        print(f'Unknown storage profile {profile}, using the default profile')
+        profile = 'default'
+    pragmas = dict(STORAGE_PROFILES[profile])
+    for name, value in storage.items():
+        if name in PRAGMA_CHOICES:
+            if str(value).upper() not in PRAGMA_CHOICES[name]:
+                print(f'Ignoring storage setting {name} = {value}, use one of {", ".join(PRAGMA_CHOICES[name])}')
+                continue
+            pragmas[name] = str(value).upper()
+        elif name in ('mmap_size', 'cache_size', 'busy_timeout') and isinstance(value, int):
+            pragmas[name] = value
+        else:
+            print(f'Ignoring storage setting {name} = {value}')
+    STORAGE.clear()
+    STORAGE.update(pragmas)
+    engine.dispose()  # connections opened before the config was read do not have the settings
+    print(f'Storage profile {profile}:', pragmas)
+    return pragmas
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Set up every new connection to the db. Space freed by deleting rows, e.g. by log compaction, is kept
+    for reclaiming with an incremental vacuum. This only takes effect for a db created after it is set.
+    The storage pragmas are applied after it.
+    :param dbapi_connection: The new connection.
+    :param connection_record: Unused.
+    :return: None
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    for name, value in STORAGE.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+
+event.listen(engine, 'connect', set_sqlite_pragmas)
+
 """
 A value to use for the local session
 """
@@ -30,3 +113,85 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base class to inherit from for an object in the db.
 """
 Base = declarative_base()
+
+"""
+The thread pools running db work off the event loop, None while db work runs on the event loop.
+"""
+EXECUTORS = {'read': None, 'write': None}
+
+"""
+The lock the worker processes of a data server take around db writes, None while the data server is one process.
+"""
+WRITE_LOCK = {'file': None, 'thread': threading.Lock()}
+
+T = TypeVar('T')
+
+
+def start_db_executors(conf: dict):
+    """
+    Start the thread pools running db work, set in the optional [db_executor] table of the server config.
+    Reads run on a bounded pool of threads. Writes run on a single thread, so SQLite never has two writers
+    waiting on each other's locks. Without readers, db work runs on the event loop.
+    :param conf: The full server config.
+    :return: None
+    """
+    readers = conf.get('db_executor', {}).get('readers', 0)
+    if readers > 0:
+        EXECUTORS['read'] = ThreadPoolExecutor(readers, thread_name_prefix='db-read')
+        EXECUTORS['write'] = ThreadPoolExecutor(1, thread_name_prefix='db-write')
+
+
+def stop_db_executors():
+    """
+    Wait for the db work in flight and stop the thread pools.
+    :return: None
+    """
+    for kind, executor in EXECUTORS.items():
+        if executor is not None:
+            executor.shutdown(wait=True)
+            EXECUTORS[kind] = None
+
+
+def share_db_writes(path: str):
+    """
+    Make db writes wait for a lock file shared by the worker processes of the data server, so that SQLite never
+    has two writers waiting on each other's locks across processes either.
+    :param path: The lock file, next to the db.
+    :return: None
+    """
+    WRITE_LOCK['file'] = open(path, 'a')
+
+
+def write_locked(fn: Callable[..., T], *args) -> T:
+    """
+    Run db writes holding the lock shared by the worker processes, if there is one.
+    :param fn: The function doing the db writes.
+    :param args: The arguments of the function.
+    :return: What the function returns.
+    """
+    lock = WRITE_LOCK['file']
+    if lock is None:
+        return fn(*args)
+    # flock only excludes other processes, the thread lock excludes other threads of this one
+    with WRITE_LOCK['thread']:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            return fn(*args)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+async def run_db(fn: Callable[..., T], *args, write: bool = False) -> T:
+    """
+    Run db work without blocking the event loop.
+    :param fn: The function doing the db work.
+    :param args: The arguments of the function.
+    :param write: If the function writes to the db.
+    :return: What the function returns.
+    """
+    executor = EXECUTORS['write' if write else 'read']
+    if write:
+        fn, args = write_locked, (fn, *args)
+    if executor is None:
+        return fn(*args)
+    return await asyncio.get_running_loop().run_in_executor(executor, partial(fn, *args))
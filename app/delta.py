@@ -0,0 +1,54 @@
+"""
+Delta encoding of page content.
+A delta turns one version of a page into the next. It is a JSON list of operations applied in order to the old
+content: a positive int copies that many characters of the old content, a negative int skips that many, and
+a string is inserted. Small edits to large pages give a delta proportional to the edit.
+"""
+
+import json
+from difflib import SequenceMatcher
+from typing import List, Union
+
+
+def make_delta(old: str, new: str) -> str:
+    """
+    Compute the delta from one version of a page to the next. Changes are found line by line.
+    :param old: The content the delta applies to.
+    :param new: The content the delta produces.
+    :return: The delta.
+    """
+    old_lines = old.splitlines(keepends=True)
+    new_lines = new.splitlines(keepends=True)
+    ops: List[Union[int, str]] = []
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, old_lines, new_lines, autojunk=False).get_opcodes():
+        if tag == 'equal':
+            ops.append(sum(len(line) for line in old_lines[i1:i2]))
+            continue
+        if i2 > i1:
+            ops.append(-sum(len(line) for line in old_lines[i1:i2]))
+        if j2 > j1:
+            ops.append(''.join(new_lines[j1:j2]))
+    return json.dumps(ops, separators=(',', ':'))
+
+
+def apply_delta(old: str, delta: str) -> str:
+    """
+    Apply a delta to the content it was computed against.
+    :param old: The content the delta applies to.
+    :param delta: The delta.
+    :return: The new content.
+    :raises ValueError: If the delta does not fit the content.
+    """
+    parts = []
+    position = 0
+    for op in json.loads(delta):
+        if isinstance(op, str):
+            parts.append(op)
+        elif op >= 0:
+            parts.append(old[position:position + op])
+            position += op
+        else:
+            position -= op
+    if position != len(old):
+        raise ValueError(f'Delta covers {position} characters of content of length {len(old)}')
+    return ''.join(parts)
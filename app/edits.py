@@ -0,0 +1,160 @@
+"""
+Edits submitted without waiting for their commit on a data server.
+The browser gets a handle for the edit as soon as it is submitted and asks for its status, while the edit is
+sent to the coordinator in the background. An edit counts as committed as soon as this data server applies a
+commit of its content, since the coordinator has decided by then, without waiting for the slowest replica.
+"""
+
+import asyncio
+import uuid
+from collections import OrderedDict
+from typing import Dict, Optional, Set
+
+PENDING = 'pending'
+COMMITTED = 'committed'
+ABORTED = 'aborted'
+
+
+class Edit:
+    """
+    An edit of a page whose commit is tracked.
+    handle = the id the status of the edit is asked for with
+    page = the name of the edited page
+    content = the new content of the page
+    status = pending, committed or aborted
+    transaction_id = the tid of the transaction whose content is now on the page, once committed
+    coalesced = if the content was folded into a later edit of the page whose content won
+    done = set once the edit is committed or aborted
+    task = the background task sending the edit to the coordinator
+    """
+
+    def __init__(self, page: str, content: str):
+        self.handle = uuid.uuid4().hex
+        self.page = page
+        self.content = content
+        self.status = PENDING
+        self.transaction_id = None
+        self.coalesced = False
+        self.done = asyncio.Event()
+        self.task = None
+
+
+class EditTracker:
+    """
+    Tracks the status of submitted edits. Pending edits are kept until they finish, finished edits are kept
+    for status requests until max_finished newer edits have finished.
+    max_finished = how many finished edits are remembered
+    edits = the tracked edits by handle
+    finished = the handles of the finished edits, oldest first
+    pending = the handles of the pending edits of each page
+    """
+
+    def __init__(self, max_finished: int):
+        self.max_finished = max_finished
+        self.edits: Dict[str, Edit] = {}
+        self.finished: OrderedDict[str, None] = OrderedDict()
+        self.pending: Dict[str, Set[str]] = {}
+        self.submitted = 0
+        self.committed = 0
+        self.aborted = 0
+        self.pushed = 0
+
+    def submit(self, page: str, content: str) -> Edit:
+        """
+        Start tracking an edit, before it is sent to the coordinator.
+        :param page: The name of the edited page.
+        :param content: The new content of the page.
+        :return: The edit.
+        """
+        edit = Edit(page, content)
+        self.edits[edit.handle] = edit
+        self.pending.setdefault(page, set()).add(edit.handle)
+        self.submitted += 1
+        return edit
+
+    def get(self, handle: str) -> Optional[Edit]:
+        """
+        :param handle: The handle of the edit.
+        :return: The edit, None if it is unknown or was forgotten.
+        """
+        return self.edits.get(handle)
+
+    def finish(self, edit: Edit, committed: bool, transaction_id: Optional[int] = None, coalesced: bool = False):
+        """
+        Record the outcome of an edit and wake up everyone waiting for it. Only the first outcome counts, a
+        commit applied on this data server is final.
+        :param edit: The edit.
+        :param committed: If the edit was committed.
+        :param transaction_id: The tid of the transaction whose content is now on the page.
+        :param coalesced: If the content was folded into a later edit of the page.
+        :return: None
+        """
+        if edit.status != PENDING:
+            return
+        edit.status = COMMITTED if committed else ABORTED
+        edit.transaction_id = transaction_id
+        edit.coalesced = coalesced
+        edit.done.set()
+        if committed:
+            self.committed += 1
+        else:
+            self.aborted += 1
+        handles = self.pending[edit.page]
+        handles.discard(edit.handle)
+        if not handles:
+            del self.pending[edit.page]
+        self.finished[edit.handle] = None
+        while len(self.finished) > self.max_finished:
+            handle, _ = self.finished.popitem(last=False)
+            del self.edits[handle]
+
+    def applied(self, page: str, content: str, transaction_id: int):
+        """
+        Commit the pending edits of a page that a commit applied on this data server carried.
+        :param page: The name of the committed page.
+        :param content: The committed content of the page.
+        :param transaction_id: The tid of the commit.
+        :return: None
+        """
+        for handle in list(self.pending.get(page, ())):
+            edit = self.edits[handle]
+            if edit.content == content:
+                self.pushed += 1
+                self.finish(edit, True, transaction_id)
+
+    @staticmethod
+    async def wait(edit: Edit, timeout: float):
+        """
+        Wait for an edit to finish.
+        :param edit: The edit.
+        :param timeout: The most seconds to wait.
+        :return: None
+        """
+        try:
+            await asyncio.wait_for(edit.done.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def stats(self) -> dict:
+        """
+        :return: How many edits were submitted and how they finished.
+        """
+        return {
+            'submitted': self.submitted,
+            'pending': sum(len(handles) for handles in self.pending.values()),
+            'committed': self.committed,
+            'aborted': self.aborted,
+            'committed_on_apply': self.pushed,
+        }
+
+
+def create_edit_tracker(conf: dict) -> Optional[EditTracker]:
+    """
+    Create the edit tracker from the optional [async_edits] table of the server config.
+    :param conf: The full server config.
+    :return: The edit tracker, None if edits wait for their commit.
+    """
+    async_edits = conf.get('async_edits', {})
+    if not async_edits.get('enabled', False):
+        return None
+    return EditTracker(async_edits.get('max_finished', 10000))
@@ -0,0 +1,154 @@
+"""
+Page history on a data server.
+Every page commit applied on the data server adds a revision of the page. A revision is stored as a delta
+against the revision before it, so its size follows the size of the edit rather than of the page. A full
+snapshot is stored instead once the chain of deltas since the last snapshot gets too long or adds up to more
+than the content itself, which bounds the work of rebuilding any revision.
+"""
+
+import difflib
+from typing import List, NamedTuple, Optional
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from . import models
+from .database import SessionLocal
+from .delta import apply_delta, make_delta
+from .page_store import memory_store
+
+
+class Head(NamedTuple):
+    """
+    The newest revision of a page, as needed to add the next one.
+    number = the revision number
+    version = tid of the commit that made the revision
+    content = the full content of the revision
+    depth = how many deltas lead from the last snapshot to the revision
+    chain_size = the total length of those deltas
+    """
+    number: int
+    version: Optional[int]
+    content: str
+    depth: int
+    chain_size: int
+
+
+""" The history settings, set from the [history] table of the server config. No history while empty. """
+HISTORY = {}
+
+
+def configure_history(conf: dict) -> bool:
+    """
+    Turn on the page history if the optional [history] table of the server config enables it.
+    :param conf: The full server config.
+    :return: If the page history is kept.
+    """
+    history = conf.get('history', {})
+    if not history.get('enabled', False):
+        return False
+    HISTORY['max_depth'] = history.get('max_depth', 50)
+    event.listen(SessionLocal, 'after_rollback', lambda db: db.info.pop('history_heads', None))
+    return True
+
+
+def load_head(db: Session, name: str) -> Optional[Head]:
+    """
+    Load the newest revision of a page, if it is the version the page is at.
+    :param db: The db session to use.
+    :param name: The name of the page.
+    :return: The newest revision, None if the page has no revisions or has been committed without them.
+    """
+    revision = db.query(models.Revision).filter(models.Revision.page == name)\
+        .order_by(models.Revision.number.desc()).first()
+    if revision is None:
+        return None
+    store = memory_store()
+    if store is not None:
+        page = store.get(name)
+        current = (page.content, page.version) if page is not None else None
+    else:
+        # columns rather than the Page object, whose attributes may be stale after bulk updates
+        current = db.query(models.Page.content, models.Page.version).filter(models.Page.name == name).first()
+    if current is None or current[1] != revision.version:
+        return None
+    return Head(revision.number, revision.version, current[0], revision.depth, revision.chain_size)
+
+
+def stage_revision(db: Session, name: str, content: str, version: int):
+    """
+    Stage the revision a page commit makes, before the commit is applied to the page.
+    :param db: The db session the commit is applied in.
+    :param name: The name of the page.
+    :param content: The new content of the page.
+    :param version: The tid of the commit.
+    :return: None
+    """
+    heads = db.info.setdefault('history_heads', {})
+    head = heads[name] if name in heads else load_head(db, name)
+    if head is not None and head.version == version:
+        return  # a decision resent for a commit that was already applied
+    number = head.number + 1 if head is not None else 1
+    delta = make_delta(head.content, content) if head is not None else None
+    if delta is None or head.depth >= HISTORY['max_depth'] or head.chain_size + len(delta) > len(content):
+        db.add(models.Revision(page=name, number=number, version=version, snapshot=True, depth=0, chain_size=0,
+                               content=content))
+        heads[name] = Head(number, version, content, 0, 0)
+    else:
+        chain_size = head.chain_size + len(delta)
+        db.add(models.Revision(page=name, number=number, version=version, snapshot=False, depth=head.depth + 1,
+                               chain_size=chain_size, content=delta))
+        heads[name] = Head(number, version, content, head.depth + 1, chain_size)
+
+
+def list_revisions(db: Session, name: str, before: Optional[int] = None, limit: int = 100) -> List[models.Revision]:
+    """
+    List the revisions of a page, newest first.
+    :param db: The db session to use.
+    :param name: The name of the page.
+    :param before: Only list revisions older than this revision number, None to start from the newest.
+    :param limit: The most revisions to return.
+    :return: The revisions.
+    """
+    query = db.query(models.Revision).filter(models.Revision.page == name)
+    if before is not None:
+        query = query.filter(models.Revision.number < before)
+    return query.order_by(models.Revision.number.desc()).limit(limit).all()
+
+
+def get_revision(db: Session, name: str, number: int) -> Optional[str]:
+    """
+    Rebuild the content of a revision from the last snapshot before it and the deltas after that snapshot.
+    :param db: The db session to use.
+    :param name: The name of the page.
+    :param number: The revision number.
+    :return: The content of the page at the revision, None if there is no such revision.
+    """
+    depth = db.query(models.Revision.depth)\
+        .filter(models.Revision.page == name, models.Revision.number == number).scalar()
+    if depth is None:
+        return None
+    chain = db.query(models.Revision.content)\
+        .filter(models.Revision.page == name, models.Revision.number.between(number - depth, number))\
+        .order_by(models.Revision.number)
+    content = None
+    for revision, in chain:
+        content = revision if content is None else apply_delta(content, revision)
+    return content
+
+
+def diff_revisions(db: Session, name: str, old: int, new: int) -> Optional[List[str]]:
+    """
+    Diff two revisions of a page line by line.
+    :param db: The db session to use.
+    :param name: The name of the page.
+    :param old: The revision number to diff from.
+    :param new: The revision number to diff to.
+    :return: The lines of a unified diff, None if either revision does not exist.
+    """
+    old_content = get_revision(db, name, old)
+    new_content = get_revision(db, name, new)
+    if old_content is None or new_content is None:
+        return None
+    return list(difflib.unified_diff(old_content.splitlines(), new_content.splitlines(), f'{name} r{old}',
+                                     f'{name} r{new}', lineterm=''))
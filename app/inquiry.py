@@ -0,0 +1,115 @@
+"""
+Inquiries about promised transactions on a data server.
+With presumed abort the coordinator forgets a transaction as soon as it aborts it, and may lose the start of a
+transaction it never decided, so a data server is not always told about an abort. The data server periodically
+asks the coordinator about the transactions it promised that are still waiting for a decision an interval later,
+and the coordinator answers abort for any transaction it has no record of.
+"""
+
+import asyncio
+from typing import Awaitable, Callable, List, Optional, Set
+
+from app import crud
+
+from .database import SessionLocal, run_db
+
+
+class Inquirer:
+    """
+    Periodically asks the coordinators about long promised transactions.
+    interval = seconds between looks at the promised transactions, a transaction still promised at the next look
+               is asked about
+    ask = asks the coordinators about some tids and applies the decisions they answer, returning how many were
+          decided
+    seen = the promised tids at the last look
+    """
+
+    def __init__(self, interval: float, ask: Callable[[List[int]], Awaitable[int]]):
+        self.interval = interval
+        self.ask = ask
+        self.seen: Set[int] = set()
+        self.task = None
+        self.inquired = 0
+        self.decided = 0
+
+    def start(self):
+        """
+        Start looking at the promised transactions in the background, asking about those promised before the
+        data server started right away.
+        :return: None
+        """
+        self.task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """
+        Stop looking at the promised transactions.
+        :return: None
+        """
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        """
+        Inquire once about every transaction promised so far, then every interval until stopped.
+        :return: None
+        """
+        try:
+            # anything promised before this data server started has waited long enough
+            self.seen = set(await run_db(self._promised))
+            await self.inquire()
+        except Exception as e:
+            print('Inquiry about promised transactions failed', repr(e))
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.inquire()
+            except Exception as e:
+                print('Inquiry about promised transactions failed', repr(e))
+
+    async def inquire(self) -> int:
+        """
+        Ask about the transactions that were already promised at the last look.
+        :return: How many of them were decided.
+        """
+        promised = set(await run_db(self._promised))
+        waiting = sorted(promised & self.seen)
+        self.seen = promised
+        if not waiting:
+            return 0
+        decided = await self.ask(waiting)
+        self.inquired += len(waiting)
+        self.decided += decided
+        print('Inquired about', len(waiting), 'promised transactions,', decided, 'decided')
+        return decided
+
+    @staticmethod
+    def _promised() -> List[int]:
+        """
+        :return: The tids of the promised transactions.
+        """
+        with SessionLocal() as db:
+            return crud.promised_in_log(db)
+
+    def stats(self) -> dict:
+        """
+        :return: How many transactions were asked about and decided.
+        """
+        return {'interval': self.interval, 'promised': len(self.seen), 'inquired': self.inquired,
+                'decided': self.decided}
+
+
+def create_inquirer(conf: dict, ask: Callable[[List[int]], Awaitable[int]]) -> Optional[Inquirer]:
+    """
+    Create the inquirer from the optional [inquiry] table of the server config.
+    :param conf: The full server config.
+    :param ask: Asks the coordinators about some tids and applies the decisions they answer.
+    :return: The inquirer, None if the interval is 0.
+    """
+    interval = conf.get('inquiry', {}).get('interval', 60.0)
+    if interval <= 0:
+        return None
+    return Inquirer(interval, ask)
@@ -0,0 +1,91 @@
+"""
+In-memory lock manager used by the coordinator to serialize transactions on the same object.
+"""
+
+import asyncio
+from collections import deque
+from time import perf_counter
+from typing import Deque, Dict, Hashable
+
+
+class LockManager:
+    """
+    Table of exclusive locks keyed by object, e.g. ('page', name).
+    A writer that finds the lock held waits in a FIFO queue until the lock is handed to it,
+    or gives up once its wait deadline has passed.
+    wait_timeout = seconds a writer waits for a lock before giving up (0 fails at once)
+    locks = held locks, mapping each key to the queue of writers waiting for it
+    """
+
+    def __init__(self, wait_timeout: float):
+        self.wait_timeout = wait_timeout
+        self.locks: Dict[Hashable, Deque[asyncio.Future]] = {}
+        self.waits = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.max_depth = 0
+
+    async def acquire(self, key: Hashable) -> bool:
+        """
+        Take the lock for a key, waiting behind earlier writers if it is held.
+        :param key: The object to lock.
+        :return: True if the lock was acquired, False if the wait deadline passed first.
+        """
+        queue = self.locks.get(key)
+        if queue is None:
+            self.locks[key] = deque()
+            return True
+        if self.wait_timeout <= 0:
+            self.timeouts += 1
+            return False
+
+        future = asyncio.get_running_loop().create_future()
+        queue.append(future)
+        self.max_depth = max(self.max_depth, len(queue))
+        start = perf_counter()
+        try:
+            await asyncio.wait_for(future, self.wait_timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return False
+        finally:
+            waited = perf_counter() - start
+            self.waits += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+            if not future.done() or future.cancelled():
+                try:
+                    queue.remove(future)
+                except ValueError:
+                    pass
+        return True
+
+    def release(self, key: Hashable):
+        """
+        Release the lock for a key, handing it to the first writer still waiting for it.
+        :param key: The locked object.
+        :return: None
+        """
+        queue = self.locks[key]
+        while queue:
+            future = queue.popleft()
+            if not future.done():
+                future.set_result(True)
+                return
+        del self.locks[key]
+
+    def stats(self) -> dict:
+        """
+        :return: Lock table statistics, used to size the wait deadline.
+        """
+        return {
+            'held': len(self.locks),
+            'waiting': sum(len(queue) for queue in self.locks.values()),
+            'max_depth': self.max_depth,
+            'waits': self.waits,
+            'timeouts': self.timeouts,
+            'avg_wait': self.total_wait / self.waits if self.waits else 0.0,
+            'max_wait': self.max_wait,
+            'wait_timeout': self.wait_timeout,
+        }
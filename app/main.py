@@ -2,33 +2,63 @@
 Webapp for a data server.
 """
 
-from typing import Optional
+import asyncio
+from typing import List, Optional
 
 import httpx
 from fastapi import FastAPI, Form
 from fastapi.exceptions import HTTPException
-from fastapi.param_functions import Cookie, Depends
+from fastapi.param_functions import Cookie, Depends, Header, Query
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from sqlalchemy.orm.session import Session
 from starlette.requests import Request
-from starlette.responses import RedirectResponse
+from starlette.responses import HTMLResponse, RedirectResponse, Response, StreamingResponse
 from time import perf_counter
 
 import start
 from app import crud, models
 
-from .database import SessionLocal, engine
-from .schemas import PageCommit, DoCommit, UserCommit, CommitReply, HaveCommit, RequestUserCommit, RequestPageCommit
-
-models.Base.metadata.create_all(bind=engine)
+from .client import create_client
+from .compaction import create_compactor
+from .database import SessionLocal, engine, configure_storage, run_db, share_db_writes, start_db_executors, \
+    stop_db_executors, write_locked
+from .delta import make_delta
+from .edits import ABORTED, COMMITTED, Edit, create_edit_tracker
+from .history import configure_history, diff_revisions, get_revision, list_revisions
+from .inquiry import create_inquirer
+from .page_cache import create_page_cache
+from .page_store import create_page_store
+from .search import create_search_index, search_pages
+from .sharding import coordinator_for, coordinators
+from .streaming import create_streaming, read_form, stream_template
+from .user_cache import create_user_cache
+from .schemas import PageCommit, DoCommit, UserCommit, CommitReply, HaveCommit, RequestUserCommit, RequestPageCommit, \
+    PageCommitBatch, CommitReplyBatch, DoCommitBatch, HaveCommitBatch, PageCommitResult, EditStatus, Inquiry, \
+    MaxTid
+from .wire import CompressResponses, WireRoute, create_wire
+from .workers import Generations, take_leadership, worker_count
 
 """ The webapp """
 app = FastAPI()
+app.router.route_class = WireRoute
+app.add_middleware(CompressResponses, wire=lambda: CONFIG.get('WIRE'))
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 templates = Jinja2Templates(directory="templates")
 
+""" Number of results on each page of search results """
+SEARCH_PAGE_SIZE = 20
+
+""" Number of names on each page of the page listing """
+LISTING_PAGE_SIZE = 100
+
+""" Number of revisions on each page of a page history """
+HISTORY_PAGE_SIZE = 100
+
+""" The most seconds a request for the status of an edit waits for the edit to finish """
+MAX_EDIT_WAIT = 30.0
+
 """ Dictionary of useful config data """
 CONFIG = {}
 
@@ -69,12 +99,64 @@ def get_servers():
     return CONFIG['SERVERS']
 
 
-def get_coordinator():
+def get_coordinators():
+    """
+    FastAPI Dependency Injection
+    :return: The IPs of the 2PC coordinator servers, in shard order.
+    """
+    return CONFIG['COORDS']
+
+
+def get_client():
     """
     FastAPI Dependency Injection
-    :return: The IP of the 2PC coordinator server.
+    :return: The shared HTTP client used to talk to the coordinator.
     """
-    return CONFIG['COORD']
+    return CONFIG['CLIENT']
+
+
+def page_response(template: str, context: dict) -> Response:
+    """
+    Render a template showing the content of a page. With streaming enabled, a large page is sent in chunks
+    instead of being rendered into memory as a whole.
+    :param template: The name of the template, which shows the content once.
+    :param context: The template context, with the request and the content.
+    :return: The response.
+    """
+    threshold = CONFIG['STREAM_THRESHOLD']
+    if threshold is not None and len(context['content']) >= threshold:
+        return StreamingResponse(stream_template(templates.get_template(template), context, 'content'),
+                                 media_type='text/html')
+    return templates.TemplateResponse(template, context)
+
+
+def load_user_admin(db: Session, name: str) -> Optional[bool]:
+    """
+    :param db: The db session to load the user from.
+    :param name: The name of the user.
+    :return: If the user is an admin, None if the user does not exist.
+    """
+    user = crud.get_user_by_name(db, name)
+    return None if user is None else user.admin
+
+
+async def user_admin(db: Session, name: str) -> Optional[bool]:
+    """
+    Look up the admin flag of a user, from the user cache when it is enabled.
+    :param db: The db session to load the user from on a cache miss.
+    :param name: The name of the user.
+    :return: If the user is an admin, None if the user does not exist.
+    """
+    cache = CONFIG['USER_CACHE']
+    if cache is None:
+        return await run_db(load_user_admin, db, name)
+    cached, admin = cache.get(name)
+    if cached:
+        return admin
+    stamp = cache.stamp(name)
+    admin = await run_db(load_user_admin, db, name)
+    cache.put(name, admin, stamp)
+    return admin
 
 
 @app.on_event('startup')
@@ -85,11 +167,59 @@ async def startup_event():
     """
     # read in config
     conf = start.read_config()
+    configure_storage(conf)
+    start_db_executors(conf)
+    CONFIG['WORKERS'] = worker_count(conf)
+    generations = None
+    if CONFIG['WORKERS'] > 1:
+        share_db_writes(engine.url.database + '.lock')
+        generations = Generations(engine.url.database + '.generations',
+                                  conf['workers'].get('generation_slots', 65536))
+    # every worker starts up at once, so only one at a time creates or upgrades the schema
+    write_locked(models.create_schema, engine)
+    CONFIG['GENERATIONS'] = generations
+    # with several workers, background jobs only run in one of them
+    CONFIG['LEADER'] = CONFIG['WORKERS'] == 1 or take_leadership(engine.url.database)
     CONFIG['IP'] = conf['this_ip']
     CONFIG['PORT'] = conf['port']
-    CONFIG['COORD'] = conf['coordinator']
+    CONFIG['COORDS'] = coordinators(conf)
     CONFIG['SERVERS'] = conf['replicas']
-    # TODO check db log table for anything in a weird state and resolve it
+    CONFIG['CLIENT'] = create_client(conf)
+    CONFIG['WIRE'] = create_wire(conf)
+    CONFIG['DELTA'] = conf.get('delta', {}).get('enabled', False)
+    CONFIG['COMPACTOR'] = create_compactor(conf)
+    CONFIG['PAGE_CACHE'] = create_page_cache(conf, generations)
+    CONFIG['USER_CACHE'] = create_user_cache(conf, generations)
+    CONFIG['EDITS'] = create_edit_tracker(conf)
+    CONFIG['HISTORY'] = configure_history(conf)
+    CONFIG['STREAM_THRESHOLD'] = create_streaming(conf)
+    CONFIG['PAGE_STORE'] = create_page_store(conf)
+    # the index is kept by triggers on the Pages table, which the in-memory page store leaves empty
+    CONFIG['FULL_TEXT'] = CONFIG['PAGE_STORE'] is None and write_locked(create_search_index, engine)
+    if CONFIG['COMPACTOR'] is not None and CONFIG['LEADER']:
+        CONFIG['COMPACTOR'].start()
+    # transactions left promised by the last run are asked about right away, then every interval
+    CONFIG['INQUIRER'] = create_inquirer(conf, ask_coordinators)
+    if CONFIG['INQUIRER'] is not None and CONFIG['LEADER']:
+        CONFIG['INQUIRER'].start()
+
+
+@app.on_event('shutdown')
+async def shutdown_event():
+    """
+    Handles events that should occur on server shutdown.
+    :return: None
+    """
+    await CONFIG['CLIENT'].aclose()
+    if CONFIG['COMPACTOR'] is not None:
+        await CONFIG['COMPACTOR'].stop()
+    if CONFIG['INQUIRER'] is not None:
+        await CONFIG['INQUIRER'].stop()
+    stop_db_executors()
+    if CONFIG['PAGE_STORE'] is not None:
+        CONFIG['PAGE_STORE'].close()
+    if CONFIG['GENERATIONS'] is not None:
+        CONFIG['GENERATIONS'].close()
 
 
 @app.get("/")
@@ -103,9 +233,7 @@ async def index(request: Request, db: Session = Depends(get_db), user: Optional[
     """
     admin = False
     if user:
-        current_user = crud.get_user_by_name(db, user)
-        if current_user and current_user.admin:
-            admin = True
+        admin = bool(await user_admin(db, user))
     return templates.TemplateResponse("index.html", {'request': request, 'admin': admin, 'user': user})
 
 
@@ -127,10 +255,9 @@ async def login_post(request: Request, user: str = Form(...), db: Session = Depe
     :param db: Dependency for the db session.
     :return: The response to the user based on their login attempt.
     """
-    existing_user = crud.get_user_by_name(db, user)
-    if existing_user:
+    if await user_admin(db, user) is not None:
         response = RedirectResponse("/", status_code=303)
-        response.set_cookie(key='user', value=existing_user.name)
+        response.set_cookie(key='user', value=user)
         return response
     else:
         return templates.TemplateResponse("user_not_found.html", {'request': request, 'user': user})
@@ -158,25 +285,26 @@ async def create(request: Request):
 
 
 @app.post("/create")
-async def create_post(user: str = Form(...), db: Session = Depends(get_db), coord: str = Depends(get_coordinator)):
+async def create_post(user: str = Form(...), db: Session = Depends(get_db), coords: List[str] = Depends(get_coordinators),
+                      client: httpx.AsyncClient = Depends(get_client)):
     """
     POST route handler for the create user page of the webapp.
     :param user: The name of the user to create.
     :param db: The db session to get the data from.
-    :param coord: The coordinator server ip.
+    :param coords: The IPs of the coordinators for 2PC.
+    :param client: The shared HTTP client to reach the coordinator with.
     :return: The redirect for the user to the page associated with logging in or failed creation of the user.
     """
-    existing_user = crud.get_user_by_name(db, user)
+    existing_user = await run_db(crud.get_user_by_name, db, user)
     if existing_user:
         return HTTPException(status_code=400, detail="User already registered")
     else:
-        admin = crud.no_users(db)
+        admin = await run_db(crud.no_users, db)
         # new_user = crud.create_user(db, user, admin)
         data = RequestUserCommit(name=user, admin=admin).dict()
-        async with httpx.AsyncClient() as client:
-            coord_url = 'http://' + coord + ':8000' + '/request_user_commit'
-            print(f'create_post: connecting to {coord_url}')
-            coord_response = await client.post(coord_url, json=data)
+        coord_url = 'http://' + coordinator_for(coords, user) + ':8000' + '/request_user_commit'
+        print(f'create_post: connecting to {coord_url}')
+        coord_response = await CONFIG['WIRE'].post(client, coord_url, data)
         if coord_response.status_code == 200:
             response = RedirectResponse("/login", status_code=303)
             return response
@@ -187,62 +315,143 @@ async def create_post(user: str = Form(...), db: Session = Depends(get_db), coor
 
 @app.get("/edit_page/{page_name}")
 async def edit_page(page_name: str, request: Request, db: Session = Depends(get_db),
-                    coord: str = Depends(get_coordinator), user: Optional[str] = Cookie(None)):
+                    coords: List[str] = Depends(get_coordinators), user: Optional[str] = Cookie(None),
+                    client: httpx.AsyncClient = Depends(get_client)):
     """
     GET route handler for the webpage to edit a page on the page_name topic.
     :param page_name: The name of the page requested by the client.
     :param request: The request the client passed
     :param db: The database session to get info from.
-    :param coord: The ip of the coordinator server for 2PC.
+    :param coords: The IPs of the coordinators for 2PC.
+    :param client: The shared HTTP client to reach the coordinator with.
     :param user: The user accessing the page.
     :return: Either the edit webpage or the login screen if the user is not logged in.
     """
     if user:
-        existing_user = crud.get_user_by_name(db, user)
-        page = crud.get_page(db, page_name)
+        page = await run_db(crud.get_page, db, page_name)
         if page is None:
-            if existing_user.admin:
+            if await user_admin(db, user):
                 # page = crud.create_page(db, schemas.Page(page_name, ""))
                 data = RequestPageCommit(page=page_name, content='').dict()
-                async with httpx.AsyncClient() as client:
-                    coord_url = 'http://' + coord + ':8000' + '/request_page_commit'
-                    coord_response = await client.post(coord_url, json=data)
+                coord_url = 'http://' + coordinator_for(coords, page_name) + ':8000' + '/request_page_commit'
+                coord_response = await CONFIG['WIRE'].post(client, coord_url, data)
                 if coord_response.status_code == 200:
                     # 200 indicates that the db has been updated
-                    page = crud.get_page(db, page_name)
-                    response = templates.TemplateResponse("edit_page.html", {'request': request, 'name': page.name, 'content': page.content})
+                    page = await run_db(crud.get_page, db, page_name)
+                    response = page_response("edit_page.html", {'request': request, 'name': page.name, 'content': page.content})
                     return response
                 else:
                     response = RedirectResponse("/create_page_failed", status_code=303)
                     return response
             else:
                 return RedirectResponse(f"/login", status_code=303)
-        return templates.TemplateResponse("edit_page.html", {'request': request, 'name': page.name, 'content': page.content})
+        return page_response("edit_page.html", {'request': request, 'name': page.name, 'content': page.content})
     else:
         return RedirectResponse(f"/login", status_code=303)
 
 
+def page_commit_request(db: Session, name: str, content: str) -> dict:
+    """
+    Build the request to commit an edit of a page. With delta encoding enabled, the edit is sent as a delta
+    against this data server's version of the page, as long as the delta is smaller than the new content.
+    :param db: The database with the page and its commit log.
+    :param name: The name of the page that was edited.
+    :param content: The new content of the page.
+    :return: The JSON RequestPageCommit message.
+    """
+    if CONFIG['DELTA']:
+        page = crud.get_page(db, name)
+        if page is not None and page.version is not None:
+            delta = make_delta(page.content, content)
+            if len(delta) < len(content):
+                return RequestPageCommit(page=name, content=delta, base=page.version).dict()
+    return RequestPageCommit(page=name, content=content).dict()
+
+
+async def send_page_commit(client: httpx.AsyncClient, coord_url: str, name: str, content: str,
+                           data: dict) -> httpx.Response:
+    """
+    Ask the coordinator to commit an edit of a page and wait for the 2PC to finish.
+    :param client: The shared HTTP client to reach the coordinator with.
+    :param coord_url: The URL the coordinator takes page commits at.
+    :param name: The name of the page that was edited.
+    :param content: The new content of the page.
+    :param data: The JSON RequestPageCommit message for the edit.
+    :return: The coordinator's response.
+    """
+    start = perf_counter()
+    coord_response = await CONFIG['WIRE'].post(client, coord_url, data)
+    if coord_response.status_code == 412 and data['base'] is not None:
+        # a replica without the version the delta applies to refused it, so fall back to the full content
+        print(f"Delta edit of {name} failed, resending the full content")
+        data = RequestPageCommit(page=name, content=content).dict()
+        coord_response = await CONFIG['WIRE'].post(client, coord_url, data)
+    done = perf_counter()
+    print(f"Coordination commit took: {done - start}")
+    if coord_response.status_code == 200:
+        result = PageCommitResult.parse_obj(coord_response.json())
+        if result.coalesced:
+            print(f"Edit of {name} was folded into transaction {result.transaction_id}")
+    return coord_response
+
+
+async def finish_edit(edit: Edit, client: httpx.AsyncClient, coord_url: str, data: dict):
+    """
+    Send an edit that was submitted without waiting to the coordinator and record how it finished.
+    :param edit: The edit.
+    :param client: The shared HTTP client to reach the coordinator with.
+    :param coord_url: The URL the coordinator takes page commits at.
+    :param data: The JSON RequestPageCommit message for the edit.
+    :return: None
+    """
+    try:
+        coord_response = await send_page_commit(client, coord_url, edit.page, edit.content, data)
+    except httpx.HTTPError as e:
+        print(f"Edit of {edit.page} could not reach the coordinator:", repr(e))
+        CONFIG['EDITS'].finish(edit, False)
+        return
+    if coord_response.status_code == 200:
+        result = PageCommitResult.parse_obj(coord_response.json())
+        CONFIG['EDITS'].finish(edit, True, result.transaction_id, result.coalesced)
+    else:
+        CONFIG['EDITS'].finish(edit, False)
+
+
 @app.post("/edit_page")
-async def edit_page_post(name: str = Form(...), content: str = Form(...),
-                         coord: str = Depends(get_coordinator), user: Optional[str] = Cookie(None)):
+async def edit_page_post(request: Request, db: Session = Depends(get_db),
+                         coords: List[str] = Depends(get_coordinators), user: Optional[str] = Cookie(None),
+                         client: httpx.AsyncClient = Depends(get_client)):
     """
     POST route handler for applying the edits made by a user.
-    :param name: The name of the page that was edited.
-    :param content: The new value for the content for the page.
+    The form has the name of the page that was edited and the new value for the content for the page. With
+    streaming enabled, a urlencoded form is parsed as it is read.
+    :param request: The request with the edit form.
     :param db: The database where info can be found.
-    :param coord: The ip of the coordinator for 2PC.
+    :param coords: The IPs of the coordinators for 2PC.
+    :param client: The shared HTTP client to reach the coordinator with.
     :param user: The user making the edits.
     :return: Redirect to login if the user is not logged in, or either the page, or a page indicating edit failure.
+             With async edits, redirect to a page showing the status of the edit.
     """
     if user:
+        if CONFIG['STREAM_THRESHOLD'] is not None and \
+                request.headers.get('content-type', '').startswith('application/x-www-form-urlencoded'):
+            form = await read_form(request)
+        else:
+            form = await request.form()
+        name, content = form.get('name'), form.get('content')
+        if not isinstance(name, str) or not isinstance(content, str):
+            raise HTTPException(status_code=422, detail='The edit needs a name and content')
+        del form  # the content is now only held once
         # crud.update_page_content(db, name, content)
-        data = RequestPageCommit(page=name, content=content).dict()
-        start = perf_counter()
-        async with httpx.AsyncClient() as client:
-            coord_url = 'http://' + coord + ':8000' + '/request_page_commit'
-            coord_response = await client.post(coord_url, json=data)
-        done = perf_counter()
-        print(f"Coordination commit took: {done - start}")
+        data = await run_db(page_commit_request, db, name, content)
+        coord_url = 'http://' + coordinator_for(coords, name) + ':8000' + '/request_page_commit'
+        edits = CONFIG['EDITS']
+        if edits is not None:
+            edit = edits.submit(name, content)
+            edit.task = asyncio.ensure_future(finish_edit(edit, client, coord_url, data))
+            return RedirectResponse(f"/edit_pending/{edit.handle}", status_code=303)
+        coord_response = await send_page_commit(client, coord_url, name, content, data)
         if coord_response.status_code == 200:
             # 200 indicates that the db has been updated
             response = RedirectResponse(f"/page/{name}", status_code=303)
@@ -254,36 +463,136 @@ async def edit_page_post(name: str = Form(...), content: str = Form(...),
         return RedirectResponse(f"/login", status_code=303)
 
 
+def edit_status(edit: Edit) -> EditStatus:
+    """
+    :param edit: A submitted edit.
+    :return: The JSON EditStatus message of the edit.
+    """
+    return EditStatus(handle=edit.handle, page=edit.page, status=edit.status, transaction_id=edit.transaction_id,
+                      coalesced=edit.coalesced)
+
+
+def tracked_edit(handle: str) -> Edit:
+    """
+    :param handle: The handle of a submitted edit.
+    :return: The edit.
+    :raises HTTPException: 404 if async edits are disabled or the edit is unknown.
+    """
+    edit = CONFIG['EDITS'].get(handle) if CONFIG['EDITS'] is not None else None
+    if edit is None:
+        raise HTTPException(status_code=404, detail='Unknown edit')
+    return edit
+
+
+@app.get("/edit_status/{handle}")
+async def edit_status_get(handle: str, wait: float = Query(0.0, ge=0.0)):
+    """
+    GET route handler for the status of an edit submitted without waiting for its commit. With wait, the
+    request is held until the edit finishes or the wait is over.
+    :param handle: The handle of the edit.
+    :param wait: The most seconds to wait for the edit to finish, up to MAX_EDIT_WAIT.
+    :return: JSON EditStatus message of the edit.
+    """
+    edit = tracked_edit(handle)
+    if wait > 0:
+        await CONFIG['EDITS'].wait(edit, min(wait, MAX_EDIT_WAIT))
+    return edit_status(edit)
+
+
+@app.get("/edit_pending/{handle}")
+async def edit_pending(handle: str, request: Request):
+    """
+    GET route handler for the webpage shown while an edit is committed in the background. It polls the status of
+    the edit and goes on to the page once the edit is committed.
+    :param handle: The handle of the edit.
+    :param request: The request from the client.
+    :return: The edit pending webpage, redirect to the page or to the edit failure page once the edit finished.
+    """
+    edit = tracked_edit(handle)
+    if edit.status == COMMITTED:
+        return RedirectResponse(f"/page/{edit.page}", status_code=303)
+    if edit.status == ABORTED:
+        return RedirectResponse(f"/edit_page_failed/{edit.page}", status_code=303)
+    return templates.TemplateResponse("edit_pending.html", {'request': request, 'name': edit.page,
+                                                            'handle': handle})
+
+
 @app.get("/pages")
-async def pages(request: Request, db: Session = Depends(get_db)):
+async def pages(request: Request, prefix: str = '', after: Optional[str] = None, db: Session = Depends(get_db)):
     """
-    GET route handler for the webpage linking all available wiki pages.
+    GET route handler for the webpage linking all available wiki pages, in name order and one page of the
+    listing at a time.
     :param request: The request passed in by the client.
+    :param prefix: Only list the pages whose name starts with the prefix.
+    :param after: The last name on the previous page of the listing, None for the first page.
     :param db: The db session to pull the page info from.
-    :return: The webpage showing all of the pages.
+    :return: The webpage showing the pages.
     """
-    query = "%"
-    res = []
-    if query:
-        for page in crud.search_page(db, query):
-            res.append(page.name)
-    return templates.TemplateResponse("all_pages.html", {'request': request, 'res': res})
+    res = await run_db(crud.list_page_names, db, prefix, after, LISTING_PAGE_SIZE + 1)
+    more = len(res) > LISTING_PAGE_SIZE
+    res = res[:LISTING_PAGE_SIZE]
+    return templates.TemplateResponse("all_pages.html", {'request': request, 'res': res, 'prefix': prefix,
+                                                         'first': after is None, 'more': more})
+
+
+def page_etag(version: int) -> str:
+    """
+    :param version: The version of a page.
+    :return: The strong ETag of the rendered page.
+    """
+    return f'"{version}"'
+
+
+def etag_matches(if_none_match: Optional[str], version: Optional[int]) -> bool:
+    """
+    Weak comparison of the ETags a client already has with the current version of a page.
+    :param if_none_match: The If-None-Match header of the request.
+    :param version: The current version of the page, None if it has none.
+    :return: If the client's copy of the page is current.
+    """
+    if if_none_match is None or version is None:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    etag = page_etag(version)
+    return any(tag.strip().removeprefix('W/') == etag for tag in if_none_match.split(','))
 
 
 @app.get("/page/{page_name}")
-async def page(page_name: str, request: Request, db: Session = Depends(get_db)):
+async def page(page_name: str, request: Request, db: Session = Depends(get_db),
+               if_none_match: Optional[str] = Header(None)):
     """
     GET route handler for a specific wiki page.
+    The page is tagged with its version, and a client that already has the current version gets a 304 without
+    the content being loaded.
     :param page_name: The name of the page to access.
     :param request: The request from the client.
     :param db: The database where the page info is stored.
-    :return: The desired wiki webpage, or a page not found page if page DNE.
+    :param if_none_match: The ETags of the copies of the page the client has.
+    :return: The desired wiki webpage, a 304 if the client's copy is current, or a page not found page if page DNE.
     """
-    page = crud.get_page(db, page_name)
+    cache = CONFIG['PAGE_CACHE']
+    cached = cache.get(page_name, str(request.base_url)) if cache is not None else None
+    stamp = cache.stamp(page_name) if cache is not None else None
+    if cached is not None:
+        body, version = cached
+    else:
+        version = await run_db(crud.page_version, db, page_name) if if_none_match is not None else None
+    if etag_matches(if_none_match, version):
+        return Response(status_code=304, headers={'ETag': page_etag(version)})
+    if cached is not None:
+        return HTMLResponse(body, headers={'ETag': page_etag(version)})
+    page = await run_db(crud.get_page, db, page_name)
     if page is None:
         return templates.TemplateResponse("page_not_found.html", {'request': request, 'name': page_name})
     else:
-        return templates.TemplateResponse("page.html", {'request': request, 'name': page.name, 'content': page.content})
+        response = page_response("page.html", {'request': request, 'name': page.name, 'content': page.content,
+                                               'history': CONFIG['HISTORY']})
+        if page.version is not None:
+            response.headers['ETag'] = page_etag(page.version)
+            if cache is not None and not isinstance(response, StreamingResponse):
+                cache.put(page_name, str(request.base_url), response.body, page.version, stamp)
+        return response
 
 
 @app.get("/create_page")
@@ -312,19 +621,80 @@ async def create_page_post(name: str = Form(...)):
 
 
 @app.get("/search")
-async def search(request: Request, query: Optional[str] = None, db: Session = Depends(get_db)):
+async def search(request: Request, query: Optional[str] = None, results_page: int = Query(1, alias='page', ge=1),
+                 db: Session = Depends(get_db)):
     """
-    GET route handler for the search webpage.
+    GET route handler for the search webpage. Pages are searched by name and content, best matches first, or
+    by name only when full-text search is not available.
     :param request: The request from the client.
     :param query: The query parameters with the search query.
+    :param results_page: Which page of the search results to show, starting from 1.
     :param db: The database with the webpages.
     :return: The search webpage.
     """
     res = []
+    more = False
     if query:
-        for page in crud.search_page(db, query):
-            res.append(page.name)
-    return templates.TemplateResponse("search.html", {'request': request, 'res': res})
+        offset = (results_page - 1) * SEARCH_PAGE_SIZE
+        if CONFIG['FULL_TEXT']:
+            res = await run_db(search_pages, db, query, offset, SEARCH_PAGE_SIZE + 1)
+        else:
+            res = await run_db(crud.search_page, db, query, offset, SEARCH_PAGE_SIZE + 1)
+        more = len(res) > SEARCH_PAGE_SIZE
+        res = res[:SEARCH_PAGE_SIZE]
+    return templates.TemplateResponse("search.html", {'request': request, 'res': res, 'query': query or '',
+                                                      'page': results_page, 'more': more})
+
+
+@app.get("/history/{page_name}")
+async def history(page_name: str, request: Request, before: Optional[int] = None, db: Session = Depends(get_db)):
+    """
+    GET route handler for the history of a page, newest revision first and one page of the history at a time.
+    :param page_name: The name of the page.
+    :param request: The request from the client.
+    :param before: The oldest revision number of the previous page of the history, None for the newest revisions.
+    :param db: The database with the page history.
+    :return: The page history webpage.
+    """
+    revisions = await run_db(list_revisions, db, page_name, before, HISTORY_PAGE_SIZE + 1)
+    return templates.TemplateResponse("history.html", {'request': request, 'name': page_name,
+                                                       'revisions': revisions[:HISTORY_PAGE_SIZE],
+                                                       'more': len(revisions) > HISTORY_PAGE_SIZE})
+
+
+@app.get("/history/{page_name}/{number}")
+async def revision(page_name: str, number: int, request: Request, db: Session = Depends(get_db)):
+    """
+    GET route handler for a past revision of a page.
+    :param page_name: The name of the page.
+    :param number: The revision number.
+    :param request: The request from the client.
+    :param db: The database with the page history.
+    :return: The revision webpage, or a page not found page if the revision DNE.
+    """
+    content = await run_db(get_revision, db, page_name, number)
+    if content is None:
+        return templates.TemplateResponse("page_not_found.html", {'request': request, 'name': page_name})
+    return templates.TemplateResponse("revision.html", {'request': request, 'name': page_name, 'number': number,
+                                                        'content': content})
+
+
+@app.get("/diff/{page_name}")
+async def diff(page_name: str, request: Request, old: int, new: int, db: Session = Depends(get_db)):
+    """
+    GET route handler for the differences between two revisions of a page.
+    :param page_name: The name of the page.
+    :param request: The request from the client.
+    :param old: The revision number to diff from.
+    :param new: The revision number to diff to.
+    :param db: The database with the page history.
+    :return: The diff webpage, or a page not found page if either revision DNE.
+    """
+    lines = await run_db(diff_revisions, db, page_name, old, new)
+    if lines is None:
+        return templates.TemplateResponse("page_not_found.html", {'request': request, 'name': page_name})
+    return templates.TemplateResponse("diff.html", {'request': request, 'name': page_name, 'old': old, 'new': new,
+                                                    'lines': lines})
 
 
 @app.get("/edit_admin")
@@ -338,39 +708,39 @@ async def edit_admin(request: Request, db: Session = Depends(get_db), user: Opti
     """
     if user is None:
         return RedirectResponse(f"/login", status_code=303)
-    current_user = crud.get_user_by_name(db, user)
-    if not current_user.admin:
+    if not await user_admin(db, user):
         return RedirectResponse('/', status_code=303)
-    return templates.TemplateResponse("edit_admin.html", {'request': request, 'res': crud.get_users(db)})
+    users = await run_db(crud.get_users, db)
+    return templates.TemplateResponse("edit_admin.html", {'request': request, 'res': users})
 
 
 @app.post("/edit_admin")
 async def edit_admin_post(request: Request, db: Session = Depends(get_db),
-                          coord: str = Depends(get_coordinator), user: Optional[str] = Cookie(None)):
+                          coords: List[str] = Depends(get_coordinators), user: Optional[str] = Cookie(None),
+                          client: httpx.AsyncClient = Depends(get_client)):
     """
     POST route handler for the edit admin webpage. Handles updating admin status for users.
     :param request: The request from the client.
     :param db: The database with the user information.
-    :param coord: The ip of the coordinator for 2PC.
+    :param coords: The IPs of the coordinators for 2PC.
+    :param client: The shared HTTP client to reach the coordinator with.
     :param user: The user that wants to change the admin rights of other users.
     :return: login page if no user, Not admin message if not an admin user, edit_admin page if successful,
              or edit_admin_failed page if something went wrong with the update.
     """
     if user is None:
         return RedirectResponse(f"/login", status_code=303)
-    current_user = crud.get_user_by_name(db, user)
-    if not current_user.admin:
+    if not await user_admin(db, user):
         return RedirectResponse('/', status_code=303)
     form_data = await request.form()
     print(form_data)
     success = True
-    for u in crud.get_users(db):
+    for u in await run_db(crud.get_users, db):
         if u.name in form_data:
             # crud.update_admin(db, u.name, True)
             data = RequestUserCommit(name=u.name, admin=True).dict()
-            async with httpx.AsyncClient() as client:
-                coord_url = 'http://' + coord + ':8000' + '/request_user_commit'
-                coord_response = await client.post(coord_url, json=data)
+            coord_url = 'http://' + coordinator_for(coords, u.name) + ':8000' + '/request_user_commit'
+            coord_response = await CONFIG['WIRE'].post(client, coord_url, data)
             if coord_response.status_code != 200:
                 success = False
                 print('failed', u.name, 'admin')
@@ -379,9 +749,8 @@ async def edit_admin_post(request: Request, db: Session = Depends(get_db),
         else:
             # crud.update_admin(db, u.name, False)
             data = RequestUserCommit(name=u.name, admin=False).dict()
-            async with httpx.AsyncClient() as client:
-                coord_url = 'http://' + coord + ':8000' + '/request_user_commit'
-                coord_response = await client.post(coord_url, json=data)
+            coord_url = 'http://' + coordinator_for(coords, u.name) + ':8000' + '/request_user_commit'
+            coord_response = await CONFIG['WIRE'].post(client, coord_url, data)
             if coord_response.status_code != 200:
                 success = False
                 print('failed', u.name, 'not admin')
@@ -389,8 +758,7 @@ async def edit_admin_post(request: Request, db: Session = Depends(get_db),
                 print(u.name, 'not admin')
 
     if success:
-        current_user = crud.get_user_by_name(db, user)
-        if current_user.admin:
+        if await user_admin(db, user):
             return RedirectResponse('/edit_admin', status_code=303)
         else:
             return RedirectResponse('/', status_code=303)
@@ -439,6 +807,111 @@ async def edit_admin_failed(request: Request):
     return templates.TemplateResponse("edit_admin_failed", {'request': request})
 
 
+def invalidate_pages(names: List[str]):
+    """
+    Drop pages from the rendered page cache once a commit to them has been applied.
+    :param names: The names of the committed pages.
+    :return: None
+    """
+    if CONFIG['PAGE_CACHE'] is not None:
+        for name in names:
+            CONFIG['PAGE_CACHE'].invalidate(name)
+
+
+def invalidate_users(names: List[str]):
+    """
+    Drop users from the user cache once a commit to them has been applied.
+    :param names: The names of the committed users.
+    :return: None
+    """
+    if CONFIG['USER_CACHE'] is not None:
+        for name in names:
+            CONFIG['USER_CACHE'].invalidate(name)
+
+
+def finish_edits(db_logs: List[models.Log]):
+    """
+    Mark the edits submitted on this data server that the applied page commits carried as committed, without
+    waiting for the coordinator to hear back from every replica.
+    :param db_logs: The log entries of the applied page commits.
+    :return: None
+    """
+    if CONFIG['EDITS'] is not None:
+        for db_log in db_logs:
+            CONFIG['EDITS'].applied(db_log.name, db_log.content, db_log.tid)
+
+
+async def apply_decisions(db: Session, decisions: List[DoCommit]) -> List[bool]:
+    """
+    Apply the coordinator's decisions in a single local transaction, then drop the committed pages and users
+    from the caches and finish the edits waiting for them.
+    :param db: The database with the commit log and the tables where the data is to be committed.
+    :param decisions: The coordinator's decision for each transaction.
+    :return: If this data server has committed, for each of the transactions.
+    """
+    applied = await run_db(crud.apply_commits, db, decisions, write=True)
+    if CONFIG['PAGE_CACHE'] is not None or CONFIG['USER_CACHE'] is not None or CONFIG['EDITS'] is not None:
+        committed = [decision.transaction_id for decision, commit in zip(decisions, applied) if commit]
+        db_logs = (await run_db(crud.get_logs, db, committed)).values()
+        invalidate_pages([db_log.name for db_log in db_logs if db_log.type == 'page'])
+        invalidate_users([db_log.name for db_log in db_logs if db_log.type == 'user'])
+        finish_edits([db_log for db_log in db_logs if db_log.type == 'page'])
+    return applied
+
+
+async def ask_coordinators(tids: List[int]) -> int:
+    """
+    Ask the coordinators for their decision on transactions this data server promised long ago, and apply the
+    decisions they answer. A coordinator answers abort for a transaction it has no record of.
+    :param tids: The tids of the promised transactions.
+    :return: How many of the transactions were decided.
+    """
+    coords = CONFIG['COORDS']
+    by_coord = {}
+    for tid in tids:
+        # every coordinator hands out tids from its own stripe
+        by_coord.setdefault(coords[tid % len(coords)], []).append(tid)
+    decisions = []
+    for coord, coord_tids in by_coord.items():
+        inquiry = Inquiry(sender=CONFIG['IP'], transaction_ids=coord_tids)
+        try:
+            response = await CONFIG['WIRE'].post(CONFIG['CLIENT'], 'http://' + coord + ':8000' + '/inquire',
+                                                 inquiry.dict())
+        except httpx.HTTPError as e:
+            print(f"Could not reach coordinator {coord} to inquire:", repr(e))
+            continue
+        if response.status_code == 200:
+            decisions += DoCommitBatch.parse_obj(response.json()).commits
+    if not decisions:
+        return 0
+    with SessionLocal() as db:
+        await apply_decisions(db, decisions)
+    return len(decisions)
+
+
+def stale_base(commit: PageCommit, promise: bool) -> bool:
+    """
+    :param commit: A page commit from the coordinator.
+    :param promise: If this data server promised the commit.
+    :return: If the commit may have been refused because it is a delta against a version of the page this data
+             server does not have. A delta older than the page is refused too, and its full content then is
+             refused again.
+    """
+    return not promise and commit.base is not None
+
+
+@app.post("/max_tid")
+async def max_tid(db: Session = Depends(get_db), ip: str = Depends(get_ip)):
+    """
+    Route handler for a starting coordinator asking for the highest tid this data server has seen. Compaction
+    keeps the newest entry of each page, so it is never below the version of a page.
+    :param db: The database with the commit log.
+    :param ip: The IP of this data server.
+    :return: JSON MaxTid with the highest tid in the log.
+    """
+    return MaxTid(sender=ip, transaction_id=await run_db(crud.max_tid, db))
+
+
 @app.post("/can_page_commit")
 async def can_page_commit(commit: PageCommit, db: Session = Depends(get_db), ip: str = Depends(get_ip)):
     """
@@ -449,18 +922,30 @@ async def can_page_commit(commit: PageCommit, db: Session = Depends(get_db), ip:
     :return: JSON CommitReply stating if this data server is willing to commit or not.
     """
     start = perf_counter()
-    if crud.tid_in_log(db, commit.transaction_id):
-        db_log = crud.get_log(db, commit.transaction_id)
-        if db_log.status == 'promised':
-            print(f"Can commit took: {perf_counter() - start}")
-            return CommitReply(sender=ip, commit=True, transaction_id=commit.transaction_id)
-        else:
-            # should this change status to aborted in log?
-            return CommitReply(sender=ip, commit=False, transaction_id=commit.transaction_id)
-    else:
-        crud.add_to_log(db, commit.transaction_id, 'page', 'promised', commit.page, commit.content, False)
-        print(f"Can commit took: {perf_counter() - start}")
-        return CommitReply(sender=ip, commit=True, transaction_id=commit.transaction_id)
+    [promise] = await run_db(crud.promise_commits, db, [commit], write=True)
+    print(f"Can commit took: {perf_counter() - start}")
+    return CommitReply(sender=ip, commit=promise, transaction_id=commit.transaction_id,
+                       stale_base=stale_base(commit, promise))
+
+
+@app.post("/can_page_commit_batch")
+async def can_page_commit_batch(batch: PageCommitBatch, db: Session = Depends(get_db), ip: str = Depends(get_ip)):
+    """
+    POST route handler for when the coordinator wants to commit a batch of page changes.
+    All of the commits are promised in a single local transaction.
+    1st Phase of 2PC.
+    :param batch: The page commits that the coordinator wants to perform.
+    :param db: The database with the commit log.
+    :param ip: The IP of this data server.
+    :return: JSON CommitReplyBatch stating if this data server is willing to commit each of the commits.
+    """
+    start = perf_counter()
+    promises = await run_db(crud.promise_commits, db, batch.commits, write=True)
+    print(f"Can commit batch of {len(promises)} took: {perf_counter() - start}")
+    return CommitReplyBatch(sender=ip, replies=[
+        CommitReply(transaction_id=commit.transaction_id, sender=ip, commit=promise,
+                    stale_base=stale_base(commit, promise))
+        for commit, promise in zip(batch.commits, promises)])
 
 
 @app.post("/can_user_commit")
@@ -473,16 +958,8 @@ async def can_user_commit(commit: UserCommit, db: Session = Depends(get_db), ip:
     :param ip: The IP of this data server.
     :return: JSON CommitReply stating if this data server is willing to commit or not.
     """
-    if crud.tid_in_log(db, commit.transaction_id):
-        db_log = crud.get_log(db, commit.transaction_id)
-        if db_log.status == 'promised':
-            return CommitReply(transaction_id=commit.transaction_id, sender=ip, commit=True)
-        else:
-            # should this change status to aborted in log?
-            return CommitReply(transaction_id=commit.transaction_id, sender=ip, commit=False)
-    else:
-        crud.add_to_log(db, commit.transaction_id, 'user', 'promised', commit.name, '', commit.admin)
-        return CommitReply(transaction_id=commit.transaction_id, sender=ip, commit=True)
+    [promise] = await run_db(crud.promise_commits, db, [commit], write=True)
+    return CommitReply(transaction_id=commit.transaction_id, sender=ip, commit=promise)
 
 
 @app.post("/do_commit")
@@ -498,23 +975,118 @@ async def do_commit(commit: DoCommit, db: Session = Depends(get_db), ip: str = D
     :return: JSON HaveCommit message indicating whether or not this data server has commit or not.
     """
     start = perf_counter()
-    if crud.tid_in_log(db, commit.transaction_id):
-        db_log = crud.get_log(db, commit.transaction_id)
-        if not commit.commit:  # coordinator decided to abort the commit
-            crud.update_in_log(db, commit.transaction_id, db_log.type, 'aborted', db_log.name, db_log.content, db_log.admin)
-            return HaveCommit(transaction_id=commit.transaction_id, sender=ip, commit=False)
-        else:
-            if db_log.status == 'promised' or db_log.status == 'committed':
-                crud.update_in_log(db, commit.transaction_id, db_log.type, 'committed', db_log.name, db_log.content, db_log.admin)
-                if db_log.type == 'user':
-                    crud.create_or_update_user(db, commit.transaction_id)
-                elif db_log.type == 'page':
-                    crud.create_or_update_page(db, commit.transaction_id)
-                print(f"Do commit took {perf_counter() - start}")
-                return HaveCommit(transaction_id=commit.transaction_id, sender=ip, commit=True)
-            else:
-                crud.update_in_log(db, commit.transaction_id, db_log.type, 'aborted', db_log.name, db_log.content, db_log.admin)
-                return HaveCommit(transaction_id=commit.transaction_id, sender=ip, commit=False)
-    else:
-        crud.add_to_log(db, commit.transaction_id, '', 'aborted', '', '', False)
-        return HaveCommit(transaction_id=commit.transaction_id, sender=ip, commit=False)
+    [applied] = await apply_decisions(db, [commit])
+    print(f"Do commit took {perf_counter() - start}")
+    return HaveCommit(transaction_id=commit.transaction_id, sender=ip, commit=applied)
+
+
+@app.post("/do_commit_batch")
+async def do_commit_batch(batch: DoCommitBatch, db: Session = Depends(get_db), ip: str = Depends(get_ip)):
+    """
+    POST route handler for when the coordinator has decided the outcome of a batch of commits.
+    Every committed change of the batch is applied in a single local transaction.
+    2nd Phase of 2PC.
+    :param batch: JSON message with the decision for each transaction of the batch.
+    :param db: The database with the commit log and the tables where the data is to be committed.
+    :param ip: The ip of this data server.
+    :return: JSON HaveCommitBatch message indicating which of the commits this data server has applied.
+    """
+    start = perf_counter()
+    applied = await apply_decisions(db, batch.commits)
+    print(f"Do commit batch of {len(applied)} took {perf_counter() - start}")
+    return HaveCommitBatch(sender=ip, replies=[
+        HaveCommit(transaction_id=decision.transaction_id, sender=ip, commit=commit)
+        for decision, commit in zip(batch.commits, applied)])
+
+
+@app.post("/one_phase_page_commit_batch")
+async def one_phase_page_commit_batch(batch: PageCommitBatch, db: Session = Depends(get_db), ip: str = Depends(get_ip)):
+    """
+    POST route handler for a one-phase commit of a batch of page changes, used by the coordinator when this
+    data server is the only participant. Every change is promised and applied in a single local transaction.
+    :param batch: The page commits that the coordinator wants to perform.
+    :param db: The database with the commit log and the tables where the data is to be committed.
+    :param ip: The IP of this data server.
+    :return: JSON HaveCommitBatch message indicating which of the commits this data server has applied.
+    """
+    start = perf_counter()
+    applied = await run_db(crud.commit_one_phase, db, batch.commits, write=True)
+    invalidate_pages([commit.page for commit, committed in zip(batch.commits, applied) if committed])
+    if CONFIG['EDITS'] is not None:
+        tids = [commit.transaction_id for commit, committed in zip(batch.commits, applied) if committed]
+        finish_edits(list((await run_db(crud.get_logs, db, tids)).values()))
+    print(f"One phase commit batch of {len(applied)} took {perf_counter() - start}")
+    return HaveCommitBatch(sender=ip, replies=[
+        HaveCommit(transaction_id=commit.transaction_id, sender=ip, commit=committed,
+                   stale_base=stale_base(commit, committed))
+        for commit, committed in zip(batch.commits, applied)])
+
+
+@app.post("/one_phase_user_commit")
+async def one_phase_user_commit(commit: UserCommit, db: Session = Depends(get_db), ip: str = Depends(get_ip)):
+    """
+    POST route handler for a one-phase commit of a user change, used by the coordinator when this
+    data server is the only participant. The change is promised and applied in a single local transaction.
+    :param commit: The user commit that the coordinator wants to perform.
+    :param db: The database with the commit log and the tables where the data is to be committed.
+    :param ip: The IP of this data server.
+    :return: JSON HaveCommit message indicating whether or not this data server has committed.
+    """
+    [committed] = await run_db(crud.commit_one_phase, db, [commit], write=True)
+    if committed:
+        invalidate_users([commit.name])
+    return HaveCommit(transaction_id=commit.transaction_id, sender=ip, commit=committed)
+
+@app.get("/cache_stats")
+async def cache_stats():
+    """
+    Route handler exposing the hit ratio, memory use and evictions of the rendered page and user caches.
+    :return: JSON with the statistics of each enabled cache.
+    """
+    return {name: CONFIG[key].stats() for name, key in (('pages', 'PAGE_CACHE'), ('users', 'USER_CACHE'))
+            if CONFIG[key] is not None}
+
+
+@app.get("/wire_stats")
+async def wire_stats():
+    """
+    Route handler exposing the bytes and compression CPU time of the messages exchanged with the coordinator,
+    to tune the wire encoding and compression per link.
+    :return: JSON with the wire statistics.
+    """
+    return CONFIG['WIRE'].stats()
+
+
+@app.get("/log_stats")
+async def log_stats(db: Session = Depends(get_db)):
+    """
+    Route handler exposing the size of the Log table, the log compaction statistics and how many promised
+    transactions were asked about.
+    :param db: The database with the commit log.
+    :return: JSON with the log statistics.
+    """
+    stats = {'log_size': await run_db(crud.log_size, db)} if CONFIG['COMPACTOR'] is None \
+        else await CONFIG['COMPACTOR'].stats()
+    if CONFIG['INQUIRER'] is not None:
+        stats['inquiry'] = CONFIG['INQUIRER'].stats()
+    return stats
+
+
+@app.get("/edit_stats")
+async def edit_stats():
+    """
+    Route handler exposing how many edits were submitted without waiting for their commit, and how they finished.
+    :return: JSON with the edit statistics, empty if async edits are disabled.
+    """
+    return CONFIG['EDITS'].stats() if CONFIG['EDITS'] is not None else {}
+
+
+@app.get("/page_store_stats")
+async def page_store_stats():
+    """
+    Route handler exposing the size of the in-memory page store and the records it has written.
+    :return: JSON with the page store statistics.
+    """
+    if CONFIG['PAGE_STORE'] is None:
+        return {'engine': 'sqlite'}
+    return CONFIG['PAGE_STORE'].stats()
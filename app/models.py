@@ -2,7 +2,8 @@
 Objects representing database rows in the SQL database/ORM model.
 """
 
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Text
+from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Text, text
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import relationship
 
 from .database import Base
@@ -27,11 +28,13 @@ class Page(Base):
     id = unique identifier
     name = page name
     content = editable page content
+    version = tid of the last commit applied to the page
     """
     __tablename__ = "Pages"
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, unique=True, index=True)
     content = Column(Text)
+    version = Column(Integer)
 
 
 class Log(Base):
@@ -44,16 +47,18 @@ class Log(Base):
     type = The type of commit {page, user}
     status = The status of the commit.
     name = The name of the page or user
-    content = The contents for a webpage. Empty string for a user.
+    content = The contents for a webpage, or a delta against the base version. Empty string for a user.
     admin = The admin rights for the user. False for a page.
+    base = The tid of the page version the content is a delta against. None if content is the full content.
     """
     __tablename__ = "Log"
     tid = Column(Integer, primary_key=True, index=True, autoincrement=True)
     type = Column(String)
     status = Column(String)
-    name = Column(String)
+    name = Column(String, index=True)
     content = Column(Text)
     admin = Column(Boolean)
+    base = Column(Integer)
 
 
 class PendingCommits(Base):
@@ -66,3 +71,61 @@ class PendingCommits(Base):
     tid = Column(Integer, primary_key=True, index=True)
     sender = Column(String, primary_key=True, index=True)
     status = Column(String)
+
+
+class Revision(Base):
+    """
+    Object mapping for a committed version of a page, kept for the page history.
+    A revision is either a snapshot of the full content or a delta against the revision before it.
+    page = the name of the page
+    number = the revision number, counting up from 1 for each page
+    version = tid of the commit that made the revision
+    snapshot = if content is the full content rather than a delta
+    depth = how many deltas lead from the last snapshot to this revision, 0 for a snapshot
+    chain_size = the total length of those deltas
+    content = the full content of the page, or the delta from the previous revision
+    """
+    __tablename__ = "Revisions"
+    page = Column(String, primary_key=True)
+    number = Column(Integer, primary_key=True)
+    version = Column(Integer)
+    snapshot = Column(Boolean)
+    depth = Column(Integer)
+    chain_size = Column(Integer)
+    content = Column(Text)
+
+
+"""
+Columns added to tables after they were first created, with their SQL types. A db created before a column
+was added gets it when the server starts.
+"""
+ADDED_COLUMNS = {
+    'Pages': {'version': 'INTEGER'},
+    'Log': {'base': 'INTEGER'},
+}
+
+
+def create_schema(engine: Engine):
+    """
+    Create the tables the db does not have yet, and bring the tables of a db created by an older version of
+    the server up to date: add the missing columns and indexes, and set the version of every page to the tid
+    of the newest commit applied to it.
+    :param engine: The db engine.
+    :return: None
+    """
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        added = set()
+        for table, columns in ADDED_COLUMNS.items():
+            existing = {row[1] for row in conn.execute(text(f'PRAGMA table_info("{table}")'))}
+            for column, sql_type in columns.items():
+                if column not in existing:
+                    conn.execute(text(f'ALTER TABLE "{table}" ADD COLUMN {column} {sql_type}'))
+                    added.add((table, column))
+                    print(f'Added column {column} to the {table} table')
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+        if ('Pages', 'version') in added:
+            conn.execute(text('UPDATE "Pages" SET version = (SELECT MAX(tid) FROM "Log" WHERE "Log".type = \'page\' '
+                              'AND "Log".status = \'committed\' AND "Log".name = "Pages".name)'))
@@ -0,0 +1,165 @@
+"""
+Cache of rendered wiki pages on a data server.
+Page views are far more common than edits, so the rendered HTML of each page is kept in memory until a commit
+to the page is applied. The cache is bounded by the bytes it holds and evicts the least recently viewed pages.
+"""
+
+from collections import OrderedDict
+from typing import Dict, Optional, Set, Tuple
+
+from .workers import Generations
+
+# estimated bytes of bookkeeping per cached page on top of its body and name
+ENTRY_OVERHEAD = 256
+
+
+class PageCache:
+    """
+    LRU cache of rendered pages, bounded by memory.
+    A page is cached once per base URL it was requested under, since the rendered links depend on it.
+    max_bytes = the most bytes of rendered pages kept in memory
+    entries = the rendered pages and their versions, by page name and base URL, least recently viewed first
+    keys = the cache keys of each page name
+    clock = counts invalidations, a page rendered from a read that started before an invalidation is not cached
+    generations = the generations of the pages shared with the other workers of the data server, None with one
+    """
+
+    def __init__(self, max_bytes: int, generations: Optional[Generations] = None):
+        self.max_bytes = max_bytes
+        self.generations = generations
+        self.entries: OrderedDict[Tuple[str, str], Tuple[bytes, int, int]] = OrderedDict()
+        self.keys: Dict[str, Set[Tuple[str, str]]] = {}
+        self.size = 0
+        self.clock = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _entry_size(key: Tuple[str, str], body: bytes) -> int:
+        """
+        :param key: The page name and base URL of the entry.
+        :param body: The rendered page.
+        :return: The estimated memory used by the entry.
+        """
+        return len(body) + len(key[0]) + len(key[1]) + ENTRY_OVERHEAD
+
+    def _generation(self, name: str) -> int:
+        """
+        :param name: The name of the page.
+        :return: The generation of the page shared by the workers, 0 with a single worker.
+        """
+        return self.generations.get(f'page/{name}') if self.generations is not None else 0
+
+    def stamp(self, name: str) -> Tuple[int, int]:
+        """
+        Taken before a page is read from the db, to tell if a commit to it was applied while it was rendered.
+        :param name: The name of the page.
+        :return: The clock of the cache and the generation of the page.
+        """
+        return self.clock, self._generation(name)
+
+    def get(self, name: str, base_url: str) -> Optional[Tuple[bytes, int]]:
+        """
+        :param name: The name of the page.
+        :param base_url: The base URL the page was requested under.
+        :return: The rendered page and its version, None if it is not cached.
+        """
+        key = (name, base_url)
+        entry = self.entries.get(key)
+        if entry is not None and entry[2] != self._generation(name):
+            # another worker applied a commit to the page
+            self._remove(key)
+            self.invalidations += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0], entry[1]
+
+    def put(self, name: str, base_url: str, body: bytes, version: int, stamp: Tuple[int, int]):
+        """
+        Cache a rendered page, evicting the least recently viewed pages to make room for it.
+        :param name: The name of the page.
+        :param base_url: The base URL the page was requested under.
+        :param body: The rendered page.
+        :param version: The version of the page that was rendered.
+        :param stamp: The stamp of the page taken before it was read from the db.
+        :return: None
+        """
+        key = (name, base_url)
+        size = self._entry_size(key, body)
+        clock, generation = stamp
+        if size > self.max_bytes or clock != self.clock:
+            return
+        self._remove(key)
+        while self.size + size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+        self.entries[key] = (body, version, generation)
+        self.keys.setdefault(name, set()).add(key)
+        self.size += size
+
+    def invalidate(self, name: str):
+        """
+        Drop a page from the cache, called when a commit to it is applied, and from the caches of the other
+        workers.
+        :param name: The name of the page.
+        :return: None
+        """
+        self.clock += 1
+        if self.generations is not None:
+            self.generations.bump(f'page/{name}')
+        keys = self.keys.get(name)
+        if not keys:
+            return
+        for key in list(keys):
+            self._remove(key)
+        self.invalidations += 1
+
+    def _remove(self, key: Tuple[str, str]):
+        """
+        Remove an entry if it is cached.
+        :param key: The page name and base URL of the entry.
+        :return: None
+        """
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= self._entry_size(key, entry[0])
+        keys = self.keys[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self.keys[key[0]]
+
+    def stats(self) -> dict:
+        """
+        :return: Hit ratio, memory use and eviction statistics of the cache.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+
+def create_page_cache(conf: dict, generations: Optional[Generations] = None) -> Optional[PageCache]:
+    """
+    Create the rendered page cache from the [page_cache] table of the server config.
+    :param conf: The full server config.
+    :param generations: The generations shared by the workers of the data server, None with a single worker.
+    :return: The page cache, None if caching is disabled.
+    """
+    page_cache = conf.get('page_cache', {})
+    if not page_cache.get('enabled', False):
+        return None
+    return PageCache(page_cache.get('max_bytes', 16 * 1024 * 1024), generations)
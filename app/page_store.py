@@ -0,0 +1,268 @@
+"""
+In-memory page store of a data server.
+Instead of the Pages table, the pages can be kept in a dict in memory, so a page read is a dict lookup rather
+than an ORM query. Applied page commits are appended to a segment file, which is periodically folded into a
+snapshot of every page. On startup the pages are rebuilt from the snapshot and the segment. The segment is not
+synced on every commit: the Log table still records every commit, and the newest committed entry of each page,
+which log compaction always keeps, restores any page the segment lost in a crash.
+"""
+
+import json
+import os
+import sys
+import threading
+from bisect import bisect_left, bisect_right, insort
+from time import perf_counter
+from typing import Dict, List, NamedTuple, Optional
+
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session
+
+from . import models
+from .database import SessionLocal
+
+
+class StoredPage(NamedTuple):
+    """
+    A page kept in memory, with the fields of a Page row that are read.
+    name = page name
+    content = editable page content
+    version = tid of the last commit applied to the page
+    """
+    name: str
+    content: str
+    version: Optional[int]
+
+
+class MemoryPageStore:
+    """
+    Keeps every page of the data server in memory, persisted through an append-only segment file and a snapshot.
+    path = the segment file applied page commits are appended to, the snapshot is kept next to it
+    snapshot_every = how many records may be appended to the segment before it is folded into the snapshot
+    pages = every page, by name
+    names = the page names in name order, for listing
+    lock = guards pages and names, which the db writer thread changes while reader threads list them
+    """
+
+    def __init__(self, path: str, snapshot_every: int):
+        self.path = path
+        self.snapshot_path = path + '.snapshot'
+        self.snapshot_every = snapshot_every
+        self.pages: Dict[str, StoredPage] = {}
+        self.names: List[str] = []
+        self.lock = threading.Lock()
+        self.records_since_snapshot = 0
+        self.writes = 0
+        self.snapshots = 0
+        self.loaded = self._load(self.snapshot_path)
+        self.replayed = self._load(self.path)
+        self.records_since_snapshot = self.replayed
+        self.names = sorted(self.pages)
+        self.file = open(self.path, 'ab')
+
+    def _load(self, path: str) -> int:
+        """
+        Apply the records of a snapshot or segment file. A record torn by a crash at the end of the file is
+        cut off.
+        :param path: The file to load.
+        :return: How many records were applied.
+        """
+        if not os.path.exists(path):
+            return 0
+        good = 0
+        records = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    name, content, version = json.loads(line)
+                except ValueError:
+                    break
+                self.pages[name] = StoredPage(name, content, version)
+                good += len(line)
+                records += 1
+        if good != os.path.getsize(path):
+            print('Cutting off torn page store tail at', good)
+            os.truncate(path, good)
+        return records
+
+    @staticmethod
+    def _encode(pages: List[StoredPage]) -> bytes:
+        """
+        :param pages: The pages to encode.
+        :return: The pages as JSON lines.
+        """
+        return b''.join(json.dumps(page, separators=(',', ':')).encode() + b'\n' for page in pages)
+
+    def write(self, pages: List[StoredPage]):
+        """
+        Apply pages and append them to the segment, folding the segment into the snapshot once it is long
+        enough.
+        :param pages: The new state of each page, in the order the commits were applied.
+        :return: None
+        """
+        with self.lock:
+            for page in pages:
+                if page.name not in self.pages:
+                    insort(self.names, page.name)
+                self.pages[page.name] = page
+        self.file.write(self._encode(pages))
+        self.file.flush()
+        self.writes += len(pages)
+        self.records_since_snapshot += len(pages)
+        if self.records_since_snapshot >= self.snapshot_every:
+            self.snapshot()
+
+    def snapshot(self):
+        """
+        Replace the snapshot with one holding every page and empty the segment.
+        :return: None
+        """
+        start = perf_counter()
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            with self.lock:
+                pages = list(self.pages.values())
+            f.write(self._encode(pages))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        # until the segment is emptied, replaying it on top of the new snapshot ends in the same pages
+        self.file.close()
+        self.file = open(self.path, 'wb')
+        self.records_since_snapshot = 0
+        self.snapshots += 1
+        print(f'Snapshot of {len(self.pages)} pages in {perf_counter() - start:.2f} s')
+
+    def stage(self, db: Session, page: StoredPage):
+        """
+        Stage a page commit in a db session. It is applied once the session commits the log entry of the
+        commit, and dropped if the session rolls back.
+        :param db: The db session the commit's log entry is changed in.
+        :param page: The new state of the page.
+        :return: None
+        """
+        db.info.setdefault('staged_pages', []).append(page)
+
+    def committed(self, db: Session):
+        """
+        Apply the page commits staged in a db session that has committed.
+        :param db: The db session.
+        :return: None
+        """
+        staged = db.info.pop('staged_pages', None)
+        if staged:
+            self.write(staged)
+
+    @staticmethod
+    def rolled_back(db: Session):
+        """
+        Drop the page commits staged in a db session that has rolled back.
+        :param db: The db session.
+        :return: None
+        """
+        db.info.pop('staged_pages', None)
+
+    def recover(self, db: Session) -> int:
+        """
+        Restore the pages whose last commits were lost from the segment, from the newest committed log entry
+        of each page.
+        :param db: The db session to read the log from.
+        :return: How many pages were restored.
+        """
+        versions = db.query(func.max(models.Log.tid))\
+            .filter(models.Log.type == 'page', models.Log.status == 'committed')\
+            .group_by(models.Log.name)
+        lost = []
+        for name, content, tid in db.query(models.Log.name, models.Log.content, models.Log.tid)\
+                .filter(models.Log.tid.in_(versions)).order_by(models.Log.tid):
+            page = self.pages.get(name)
+            if page is None or page.version != tid:
+                lost.append(StoredPage(name, content, tid))
+        if lost:
+            self.write(lost)
+        return len(lost)
+
+    def get(self, name: str) -> Optional[StoredPage]:
+        """
+        :param name: The name of the page.
+        :return: The page, None if it does not exist.
+        """
+        return self.pages.get(name)
+
+    def list_names(self, prefix: str, after: Optional[str], limit: int) -> List[str]:
+        """
+        :param prefix: Only list the pages whose name starts with the prefix.
+        :param after: The last name of the previous page of the listing, None for the first page.
+        :param limit: The most names to return.
+        :return: The page names in name order.
+        """
+        with self.lock:
+            start = bisect_left(self.names, prefix)
+            if after is not None:
+                start = max(start, bisect_right(self.names, after))
+            names = self.names[start:start + limit]
+        if prefix:
+            names = [name for name in names if name.startswith(prefix)]
+        return names
+
+    def search_names(self, query: str, offset: int, limit: Optional[int]) -> List[str]:
+        """
+        :param query: The text to look for in page names, ignoring case like the LIKE of SQLite.
+        :param offset: How many of the matching pages to skip, in name order.
+        :param limit: The most pages to return, None for all of them.
+        :return: The names of the pages with the text in their name.
+        """
+        query = query.lower()
+        with self.lock:
+            matches = [name for name in self.names if query in name.lower()]
+        return matches[offset:None if limit is None else offset + limit]
+
+    def close(self):
+        """
+        Close the segment file.
+        :return: None
+        """
+        self.file.close()
+
+    def stats(self) -> dict:
+        """
+        :return: How many pages the store holds and how many records it has written.
+        """
+        return {'engine': 'memory', 'pages': len(self.pages), 'writes': self.writes,
+                'segment_records': self.records_since_snapshot, 'snapshots': self.snapshots}
+
+
+""" The in-memory page store of this data server, None while pages are kept in the Pages table """
+MEMORY = {'store': None}
+
+
+def memory_store() -> Optional[MemoryPageStore]:
+    """
+    :return: The in-memory page store of this data server, None while pages are kept in the Pages table.
+    """
+    return MEMORY['store']
+
+
+def create_page_store(conf: dict) -> Optional[MemoryPageStore]:
+    """
+    Create the page store selected by the optional [page_store] table of the server config, rebuilding the
+    pages from the snapshot, the segment and the log.
+    :param conf: The full server config.
+    :return: The in-memory page store, None if pages are kept in the Pages table.
+    """
+    page_store = conf.get('page_store', {})
+    if page_store.get('engine', 'sqlite') != 'memory':
+        return None
+    start = perf_counter()
+    path = page_store.get('path', f"./pages_{os.path.basename(sys.argv[1])}.seg")
+    store = MemoryPageStore(path, page_store.get('snapshot_every', 100000))
+    with SessionLocal() as db:
+        recovered = store.recover(db)
+    event.listen(SessionLocal, 'after_commit', store.committed)
+    event.listen(SessionLocal, 'after_rollback', store.rolled_back)
+    MEMORY['store'] = store
+    print(f'Loaded {len(store.pages)} pages from {store.loaded} snapshot and {store.replayed} segment records, '
+          f'{recovered} from the log, in {perf_counter() - start:.2f} s')
+    return store
@@ -21,10 +21,12 @@ class RequestPageCommit(BaseModel):
     JSON message from the data server to the coordinator indicating
     that they want the coordinator to update the page to have the given data.
     page = the name fo the page to edit or create
-    content = the content to display on the page
+    content = the content to display on the page, or a delta against the base version
+    base = the tid of the version of the page the delta applies to, None if content is the full content
     """
     page: str
     content: str
+    base: Optional[int] = None
 
 
 class RequestUserCommit(BaseModel):
@@ -45,11 +47,13 @@ class PageCommit(BaseModel):
     (1st step in 2PC).
     transaction_id = the id of the transaction
     name = the name of the page to update or create
-    content = the data displayed on the page
+    content = the data displayed on the page, or a delta against the base version
+    base = the tid of the version of the page the delta applies to, None if content is the full content
     """
     transaction_id: int
     page: str
     content: str
+    base: Optional[int] = None
 
 
 class UserCommit(BaseModel):
@@ -73,10 +77,12 @@ class CommitReply(BaseModel):
     transaction_id = the id of the transaction to commit or abort
     sender = the ip of the data server
     commit = if the data server is willing to commit or if it will abort
+    stale_base = if the data server refused a delta because it is not at the version the delta applies to
     """
     transaction_id: int
     sender: str
     commit: bool
+    stale_base: bool = False
 
 
 class DoCommit(BaseModel):
@@ -98,10 +104,87 @@ class HaveCommit(BaseModel):
     transaction_id = the id of the transaction to commit
     sender = the ip of the data server
     commit = if the server commit or not
+    stale_base = if the data server refused a delta because it is not at the version the delta applies to
     """
     transaction_id: int
     sender: str
     commit: bool
+    stale_base: bool = False
+
+
+class PageCommitBatch(BaseModel):
+    """
+    JSON message sent from the coordinator to the data server asking it to
+    promise a whole batch of page commits at once (1st step in 2PC).
+    commits = the page commits in the batch
+    """
+    commits: List[PageCommit]
+
+
+class CommitReplyBatch(BaseModel):
+    """
+    JSON message sent from the data server to the coordinator with its vote
+    for every commit of a batch (2nd step in 2PC).
+    sender = the ip of the data server
+    replies = the vote for each commit, in the order of the batch
+    """
+    sender: str
+    replies: List[CommitReply]
+
+
+class DoCommitBatch(BaseModel):
+    """
+    JSON message sent from the coordinator to the data server with the
+    decision for every commit of a batch (3rd step in 2PC).
+    commits = the decision for each commit
+    """
+    commits: List[DoCommit]
+
+
+class HaveCommitBatch(BaseModel):
+    """
+    JSON message sent from the data server to the coordinator indicating
+    which commits of a batch it has applied (4th step in 2PC).
+    sender = the ip of the data server
+    replies = the outcome for each commit, in the order of the batch
+    """
+    sender: str
+    replies: List[HaveCommit]
+
+
+class Inquiry(BaseModel):
+    """
+    JSON message sent from a data server to the coordinator asking for the decision on transactions it
+    promised long ago without hearing back.
+    sender = the ip of the data server
+    transaction_ids = the ids of the transactions
+    """
+    sender: str
+    transaction_ids: List[int]
+
+
+class MaxTid(BaseModel):
+    """
+    JSON message sent from a data server to a starting coordinator with the highest tid it has seen, so that
+    a coordinator whose shard changed never hands out tids below the versions of the pages it now owns.
+    sender = the ip of the data server
+    transaction_id = the highest tid in the log of the data server, 0 if it is empty
+    """
+    sender: str
+    transaction_id: int
+
+
+class PageCommitResult(BaseModel):
+    """
+    JSON message sent from the coordinator to the data server once a
+    requested page commit has been committed.
+    transaction_id = the id of the transaction whose content is now on the page
+    page = the name of the page
+    coalesced = if the requested content was folded into a later edit of the page whose content won
+    """
+    transaction_id: int
+    page: str
+    coalesced: bool
 
 
 @dataclass
@@ -111,3 +194,20 @@ class Page:
     """
     name: str
     content: str
+
+
+class EditStatus(BaseModel):
+    """
+    JSON message sent from a data server to the browser with the status of an edit submitted without waiting
+    for its commit.
+    handle = the id of the edit
+    page = the name of the edited page
+    status = pending, committed or aborted
+    transaction_id = the tid of the transaction whose content is now on the page, None until committed
+    coalesced = if the content was folded into a later edit of the page whose content won
+    """
+    handle: str
+    page: str
+    status: str
+    transaction_id: Optional[int]
+    coalesced: bool
@@ -0,0 +1,87 @@
+"""
+Full-text search over the pages of a data server.
+Page names and contents are indexed in an SQLite FTS5 table. Triggers on the Pages table keep it up to date, so
+a page commit is indexed in the same db transaction that applies it, whichever way the commit arrives. Without
+FTS5 support in the SQLite library, search falls back to matching page names.
+"""
+
+import re
+from typing import List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+SEARCH_TABLE = 'PagesSearch'
+
+# how much more a match in the page name counts than a match in the content
+NAME_WEIGHT = 10.0
+
+SCHEMA = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE}
+        USING fts5(name, content, content='Pages', content_rowid='id')""",
+    f"""CREATE TRIGGER IF NOT EXISTS PagesSearchInsert AFTER INSERT ON Pages BEGIN
+            INSERT INTO {SEARCH_TABLE}(rowid, name, content) VALUES (new.id, new.name, new.content);
+        END""",
+    f"""CREATE TRIGGER IF NOT EXISTS PagesSearchDelete AFTER DELETE ON Pages BEGIN
+            INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, name, content)
+                VALUES ('delete', old.id, old.name, old.content);
+        END""",
+    f"""CREATE TRIGGER IF NOT EXISTS PagesSearchUpdate AFTER UPDATE OF name, content ON Pages BEGIN
+            INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, name, content)
+                VALUES ('delete', old.id, old.name, old.content);
+            INSERT INTO {SEARCH_TABLE}(rowid, name, content) VALUES (new.id, new.name, new.content);
+        END""",
+]
+
+
+def create_search_index(engine: Engine) -> bool:
+    """
+    Create the search index and its triggers if the db does not have them yet, indexing the existing pages.
+    :param engine: The db engine, after the Pages table has been created.
+    :return: If full-text search is available.
+    """
+    try:
+        with engine.begin() as conn:
+            exists = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = :name"),
+                                  {'name': SEARCH_TABLE}).first() is not None
+            for statement in SCHEMA:
+                conn.execute(text(statement))
+            if not exists:
+                conn.execute(text(f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) VALUES ('rebuild')"))
+    except OperationalError as e:
+        print('Full-text search is not available, searching page names only:', repr(e))
+        return False
+    return True
+
+
+def match_expression(query: str) -> Optional[str]:
+    """
+    Turn a user's search query into an FTS5 query matching pages that contain every word of it. The last word
+    also matches as a prefix, so results show up while a word is still being typed.
+    :param query: The search query as typed by the user.
+    :return: The FTS5 query, None if the query has no words.
+    """
+    words = re.findall(r'\w+', query)
+    if not words:
+        return None
+    return ' '.join(f'"{word}"' for word in words) + '*'
+
+
+def search_pages(db: Session, query: str, offset: int, limit: int) -> List[str]:
+    """
+    Search the pages by name and content, best matches first. Matches in the name rank higher.
+    :param db: The db session to use.
+    :param query: The search query as typed by the user.
+    :param offset: How many of the best matches to skip.
+    :param limit: The most matches to return.
+    :return: The names of the matching pages.
+    """
+    expression = match_expression(query)
+    if expression is None:
+        return []
+    rows = db.execute(text(f"SELECT name FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH :expression "
+                           f"ORDER BY bm25({SEARCH_TABLE}, {NAME_WEIGHT}, 1.0) LIMIT :limit OFFSET :offset"),
+                      {'expression': expression, 'limit': limit, 'offset': offset})
+    return [name for name, in rows]
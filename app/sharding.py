@@ -0,0 +1,53 @@
+"""
+Sharding of the 2PC across several coordinators.
+Each coordinator owns a hash partition of the page and user names and only runs transactions for the names it
+owns, so writes to different partitions are coordinated in parallel. Every coordinator hands out tids from its
+own stripe of the tid space so that tids stay unique on the data servers.
+"""
+
+from typing import List
+from zlib import crc32
+
+
+def coordinators(conf: dict) -> List[str]:
+    """
+    :param conf: The full server config.
+    :return: The IPs of the coordinators, in shard order. A config with a single coordinator has one shard.
+    """
+    return conf.get('coordinators') or [conf['coordinator']]
+
+
+def shard_of(name: str, shards: int) -> int:
+    """
+    :param name: The name of a page or user.
+    :param shards: The number of shards.
+    :return: The shard that owns the name. The hash is stable across processes and restarts.
+    """
+    return crc32(name.encode('utf-8')) % shards
+
+
+def coordinator_for(coordinator_ips: List[str], name: str) -> str:
+    """
+    :param coordinator_ips: The IPs of the coordinators, in shard order.
+    :param name: The name of a page or user.
+    :return: The IP of the coordinator owning the name.
+    """
+    return coordinator_ips[shard_of(name, len(coordinator_ips))]
+
+
+def next_in_stripe(tid: int, shard: int, shards: int) -> int:
+    """
+    :param tid: A tid.
+    :param shard: The shard whose stripe to use.
+    :param shards: The number of shards.
+    :return: The smallest tid of the shard's stripe that is not below the given tid.
+    """
+    return tid + (shard - tid) % shards
+
+
+def this_shard(conf: dict) -> int:
+    """
+    :param conf: The full config of a coordinator.
+    :return: The shard the coordinator owns, its position in the list of coordinators.
+    """
+    return coordinators(conf).index(conf['this_ip'])
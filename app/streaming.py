@@ -0,0 +1,111 @@
+"""
+Streaming of very large pages through a data server.
+Starlette's form parser builds a field value by concatenating bytes, which copies a large page over and over
+while it is uploaded. The edit form is parsed here straight from the request stream, percent-decoding each
+chunk as it arrives. Large pages are also sent to the browser in chunks, escaping one chunk at a time, instead
+of rendering the whole page into a string and then into bytes.
+"""
+
+import uuid
+from typing import Dict, Iterator, Optional
+from urllib.parse import unquote_to_bytes
+
+import multipart
+from jinja2 import Template
+from markupsafe import escape
+from starlette.requests import Request
+
+""" Characters of a page sent to the browser at once """
+CHUNK_SIZE = 65536
+
+
+class _Field:
+    """
+    A form field being decoded.
+    name = the percent-decoded name
+    value = the percent-decoded value
+    pending = the end of the last piece of the value, holding a percent escape that is cut off
+    """
+
+    def __init__(self):
+        self.name = bytearray()
+        self.value = bytearray()
+        self.pending = b''
+
+
+def _decode_piece(piece: bytes) -> bytes:
+    """
+    :param piece: Part of a urlencoded value, without cut off percent escapes.
+    :return: The decoded bytes.
+    """
+    return unquote_to_bytes(piece.replace(b'+', b' '))
+
+
+async def read_form(request: Request) -> Dict[str, str]:
+    """
+    Parse a urlencoded form from the request stream. Memory use is about the decoded size of the form.
+    :param request: The request with a form body.
+    :return: The form fields, the last value of each name.
+    """
+    fields = []
+
+    def on_field_start():
+        fields.append(_Field())
+
+    def on_field_name(data: bytes, start: int, end: int):
+        fields[-1].name += data[start:end]
+
+    def on_field_data(data: bytes, start: int, end: int):
+        field = fields[-1]
+        piece = field.pending + data[start:end]
+        escape_start = piece.rfind(b'%', max(0, len(piece) - 2))
+        cut = len(piece) if escape_start == -1 else escape_start
+        field.pending = piece[cut:]
+        field.value += _decode_piece(piece[:cut])
+
+    def on_field_end():
+        field = fields[-1]
+        field.value += _decode_piece(field.pending)
+        field.pending = b''
+
+    parser = multipart.QuerystringParser({'on_field_start': on_field_start, 'on_field_name': on_field_name,
+                                          'on_field_data': on_field_data, 'on_field_end': on_field_end})
+    async for chunk in request.stream():
+        if chunk:
+            parser.write(chunk)
+    parser.finalize()
+    form = {}
+    while fields:
+        # the decoded bytes of each field are freed as soon as its string is made
+        field = fields.pop(0)
+        form[_decode_piece(bytes(field.name)).decode('utf-8')] = field.value.decode('utf-8')
+    return form
+
+
+def stream_template(template: Template, context: dict, field: str) -> Iterator[bytes]:
+    """
+    Render a template around one large value of its context, sending the value in escaped chunks.
+    :param template: The template, which must show the value exactly once.
+    :param context: The template context, with the request.
+    :param field: The name of the large value in the context.
+    :return: The rendered page, as chunks of bytes.
+    """
+    marker = f'streamed{uuid.uuid4().hex}'
+    head, tail = template.render({**context, field: marker}).split(marker)
+    value = context[field]
+    yield head.encode('utf-8')
+    for start in range(0, len(value), CHUNK_SIZE):
+        yield str(escape(value[start:start + CHUNK_SIZE])).encode('utf-8')
+    yield tail.encode('utf-8')
+
+
+def create_streaming(conf: dict) -> Optional[int]:
+    """
+    Read the optional [streaming] table of the server config.
+    :param conf: The full server config.
+    :return: The page size in characters from which pages are sent in chunks, None if they never are.
+    """
+    streaming = conf.get('streaming', {})
+    if not streaming.get('enabled', False):
+        return None
+    return streaming.get('threshold', 1024 * 1024)
@@ -0,0 +1,500 @@
+"""
+Transaction logs recording the coordinator's side of the 2PC.
+The log is what lets the coordinator finish the transactions it had in flight after a restart.
+"""
+
+import asyncio
+import json
+import os
+import sys
+from contextlib import contextmanager
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+
+from app import crud
+
+from .database import SessionLocal, run_db
+from .sharding import coordinators, next_in_stripe, this_shard
+
+
+class SqlTransactionLog:
+    """
+    Keeps the coordinator's transaction state in the Log and PendingCommits tables of the db.
+    Every phase is committed to the db in a single db transaction, with one statement per table, before the 2PC
+    moves on.
+    presumed_abort = if aborts are left out of the log, an unfinished transaction is presumed aborted
+    shard = the shard of this coordinator, whose stripe of tids it hands out
+    shards = the number of coordinator shards
+    floor = the highest tid seen on the data servers, new tids are above it
+    """
+
+    def __init__(self, presumed_abort: bool, shard: int = 0, shards: int = 1):
+        self.presumed_abort = presumed_abort
+        self.shard = shard
+        self.shards = shards
+        self.floor = 0
+        self.writes = 0
+        self.statements = 0
+        self.syncs = 0
+
+    @contextmanager
+    def session(self):
+        """
+        :return: A db session that is closed when the block ends.
+        """
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def _commit(self, log_statuses: Dict[int, str], pending_statuses: Dict[Tuple[int, str], str]):
+        """
+        Update the statuses of transactions in the log and of their pending commits on the data servers,
+        in a single db transaction.
+        :param log_statuses: The new status of transactions in the Log table, by tid.
+        :param pending_statuses: The new status of pending commits in the PendingCommits table, by tid and
+                                 data server.
+        :return: None
+        """
+        if not log_statuses and not pending_statuses:
+            return
+        with self.session() as db:
+            crud.update_statuses_in_log(db, log_statuses)
+            crud.update_statuses_in_pending(db, pending_statuses)
+            db.commit()
+        self.writes += len(log_statuses) + len(pending_statuses)
+        self.statements += bool(log_statuses) + bool(pending_statuses)
+        self.syncs += 1
+
+    async def begin(self, entries: List[dict], data_servers: List[str]) -> List[int]:
+        """
+        Log new transactions before asking the data servers to promise them.
+        :param entries: The commits, as dicts with the type, name, content, admin and base of each commit.
+        :param data_servers: The data servers participating in the 2PC.
+        :return: The tids of the new transactions, in the order of the entries.
+        """
+        return await run_db(self._begin, entries, data_servers, write=True)
+
+    def _begin(self, entries: List[dict], data_servers: List[str]) -> List[int]:
+        """
+        Log new transactions and their pending commits in a single db transaction.
+        :param entries: The commits, as dicts with the type, name, content, admin and base of each commit.
+        :param data_servers: The data servers participating in the 2PC.
+        :return: The tids of the new transactions, in the order of the entries.
+        """
+        with self.session() as db:
+            tids = crud.new_commits_to_log(db, entries, self.shard, self.shards, self.floor)
+            crud.new_commits_to_pending(db, tids, data_servers, 'requested')
+            db.commit()
+        self.writes += len(tids) * (1 + len(data_servers))
+        self.statements += 2
+        self.syncs += 1
+        return tids
+
+    def raise_floor(self, tid: int):
+        """
+        Hand out only tids above one seen elsewhere, e.g. on the data servers by another coordinator.
+        :param tid: The tid.
+        :return: None
+        """
+        self.floor = max(self.floor, tid)
+
+    async def voted(self, votes: Dict[str, Dict[int, bool]]):
+        """
+        Log the votes of the data servers.
+        :param votes: For each data server, whether it promised to commit each tid. A tid the data server did not
+                      vote for counts as refused.
+        :return: None
+        """
+        statuses = {(tid, server_ip): 'promised' if promised else 'aborted'
+                    for server_ip, server_votes in votes.items() for tid, promised in server_votes.items()
+                    if promised or not self.presumed_abort}
+        await run_db(self._commit, {}, statuses, write=True)
+
+    async def decided(self, committed: List[int], aborted: List[int], data_servers: List[str], force: bool = True):
+        """
+        Log the coordinator's decision before sending it to the data servers.
+        :param committed: The tids decided to commit.
+        :param aborted: The tids decided to abort.
+        :param data_servers: The data servers participating in the 2PC.
+        :param force: Ignored, every db commit is synchronous.
+        :return: None
+        """
+        if self.presumed_abort:
+            aborted = []
+        pending = {**{tid: 'started' for tid in committed}, **{tid: 'aborting' for tid in aborted}}
+        statuses = {**{tid: 'promised' for tid in committed}, **{tid: 'aborted' for tid in aborted}}
+        await run_db(self._commit, statuses,
+                     {(tid, server_ip): status for tid, status in pending.items() for server_ip in data_servers},
+                     write=True)
+
+    async def acknowledged(self, server_ips: List[str], committed: List[int], aborted: List[int]):
+        """
+        Log that some data servers have applied the decision for some transactions.
+        :param server_ips: The data servers that acknowledged the decision.
+        :param committed: The acknowledged tids that were committed.
+        :param aborted: The acknowledged tids that were aborted.
+        :return: None
+        """
+        tids = committed if self.presumed_abort else committed + aborted
+        await run_db(self._commit, {}, {(tid, server_ip): 'done' for tid in tids for server_ip in server_ips},
+                     write=True)
+
+    async def finished(self, committed: List[int], aborted: List[int]):
+        """
+        Log that every data server has applied the decision for some transactions.
+        :param committed: The finished tids that were committed.
+        :param aborted: The finished tids that were aborted.
+        :return: None
+        """
+        if not self.presumed_abort:
+            aborted = []  # already marked when the abort was decided
+        statuses = {**{tid: 'done' for tid in committed}, **{tid: 'aborted' for tid in aborted}}
+        await run_db(self._commit, statuses, {}, write=True)
+
+    async def unfinished(self) -> Dict[int, Optional[bool]]:
+        """
+        :return: The decision for each transaction that was not finished, None if it was never decided.
+        """
+        statuses = await run_db(self._unfinished)
+        return {tid: {'pending': None, 'promised': True, 'aborted': False}[status]
+                for tid, status in statuses.items()}
+
+    def _unfinished(self) -> Dict[int, str]:
+        """
+        :return: The status in the Log table of each transaction that was not finished.
+        """
+        with self.session() as db:
+            return crud.unfinished_in_log(db)
+
+    async def close(self):
+        """
+        Release the log on shutdown.
+        :return: None
+        """
+
+    def stats(self) -> dict:
+        """
+        :return: How many rows, statements and synchronous db commits the log has written.
+        """
+        return {'kind': 'sqlite', 'presumed_abort': self.presumed_abort, 'writes': self.writes,
+                'statements': self.statements, 'syncs': self.syncs}
+
+
+class WalTransactionLog:
+    """
+    Keeps the coordinator's transaction state in an append-only write-ahead log file.
+    Records are JSON lines. Records appended by concurrent transactions while an fsync is running
+    are made durable together by the next fsync. Finished transactions are periodically checkpointed
+    into the Log table of the db, and the file is rewritten to hold only the transactions still in flight.
+    path = the log file
+    checkpoint_every = how many records may be appended before the log is checkpointed
+    presumed_abort = if starts and aborts are not forced, an unfinished transaction is presumed aborted
+    shard = the shard of this coordinator, whose stripe of tids it hands out
+    shards = the number of coordinator shards
+    entries = the transactions in flight, by tid
+    to_checkpoint = the transactions finished since the last checkpoint, to be written to the Log table
+    """
+
+    def __init__(self, path: str, checkpoint_every: int, presumed_abort: bool, shard: int = 0, shards: int = 1):
+        self.path = path
+        self.checkpoint_every = checkpoint_every
+        self.presumed_abort = presumed_abort
+        self.shard = shard
+        self.shards = shards
+        self.entries: Dict[int, dict] = {}
+        self.to_checkpoint: List[dict] = []
+        self.next_tid = 1
+        self.buffer: List[bytes] = []
+        self.waiters: List[asyncio.Future] = []
+        self.flusher = None
+        self.records_since_checkpoint = 0
+        self.writes = 0
+        self.syncs = 0
+        self._replay()
+        with SessionLocal() as db:
+            self.next_tid = next_in_stripe(max(self.next_tid, crud.max_tid(db) + 1), shard, shards)
+        self.file = open(self.path, 'ab')
+
+    def _replay(self):
+        """
+        Rebuild the in-flight transactions from the log file. A record torn by a crash at the end of the file
+        is cut off.
+        :return: None
+        """
+        if not os.path.exists(self.path):
+            return
+        good = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                self._apply(record)
+                good += len(line)
+                self.records_since_checkpoint += 1
+        if good != os.path.getsize(self.path):
+            print('Cutting off torn write-ahead log tail at', good)
+            os.truncate(self.path, good)
+
+    def _apply(self, record: dict):
+        """
+        Apply a log record to the in-flight transactions.
+        :param record: The record to apply.
+        :return: None
+        """
+        op = record['op']
+        tid = record['tid']
+        if op == 'begin':
+            self.entries[tid] = {'tid': tid, 'type': record['type'], 'name': record['name'],
+                                 'content': record['content'], 'admin': record['admin'],
+                                 'base': record.get('base'), 'decision': None}
+            self.next_tid = max(self.next_tid, tid + 1)
+        elif op in ('commit', 'abort'):
+            if tid in self.entries:
+                self.entries[tid]['decision'] = op == 'commit'
+        elif op == 'end':
+            entry = self.entries.pop(tid, None)
+            if entry is not None:
+                self.to_checkpoint.append(self._projection(entry))
+        elif op == 'next_tid':
+            self.next_tid = max(self.next_tid, tid)
+
+    @staticmethod
+    def _projection(entry: dict) -> dict:
+        """
+        :param entry: A finished transaction.
+        :return: The row of the Log table for the transaction.
+        """
+        return {'tid': entry['tid'], 'type': entry['type'], 'status': 'done' if entry['decision'] else 'aborted',
+                'name': entry['name'], 'content': entry['content'], 'admin': entry['admin'], 'base': entry['base']}
+
+    def _state_records(self) -> List[dict]:
+        """
+        :return: The records that rebuild the current in-flight transactions.
+        """
+        records = [{'op': 'next_tid', 'tid': self.next_tid}]
+        for entry in self.entries.values():
+            records.append({'op': 'begin', 'tid': entry['tid'], 'type': entry['type'], 'name': entry['name'],
+                            'content': entry['content'], 'admin': entry['admin'], 'base': entry['base']})
+            if entry['decision'] is not None:
+                records.append({'op': 'commit' if entry['decision'] else 'abort', 'tid': entry['tid']})
+        return records
+
+    @staticmethod
+    def _encode(records: List[dict]) -> bytes:
+        """
+        :param records: The records to encode.
+        :return: The records as JSON lines.
+        """
+        return b''.join(json.dumps(record, separators=(',', ':')).encode() + b'\n' for record in records)
+
+    async def _append(self, records: List[dict], force: bool):
+        """
+        Append records to the log.
+        :param records: The records to append.
+        :param force: If the records have to be durable before returning. Records that are not forced are
+                      written together with the next forced records.
+        :return: None
+        """
+        for record in records:
+            self._apply(record)
+        self.buffer.append(self._encode(records))
+        self.records_since_checkpoint += len(records)
+        self.writes += len(records)
+        if not force:
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append(future)
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.ensure_future(self._flush())
+        await future
+
+    async def _flush(self):
+        """
+        Make the buffered records durable, one fsync for every record appended since the last fsync started.
+        :return: None
+        """
+        loop = asyncio.get_running_loop()
+        while self.waiters:
+            waiters, self.waiters = self.waiters, []
+            finished = []
+            buffered, since_checkpoint = self.buffer, self.records_since_checkpoint
+            if self.records_since_checkpoint >= self.checkpoint_every:
+                # the checkpoint holds the effect of every buffered record
+                finished, self.to_checkpoint = self.to_checkpoint, []
+                records = self._state_records()
+                self.buffer = []
+                self.records_since_checkpoint = len(records)
+                job = partial(self._checkpoint, self._encode(records), len(finished))
+            else:
+                data, self.buffer = b''.join(self.buffer), []
+                job = partial(self._write, data)
+            try:
+                if finished:
+                    # the finished transactions must be in the Log table before the log file drops them
+                    await run_db(self._project, finished, write=True)
+                await loop.run_in_executor(None, job)
+            except Exception as e:
+                if finished:
+                    # keep the finished transactions for the next checkpoint, and the buffered records for the
+                    # next write, replaying them again on top of a checkpoint that did replace the file is harmless
+                    self.to_checkpoint = finished + self.to_checkpoint
+                    self.buffer = buffered + self.buffer
+                    self.records_since_checkpoint += since_checkpoint - len(records)
+                for waiter in waiters:
+                    waiter.set_exception(e)
+                continue
+            self.syncs += 1
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    def _write(self, data: bytes):
+        """
+        Append data to the log file and fsync it.
+        :param data: The encoded records.
+        :return: None
+        """
+        self.file.write(data)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    @staticmethod
+    def _project(finished: List[dict]):
+        """
+        Write finished transactions to the Log table.
+        :param finished: The Log table rows of the finished transactions.
+        :return: None
+        """
+        with SessionLocal() as db:
+            crud.project_to_log(db, finished)
+
+    def _checkpoint(self, data: bytes, finished: int):
+        """
+        Replace the log file with one holding only the transactions in flight, once the finished transactions
+        are in the Log table.
+        :param data: The encoded records rebuilding the transactions in flight.
+        :param finished: How many finished transactions were written to the Log table.
+        :return: None
+        """
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self.file.close()
+        os.replace(tmp_path, self.path)
+        self.file = open(self.path, 'ab')
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        print('Checkpointed', finished, 'transactions,', len(self.entries), 'in flight')
+
+    async def begin(self, entries: List[dict], data_servers: List[str]) -> List[int]:
+        """
+        Log new transactions before asking the data servers to promise them.
+        :param entries: The commits, as dicts with the type, name, content, admin and base of each commit.
+        :param data_servers: The data servers participating in the 2PC.
+        :return: The tids of the new transactions, in the order of the entries.
+        """
+        tids = [self.next_tid + i * self.shards for i in range(len(entries))]
+        self.next_tid += len(entries) * self.shards
+        # with presumed abort the start is forced by the commit record if there is one
+        await self._append([{'op': 'begin', 'tid': tid, **entry} for tid, entry in zip(tids, entries)],
+                           force=not self.presumed_abort)
+        return tids
+
+    def raise_floor(self, tid: int):
+        """
+        Hand out only tids above one seen elsewhere, e.g. on the data servers by another coordinator.
+        :param tid: The tid.
+        :return: None
+        """
+        self.next_tid = next_in_stripe(max(self.next_tid, tid + 1), self.shard, self.shards)
+
+    async def voted(self, votes: Dict[str, Dict[int, bool]]):
+        """
+        Votes are not logged, a transaction that was never decided is aborted on recovery.
+        :param votes: For each data server, whether it promised to commit each tid.
+        :return: None
+        """
+
+    async def decided(self, committed: List[int], aborted: List[int], data_servers: List[str], force: bool = True):
+        """
+        Log the coordinator's decision before sending it to the data servers.
+        :param committed: The tids decided to commit.
+        :param aborted: The tids decided to abort.
+        :param data_servers: The data servers participating in the 2PC.
+        :param force: If the decision has to be durable before returning. Aborts are never forced with
+                      presumed abort.
+        :return: None
+        """
+        await self._append([{'op': 'abort', 'tid': tid} for tid in aborted],
+                           force=force and not self.presumed_abort and bool(aborted) and not committed)
+        await self._append([{'op': 'commit', 'tid': tid} for tid in committed], force=force and bool(committed))
+
+    async def acknowledged(self, server_ips: List[str], committed: List[int], aborted: List[int]):
+        """
+        Acknowledgements are not logged, the decision is resent to every data server on recovery.
+        :param server_ips: The data servers that acknowledged the decision.
+        :param committed: The acknowledged tids that were committed.
+        :param aborted: The acknowledged tids that were aborted.
+        :return: None
+        """
+
+    async def finished(self, committed: List[int], aborted: List[int]):
+        """
+        Log that every data server has applied the decision for some transactions. Not forced: if the record is
+        lost the decision is simply resent on recovery.
+        :param committed: The finished tids that were committed.
+        :param aborted: The finished tids that were aborted.
+        :return: None
+        """
+        await self._append([{'op': 'end', 'tid': tid} for tid in committed + aborted], force=False)
+
+    async def unfinished(self) -> Dict[int, Optional[bool]]:
+        """
+        :return: The decision for each transaction that was not finished, None if it was never decided.
+        """
+        return {tid: entry['decision'] for tid, entry in self.entries.items()}
+
+    async def close(self):
+        """
+        Write out any records that were not forced yet and close the log file.
+        :return: None
+        """
+        if self.flusher is not None:
+            await self.flusher
+        self._write(b''.join(self.buffer))
+        self.buffer = []
+        self.file.close()
+
+    def stats(self) -> dict:
+        """
+        :return: How many records and fsyncs the log has written.
+        """
+        return {'kind': 'wal', 'presumed_abort': self.presumed_abort, 'writes': self.writes, 'syncs': self.syncs,
+                'in_flight': len(self.entries)}
+
+
+def create_txlog(conf: dict):
+    """
+    Create the transaction log selected by the [wal] and [twopc] tables of the server config, handing out the
+    tids of this coordinator's shard.
+    :param conf: The full server config.
+    :return: The coordinator's transaction log.
+    """
+    wal = conf.get('wal', {})
+    presumed_abort = conf.get('twopc', {}).get('protocol', 'standard') == 'presumed_abort'
+    shard, shards = this_shard(conf), len(coordinators(conf))
+    if not wal.get('enabled', False):
+        return SqlTransactionLog(presumed_abort, shard, shards)
+    path = wal.get('path', f"./coordinator_{os.path.basename(sys.argv[1])}.wal")
+    return WalTransactionLog(path, wal.get('checkpoint_every', 10000), presumed_abort, shard, shards)
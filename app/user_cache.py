@@ -0,0 +1,122 @@
+"""
+Cache of user lookups on a data server.
+Most requests carry the user cookie and look the user up only to read the admin flag, so the flag of each user
+is kept in memory until a commit to the user is applied.
+"""
+
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from .workers import Generations
+
+
+class UserCache:
+    """
+    LRU cache of the admin flag of users, including users that do not exist.
+    max_entries = the most users kept in the cache
+    entries = the admin flag of each cached user, None for a user that does not exist, and its generation, least
+              recently used first
+    clock = counts invalidations, a user loaded by a read that started before an invalidation is not cached
+    generations = the generations of the users shared with the other workers of the data server, None with one
+    """
+
+    def __init__(self, max_entries: int, generations: Optional[Generations] = None):
+        self.max_entries = max_entries
+        self.generations = generations
+        self.entries: OrderedDict[str, Tuple[Optional[bool], int]] = OrderedDict()
+        self.clock = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _generation(self, name: str) -> int:
+        """
+        :param name: The name of the user.
+        :return: The generation of the user shared by the workers, 0 with a single worker.
+        """
+        return self.generations.get(f'user/{name}') if self.generations is not None else 0
+
+    def stamp(self, name: str) -> Tuple[int, int]:
+        """
+        Taken before a user is read from the db, to tell if a commit to it was applied meanwhile.
+        :param name: The name of the user.
+        :return: The clock of the cache and the generation of the user.
+        """
+        return self.clock, self._generation(name)
+
+    def get(self, name: str) -> Tuple[bool, Optional[bool]]:
+        """
+        :param name: The name of the user.
+        :return: If the user is cached, and if so whether the user is an admin, None if the user does not exist.
+        """
+        entry = self.entries.get(name)
+        if entry is not None and entry[1] != self._generation(name):
+            # another worker applied a commit to the user
+            del self.entries[name]
+            self.invalidations += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return False, None
+        self.entries.move_to_end(name)
+        self.hits += 1
+        return True, entry[0]
+
+    def put(self, name: str, admin: Optional[bool], stamp: Tuple[int, int]):
+        """
+        Cache the admin flag of a user, evicting the least recently used user to make room for it.
+        :param name: The name of the user.
+        :param admin: If the user is an admin, None if the user does not exist.
+        :param stamp: The stamp of the user taken before it was read from the db.
+        :return: None
+        """
+        clock, generation = stamp
+        if self.max_entries <= 0 or clock != self.clock:
+            return
+        if name not in self.entries and len(self.entries) >= self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        self.entries[name] = (admin, generation)
+
+    def invalidate(self, name: str):
+        """
+        Drop a user from the cache, called when a commit to it is applied, and from the caches of the other
+        workers.
+        :param name: The name of the user.
+        :return: None
+        """
+        self.clock += 1
+        if self.generations is not None:
+            self.generations.bump(f'user/{name}')
+        if name in self.entries:
+            del self.entries[name]
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        """
+        :return: Hit ratio and eviction statistics of the cache.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+
+def create_user_cache(conf: dict, generations: Optional[Generations] = None) -> Optional[UserCache]:
+    """
+    Create the user lookup cache from the [user_cache] table of the server config.
+    :param conf: The full server config.
+    :param generations: The generations shared by the workers of the data server, None with a single worker.
+    :return: The user cache, None if caching is disabled.
+    """
+    user_cache = conf.get('user_cache', {})
+    if not user_cache.get('enabled', False):
+        return None
+    return UserCache(user_cache.get('max_entries', 10000), generations)
@@ -0,0 +1,364 @@
+"""
+Wire encodings for the 2PC messages between the data servers and the coordinator.
+Messages are JSON by default. With the frame encoding, the page content is sent as raw UTF-8 bytes after a
+small JSON header instead of being escaped into the JSON, and it is decoded straight out of the request body.
+Message bodies above a size threshold can also be compressed with gzip, or zstd if zstandard is installed.
+"""
+
+import gzip
+import json
+import struct
+from collections import defaultdict
+from time import process_time
+from typing import Callable, Dict, Optional, Set, Tuple
+
+import httpx
+from fastapi.routing import APIRoute
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.requests import Request
+from starlette.responses import Response
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+"""
+Media type of a framed message.
+"""
+FRAME_MEDIA_TYPE = 'application/x-wiki-frame'
+
+"""
+Message fields carried as raw bytes after the header of a frame.
+"""
+BLOB_FIELDS = ('content',)
+
+"""
+Header length prefix of a frame: 4 byte big endian unsigned int.
+"""
+HEADER_LENGTH = struct.Struct('>I')
+
+"""
+Header marking a message sent by a peer, only the responses to these are compressed.
+"""
+WIRE_HEADER = 'x-wiki-wire'
+
+"""
+Compression codecs that can be used, zstd only if zstandard is installed.
+"""
+CODECS = ('gzip', 'zstd') if zstandard is not None else ('gzip',)
+
+"""
+Statistics of the compressed messages received by this server, by peer.
+"""
+RECEIVED: Dict[str, Dict[str, float]] = defaultdict(lambda: {'messages': 0, 'wire_bytes': 0, 'raw_bytes': 0,
+                                                              'cpu': 0.0})
+
+
+def _extract_blobs(message, blobs: list):
+    """
+    Replace every blob field of a message by the byte length of its value, collecting the encoded values.
+    :param message: The message, or part of it.
+    :param blobs: The encoded blob values, in the order they are found.
+    :return: The message with the blob fields replaced.
+    """
+    if isinstance(message, dict):
+        header = {}
+        for key, value in message.items():
+            if key in BLOB_FIELDS and isinstance(value, str):
+                blob = value.encode('utf-8')
+                blobs.append(blob)
+                header[key] = len(blob)
+            else:
+                header[key] = _extract_blobs(value, blobs)
+        return header
+    if isinstance(message, list):
+        return [_extract_blobs(value, blobs) for value in message]
+    return message
+
+
+def _insert_blobs(header, view: memoryview, offset: int):
+    """
+    Put the blob values back into a decoded header, in the same order they were extracted.
+    :param header: The decoded header, or part of it.
+    :param view: The frame.
+    :param offset: Where the next blob starts in the frame.
+    :return: The message with the blob fields restored, and the offset after the last blob used.
+    """
+    if isinstance(header, dict):
+        for key, value in header.items():
+            if key in BLOB_FIELDS and isinstance(value, int):
+                header[key] = str(view[offset:offset + value], 'utf-8')
+                offset += value
+            else:
+                header[key], offset = _insert_blobs(value, view, offset)
+    elif isinstance(header, list):
+        for i, value in enumerate(header):
+            header[i], offset = _insert_blobs(value, view, offset)
+    return header, offset
+
+
+def encode_frame(message: dict) -> bytes:
+    """
+    Encode a message as a frame: header length, JSON header, then the blob fields as raw UTF-8.
+    :param message: The message to encode.
+    :return: The frame.
+    """
+    blobs = []
+    header = json.dumps(_extract_blobs(message, blobs), separators=(',', ':')).encode('utf-8')
+    return b''.join([HEADER_LENGTH.pack(len(header)), header, *blobs])
+
+
+def decode_frame(frame: bytes) -> dict:
+    """
+    Decode a frame. The blob fields are decoded directly from the frame without copying them first.
+    :param frame: The frame.
+    :return: The message.
+    """
+    view = memoryview(frame)
+    (header_length,) = HEADER_LENGTH.unpack_from(view)
+    start = HEADER_LENGTH.size
+    header = json.loads(bytes(view[start:start + header_length]))
+    message, _ = _insert_blobs(header, view, start + header_length)
+    return message
+
+
+def compress(codec: str, body: bytes, level: int) -> bytes:
+    """
+    :param codec: gzip or zstd.
+    :param body: The message body.
+    :param level: The compression level.
+    :return: The compressed body.
+    """
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(body)
+    return gzip.compress(body, compresslevel=level)
+
+
+def decompress(codec: str, body: bytes) -> bytes:
+    """
+    :param codec: gzip or zstd.
+    :param body: The compressed message body.
+    :return: The message body.
+    :raises ValueError: If the codec is not available.
+    """
+    if codec not in CODECS:
+        raise ValueError(f'Unsupported content encoding {codec}')
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(body)
+    return gzip.decompress(body)
+
+
+class WireRequest(Request):
+    """
+    Request with a framed or compressed body. Route handlers see the decoded message as if it had been sent as
+    plain JSON.
+    """
+
+    @property
+    def headers(self) -> Headers:
+        if not hasattr(self, '_headers'):
+            headers = MutableHeaders(raw=list(self.scope['headers']))
+            if headers.get('content-type') == FRAME_MEDIA_TYPE:
+                headers['content-type'] = 'application/json'
+            self._headers = Headers(raw=headers.raw)
+        return self._headers
+
+    async def body(self) -> bytes:
+        if not hasattr(self, '_body'):
+            body = await super().body()
+            codec = Headers(scope=self.scope).get('content-encoding')
+            if codec is not None:
+                start = process_time()
+                self._body = decompress(codec, body)
+                received = RECEIVED[self.client.host if self.client else '']
+                received['messages'] += 1
+                received['wire_bytes'] += len(body)
+                received['raw_bytes'] += len(self._body)
+                received['cpu'] += process_time() - start
+        return self._body
+
+    async def json(self):
+        if not hasattr(self, '_json'):
+            if Headers(scope=self.scope).get('content-type') == FRAME_MEDIA_TYPE:
+                self._json = decode_frame(await self.body())
+            else:
+                self._json = json.loads(await self.body())
+        return self._json
+
+
+class WireRoute(APIRoute):
+    """
+    Route that accepts request bodies in any of the wire encodings, compressed or not.
+    """
+
+    def get_route_handler(self) -> Callable:
+        original_route_handler = super().get_route_handler()
+
+        async def wire_route_handler(request: Request) -> Response:
+            codec = request.headers.get('content-encoding')
+            if codec is not None and codec not in CODECS:
+                return Response(status_code=415)
+            if codec is not None or request.headers.get('content-type') == FRAME_MEDIA_TYPE:
+                request = WireRequest(request.scope, request.receive)
+            return await original_route_handler(request)
+
+        return wire_route_handler
+
+
+class Wire:
+    """
+    How this server sends messages to its peers, and what it has sent to each of them.
+    encoding = json or frame
+    codec = compression codec for message bodies: none, gzip or zstd
+    threshold = message bodies smaller than this many bytes are sent uncompressed
+    level = compression level
+    plain_peers = peers that could not decode a frame or a compressed body, they are sent plain JSON
+    sent = statistics of the messages sent, by peer
+    """
+
+    def __init__(self, encoding: str, codec: str, threshold: int, level: int):
+        self.encoding = encoding
+        self.codec = codec
+        self.threshold = threshold
+        self.level = level
+        self.plain_peers: Set[str] = set()
+        self.sent: Dict[str, Dict[str, float]] = defaultdict(lambda: {'messages': 0, 'compressed': 0,
+                                                                      'raw_bytes': 0, 'wire_bytes': 0,
+                                                                      'response_bytes': 0, 'cpu': 0.0})
+
+    def encode(self, message: dict) -> Tuple[bytes, dict, int]:
+        """
+        Encode a message in the configured encoding, compressing it if it is large enough.
+        :param message: The message.
+        :return: The body, the headers to send it with and the size of the body before compression.
+        """
+        if self.encoding == 'frame':
+            body, headers = encode_frame(message), {'content-type': FRAME_MEDIA_TYPE, WIRE_HEADER: '1'}
+        else:
+            body, headers = json.dumps(message).encode('utf-8'), {'content-type': 'application/json',
+                                                                  WIRE_HEADER: '1'}
+        raw_size = len(body)
+        if self.codec != 'none' and raw_size >= self.threshold:
+            body = compress(self.codec, body, self.level)
+            headers['content-encoding'] = self.codec
+        return body, headers, raw_size
+
+    async def post(self, client: httpx.AsyncClient, url: str, message: dict,
+                   timeout: Optional[float] = None) -> httpx.Response:
+        """
+        Post a message in the configured wire encoding. A peer that cannot decode a frame or a compressed body is
+        sent plain JSON from then on.
+        :param client: The HTTP client to use.
+        :param url: Where to post the message.
+        :param message: The message.
+        :param timeout: Timeout for the request, the client's default if None.
+        :return: The response.
+        """
+        kwargs = {} if timeout is None else {'timeout': timeout}
+        peer = httpx.URL(url).host
+        sent = self.sent[peer]
+        if (self.encoding != 'json' or self.codec != 'none') and peer not in self.plain_peers:
+            start = process_time()
+            body, headers, raw_size = self.encode(message)
+            sent['cpu'] += process_time() - start
+            response = await client.post(url, content=body, headers=headers, **kwargs)
+            if not undecodable(response):
+                self._record(sent, len(body), raw_size, response)
+                return response
+            print('Falling back to plain JSON messages for', peer)
+            self.plain_peers.add(peer)
+        response = await client.post(url, json=message, headers={WIRE_HEADER: '1'}, **kwargs)
+        self._record(sent, len(response.request.content), len(response.request.content), response)
+        return response
+
+    @staticmethod
+    def _record(sent: dict, wire_size: int, raw_size: int, response: httpx.Response):
+        """
+        Add a message to the statistics of its peer.
+        :param sent: The statistics of the peer.
+        :param wire_size: The size of the body sent.
+        :param raw_size: The size of the body before compression.
+        :param response: The response of the peer.
+        :return: None
+        """
+        sent['messages'] += 1
+        sent['compressed'] += wire_size != raw_size
+        sent['wire_bytes'] += wire_size
+        sent['raw_bytes'] += raw_size
+        sent['response_bytes'] += response.num_bytes_downloaded
+
+    def stats(self) -> dict:
+        """
+        :return: Statistics of the messages sent and of the compressed messages received, by peer.
+        """
+        return {
+            'encoding': self.encoding,
+            'codec': self.codec,
+            'threshold': self.threshold,
+            'level': self.level,
+            'sent': dict(self.sent),
+            'received': dict(RECEIVED),
+        }
+
+
+def undecodable(response: httpx.Response) -> bool:
+    """
+    :param response: The response of a peer to a framed or compressed message.
+    :return: If the peer could not decode the body: it refused the encoding, or reported the body as a whole as
+             invalid, rather than a field of the message.
+    """
+    if response.status_code == 415:
+        return True
+    if response.status_code != 422:
+        return False
+    try:
+        errors = response.json()['detail']
+    except (ValueError, KeyError, TypeError):
+        return False
+    return isinstance(errors, list) and any(
+        isinstance(error, dict) and (error.get('type') == 'value_error.jsondecode' or error.get('loc') == ['body'])
+        for error in errors)
+
+
+class CompressResponses:
+    """
+    ASGI middleware compressing the responses to messages from peers with gzip once the server's Wire is known,
+    if compression is enabled. Pages served to browsers are left alone. Responses always use gzip since every
+    HTTP client can decode it.
+    app = the app to wrap
+    wire = returns the server's Wire, None before startup
+    """
+
+    def __init__(self, app, wire: Callable[[], Optional[Wire]]):
+        self.app = app
+        self.wire = wire
+        self.gzip = None
+
+    async def __call__(self, scope, receive, send):
+        wire = self.wire()
+        if scope['type'] != 'http' or wire is None or wire.codec == 'none' or \
+                WIRE_HEADER not in Headers(scope=scope):
+            await self.app(scope, receive, send)
+            return
+        if self.gzip is None:
+            self.gzip = GZipMiddleware(self.app, minimum_size=wire.threshold, compresslevel=min(wire.level, 9))
+        await self.gzip(scope, receive, send)
+
+
+def create_wire(conf: dict) -> Wire:
+    """
+    Create the message sender from the [wire] and [compression] tables of the server config.
+    :param conf: The full server config.
+    :return: The message sender for this process.
+    """
+    wire = conf.get('wire', {})
+    compression = conf.get('compression', {})
+    codec = compression.get('codec', 'none')
+    if codec != 'none' and codec not in CODECS:
+        print(f'Compression codec {codec} is not available, using gzip')
+        codec = 'gzip'
+    default_level = 3 if codec == 'zstd' else 6
+    return Wire(wire.get('encoding', 'json'), codec, compression.get('threshold', 1024),
+                compression.get('level', default_level))
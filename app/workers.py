@@ -0,0 +1,113 @@
+"""
+Several worker processes serving one data server.
+Each worker has its own event loop, config and caches, and they share the db. A commit can be applied by any
+worker, so a worker that applies one bumps a generation counter of the committed page or user in a file every
+worker maps into memory, and every worker drops a cached copy whose generation has moved on. Db writes take a
+lock file shared by the workers, and the one worker holding the leader lock runs the background jobs.
+"""
+
+import fcntl
+import mmap
+import os
+import struct
+import zlib
+
+""" The leader lock file, kept open by the leader """
+LEADER = {'file': None}
+
+""" Bytes of each generation counter """
+COUNTER = struct.Struct('<Q')
+
+
+class Generations:
+    """
+    Generation counters shared by the worker processes, in a file mapped into memory.
+    Names hash to a fixed number of slots, names sharing a slot also share a counter, which only costs a cache
+    miss now and then.
+    slots = how many counters there are
+    file = the open file of counters, locked while a counter is bumped
+    map = the counters mapped into memory
+    """
+
+    def __init__(self, path: str, slots: int):
+        self.slots = slots
+        size = slots * COUNTER.size
+        self.file = open(path, 'a+b')
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self.file.fileno()).st_size < size:
+                self.file.truncate(size)
+        finally:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.map = mmap.mmap(self.file.fileno(), size)
+
+    def _offset(self, key: str) -> int:
+        """
+        :param key: The name of what is counted, e.g. page/<name>.
+        :return: Where its counter is in the file.
+        """
+        return zlib.crc32(key.encode('utf-8')) % self.slots * COUNTER.size
+
+    def get(self, key: str) -> int:
+        """
+        :param key: The name of what is counted.
+        :return: Its generation.
+        """
+        return COUNTER.unpack_from(self.map, self._offset(key))[0]
+
+    def bump(self, key: str):
+        """
+        Move on to the next generation, called once a commit to what is counted is applied.
+        :param key: The name of what is counted.
+        :return: None
+        """
+        offset = self._offset(key)
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        try:
+            COUNTER.pack_into(self.map, offset, COUNTER.unpack_from(self.map, offset)[0] + 1)
+        finally:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+
+    def close(self):
+        """
+        Unmap the counters.
+        :return: None
+        """
+        self.map.close()
+        self.file.close()
+
+
+def worker_count(conf: dict) -> int:
+    """
+    Read the number of worker processes of a data server from the optional [workers] table of the server config.
+    The memory page store and async edits keep their state in one process, so with either a data server runs
+    a single worker.
+    :param conf: The full server config.
+    :return: How many worker processes serve the data server.
+    """
+    count = conf.get('workers', {}).get('count', 1)
+    if count > 1:
+        if conf.get('page_store', {}).get('engine', 'sqlite') == 'memory':
+            print('The memory page store is kept by a single process, running one worker')
+            return 1
+        if conf.get('async_edits', {}).get('enabled', False):
+            print('Async edits are tracked by a single process, running one worker')
+            return 1
+    return max(1, count)
+
+
+def take_leadership(db_path: str) -> bool:
+    """
+    Try to become the worker running the background jobs of the data server. The lock is held until the
+    process exits.
+    :param db_path: The path of the db, the lock file is kept next to it.
+    :return: If this worker is the leader.
+    """
+    lock = open(db_path + '.leader', 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return False
+    LEADER['file'] = lock
+    return True
@@ -0,0 +1,99 @@
+"""
+Benchmark for page edits through the 2PC.
+Sends page edits to a data server from several concurrent clients, then prints the client side throughput
+and latency and the coordinator's commit statistics (commit latency and log writes per transaction). With
+async edits, the latency until an edit is accepted is printed next to the latency until it is committed.
+
+Usage: python scripts/commit_bench.py <data server ips> <coordinator ips> [edits] [clients] [pages]
+Several data servers or coordinator shards are given as comma separated IPs. Edits are spread over the data
+servers round robin. The data servers must have a user named admin, e.g. the first user created.
+"""
+
+import asyncio
+import sys
+from time import perf_counter
+from typing import Tuple
+
+import httpx
+
+
+async def edit(client: httpx.AsyncClient, server: str, page: str, content: str) -> Tuple[bool, float, float]:
+    """
+    Submit one page edit through the data server's edit form, and wait for it to commit if the data server
+    accepts it before it commits.
+    :param client: The HTTP client to use.
+    :param server: The data server IP.
+    :param page: The page to edit.
+    :param content: The new content.
+    :return: If the edit was committed, the seconds until it was accepted and the seconds until it committed.
+    """
+    start = perf_counter()
+    response = await client.post(f'http://{server}:8000/edit_page', data={'name': page, 'content': content},
+                                 cookies={'user': 'admin'})
+    accepted = perf_counter() - start
+    location = response.headers.get('location', 'failed')
+    if location.startswith('/edit_pending/'):
+        handle = location[len('/edit_pending/'):]
+        status = 'pending'
+        while status == 'pending':
+            status = (await client.get(f'http://{server}:8000/edit_status/{handle}?wait=30')).json()['status']
+        return status == 'committed', accepted, perf_counter() - start
+    return 'failed' not in location, accepted, accepted
+
+
+def percentiles(latencies: list) -> str:
+    """
+    :param latencies: Latencies in seconds.
+    :return: The median and p99 in milliseconds.
+    """
+    latencies = sorted(latencies)
+    return f'{latencies[len(latencies) // 2] * 1000:.1f} / {latencies[len(latencies) * 99 // 100] * 1000:.1f} ms'
+
+
+async def run(servers: str, coordinators: str, edits: int = 200, clients: int = 4, pages: int = 16):
+    """
+    Run the benchmark and print the results.
+    :param servers: The data server IPs, comma separated.
+    :param coordinators: The coordinator IPs, comma separated.
+    :param edits: How many edits to send.
+    :param clients: How many edits are in flight at once.
+    :param pages: How many distinct pages the edits are spread over.
+    :return: None
+    """
+    server_ips = servers.split(',')
+    queue = list(range(edits))
+    failed = 0
+    accepted = {server: [] for server in server_ips}
+    committed = {server: [] for server in server_ips}
+
+    async def worker(client: httpx.AsyncClient):
+        nonlocal failed
+        while queue:
+            i = queue.pop()
+            server = server_ips[i % len(server_ips)]
+            ok, accept_latency, commit_latency = await edit(client, server, f'bench{i % pages}', f'content {i}')
+            if not ok:
+                failed += 1
+            accepted[server].append(accept_latency)
+            committed[server].append(commit_latency)
+
+    async with httpx.AsyncClient(timeout=30) as client:
+        start = perf_counter()
+        await asyncio.gather(*[worker(client) for _ in range(clients)])
+        elapsed = perf_counter() - start
+        stats = [(await client.get(f'http://{coordinator}:8000/commit_stats')).json()
+                 for coordinator in coordinators.split(',')]
+    print(f'{edits / elapsed:.2f} req/s')
+    print(f'{failed}/{edits} failed')
+    for server in server_ips:
+        print(f'data server {server} median / p99 latency, accepted: {percentiles(accepted[server])}, '
+              f'committed: {percentiles(committed[server])}')
+    for coordinator, coordinator_stats in zip(coordinators.split(','), stats):
+        print(f'coordinator {coordinator}')
+        for key, value in coordinator_stats.items():
+            print(f'  {key}: {value}')
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    asyncio.run(run(args[0], args[1], *[int(arg) for arg in args[2:]]))
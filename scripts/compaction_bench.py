@@ -0,0 +1,85 @@
+"""
+Benchmark for log compaction.
+Fills a data server's log on a scratch db the way the 2PC does, a round of transactions at a time, and after each
+round prints the size of the log and of the db file, and how long log lookups take. Run it with and without
+compaction to compare.
+
+Usage: python scripts/compaction_bench.py <scratch db path> [rounds] [transactions per round] [horizon]
+A horizon of 0 disables compaction.
+"""
+
+import os
+import random
+import sys
+from time import perf_counter
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app import crud, models
+from app.database import set_sqlite_pragmas
+from app.schemas import DoCommit, PageCommit
+
+PAGES = 200
+LOOKUPS = 200
+
+
+def lookup_latency(db, newest: int) -> float:
+    """
+    :param db: The db session to use.
+    :param newest: The newest tid in the log.
+    :return: The average time in microseconds of a tid lookup, an open transaction check and a page version.
+    """
+    rng = random.Random(newest)
+    start = perf_counter()
+    for _ in range(LOOKUPS):
+        crud.tid_in_log(db, rng.randint(1, newest))
+        crud.log_has_open_tranaction(db, 'page', f'page{rng.randrange(PAGES)}')
+        crud.page_version(db, f'page{rng.randrange(PAGES)}')
+    return (perf_counter() - start) / LOOKUPS * 1e6
+
+
+def main():
+    path = sys.argv[1]
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    per_round = int(sys.argv[3]) if len(sys.argv) > 3 else 2000
+    horizon = int(sys.argv[4]) if len(sys.argv) > 4 else 1000
+    if os.path.exists(path):
+        os.remove(path)
+    engine = create_engine(f'sqlite:///{path}')
+    event.listen(engine, 'connect', set_sqlite_pragmas)
+    models.Base.metadata.create_all(bind=engine)
+    session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    rng = random.Random(0)
+    tid = 0
+    print(f'{"round":>5} {"log rows":>10} {"db KB":>10} {"compact ms":>10} {"lookup us":>10}')
+    for r in range(1, rounds + 1):
+        with session() as db:
+            for _ in range(per_round // 10):
+                commits = []
+                for _ in range(10):
+                    tid += 1
+                    commits.append(PageCommit(transaction_id=tid, page=f'page{rng.randrange(PAGES)}',
+                                              content='x' * rng.randint(100, 2000)))
+                crud.promise_commits(db, commits)
+                # one in ten transactions is aborted
+                crud.apply_commits(db, [DoCommit(transaction_id=commit.transaction_id, commit=rng.random() > 0.1)
+                                        for commit in commits])
+        start = perf_counter()
+        if horizon:
+            with session() as db:
+                while crud.compact_log(db, horizon, 1000) == 1000:
+                    pass
+                crud.reclaim_space(db)
+        compact_time = (perf_counter() - start) * 1000
+        with session() as db:
+            size = crud.log_size(db)
+            latency = lookup_latency(db, tid)
+        print(f'{r:>5} {size:>10} {os.path.getsize(path) // 1024:>10} {compact_time:>10.1f} {latency:>10.1f}')
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
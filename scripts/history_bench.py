@@ -0,0 +1,98 @@
+"""
+Benchmark for the page history.
+Applies a run of small edits to a page in a scratch db, each changing a few lines, with and without the
+history, then prints the bytes stored per revision next to the size of the page, the time a commit spends
+adding its revision, and the latency of rebuilding and diffing revisions.
+
+Usage: python scripts/history_bench.py <scratch db path> [edits] [lines] [changed lines per edit] [max depth]
+"""
+
+import os
+import random
+import sys
+from time import perf_counter
+
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import sessionmaker
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app import crud, models
+from app.history import HISTORY, diff_revisions, get_revision
+
+LOOKUPS = 200
+
+
+def apply_edits(path: str, versions: list, max_depth: int) -> float:
+    """
+    Commit every version of the page in its own db transaction, the way page commits are applied.
+    :param path: The scratch db path.
+    :param versions: The content of the page after each edit.
+    :param max_depth: The most deltas between snapshots of the history, 0 keeps no history.
+    :return: The average time of a commit in milliseconds.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    engine = create_engine(f'sqlite:///{path}')
+    models.Base.metadata.create_all(bind=engine)
+    HISTORY.clear()
+    if max_depth:
+        HISTORY['max_depth'] = max_depth
+    session = sessionmaker(bind=engine)
+    start = perf_counter()
+    for tid, content in enumerate(versions, 1):
+        with session() as db:
+            crud.stage_page(db, models.Log(tid=tid, type='page', status='committed', name='page', content=content))
+            db.commit()
+    elapsed = (perf_counter() - start) / len(versions) * 1000
+    engine.dispose()
+    return elapsed
+
+
+def main():
+    path = sys.argv[1]
+    edits = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    lines = int(sys.argv[3]) if len(sys.argv) > 3 else 500
+    changed = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+    max_depth = int(sys.argv[5]) if len(sys.argv) > 5 else 50
+    rng = random.Random(0)
+    page = [f'line {i} of the page, with some more text to make it a realistic length\n' for i in range(lines)]
+    versions = []
+    for i in range(edits):
+        for _ in range(changed):
+            page[rng.randrange(lines)] = f'edit {i} changed this line of the page to something else\n'
+        versions.append(''.join(page))
+    print(f'{edits} edits of {changed} lines to a page of {lines} lines ({len(versions[-1])} bytes), '
+          f'max depth {max_depth}')
+
+    plain = apply_edits(path, versions, 0)
+    with_history = apply_edits(path, versions, max_depth)
+    print(f'commit without history: {plain:.2f} ms, with history: {with_history:.2f} ms')
+
+    engine = create_engine(f'sqlite:///{path}')
+    session = sessionmaker(bind=engine)
+    with session() as db:
+        stored = db.query(func.sum(func.length(models.Revision.content))).scalar()
+        snapshots = db.query(func.count()).filter(models.Revision.snapshot).scalar()
+        print(f'{stored / edits:.0f} bytes per revision, {snapshots} snapshots, '
+              f'{sum(len(version) for version in versions) / edits:.0f} bytes per full version')
+        numbers = [rng.randrange(1, edits + 1) for _ in range(LOOKUPS)]
+        start = perf_counter()
+        for number in numbers:
+            assert get_revision(db, 'page', number) == versions[number - 1]
+        print(f'rebuild a random revision: {(perf_counter() - start) / LOOKUPS * 1000:.2f} ms')
+        deepest = db.query(models.Revision.number).order_by(models.Revision.depth.desc()).first()[0]
+        start = perf_counter()
+        for _ in range(LOOKUPS):
+            get_revision(db, 'page', deepest)
+        print(f'rebuild the deepest revision: {(perf_counter() - start) / LOOKUPS * 1000:.2f} ms')
+        start = perf_counter()
+        for number in numbers:
+            diff_revisions(db, 'page', max(1, number - 1), number)
+        print(f'diff two revisions: {(perf_counter() - start) / LOOKUPS * 1000:.2f} ms')
+    engine.dispose()
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Benchmark for very large pages.
+Edits a page to several sizes through a data server, viewing it after each edit, and prints the latency of the
+edit and of the view with the peak memory the data server process needed on top of its memory before each
+request. Peak memory is read from /proc, so the benchmark has to run on the same Linux host as the data server
+and be allowed to reset its peak (e.g. as root).
+
+Usage: python scripts/large_page_bench.py <data server ip> <data server pid> [page sizes in MB, comma separated]
+The data server must have a user named admin, e.g. the first user created.
+"""
+
+import sys
+from time import perf_counter
+
+import httpx
+
+PAGE = 'large'
+
+
+def memory(pid: int, field: str) -> int:
+    """
+    :param pid: The process to look at.
+    :param field: VmRSS for the current memory, VmHWM for the peak.
+    :return: The memory in MB.
+    """
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) // 1024
+    raise ValueError(f'No {field} for process {pid}')
+
+
+def measure(pid: int, request) -> tuple:
+    """
+    :param pid: The data server process.
+    :param request: Sends one request and returns the response.
+    :return: The response, the latency in ms and the peak memory the request added in MB.
+    """
+    with open(f'/proc/{pid}/clear_refs', 'w') as f:
+        f.write('5')  # resets the peak to the current memory
+    before = memory(pid, 'VmRSS')
+    start = perf_counter()
+    response = request()
+    elapsed = (perf_counter() - start) * 1000
+    return response, elapsed, memory(pid, 'VmHWM') - before
+
+
+def main():
+    server = sys.argv[1]
+    pid = int(sys.argv[2])
+    sizes = [float(size) for size in sys.argv[3].split(',')] if len(sys.argv) > 3 else [1, 8, 32]
+    print(f'{"MB":>6} {"edit ms":>10} {"edit peak MB":>13} {"view ms":>10} {"view peak MB":>13}')
+    with httpx.Client(timeout=300, cookies={'user': 'admin'}) as client:
+        for size in sizes:
+            line = 'a line of a very large page, & with <markup> to escape\n'
+            content = line * int(size * 1024 * 1024 / len(line))
+            response, edit_ms, edit_peak = measure(pid, lambda: client.post(
+                f'http://{server}:8000/edit_page', data={'name': PAGE, 'content': content}))
+            assert 'failed' not in response.headers.get('location', 'failed'), response.headers
+            response, view_ms, view_peak = measure(pid, lambda: client.get(f'http://{server}:8000/page/{PAGE}'))
+            assert response.status_code == 200 and len(response.content) > len(content)
+            print(f'{size:>6} {edit_ms:>10.0f} {edit_peak:>13} {view_ms:>10.0f} {view_peak:>13}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Benchmark for the page listing.
+Fills a scratch db with pages, then prints the latency and the peak memory of listing a page of names at the
+start, middle and end of the listing and under a prefix, and of loading every page the way /pages used to.
+
+Usage: python scripts/listing_bench.py <scratch db path> [pages] [content bytes]
+"""
+
+import os
+import sys
+import tracemalloc
+from time import perf_counter
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app import crud, models
+
+BATCH = 10000
+RUNS = 20
+
+
+def measure(run, runs: int = RUNS) -> tuple:
+    """
+    :param run: Runs one listing.
+    :param runs: How many times to run it.
+    :return: The average time in milliseconds and the peak memory in KB of a run.
+    """
+    run()
+    tracemalloc.start()
+    start = perf_counter()
+    for _ in range(runs):
+        run()
+    elapsed = (perf_counter() - start) / runs * 1000
+    peak = tracemalloc.get_traced_memory()[1] // 1024
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    path = sys.argv[1]
+    pages = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+    content = 'x' * (int(sys.argv[3]) if len(sys.argv) > 3 else 200)
+    if os.path.exists(path):
+        os.remove(path)
+    engine = create_engine(f'sqlite:///{path}')
+    models.Base.metadata.create_all(bind=engine)
+    for i in range(0, pages, BATCH):
+        with engine.begin() as conn:
+            conn.execute(models.Page.__table__.insert(),
+                         [{'name': f'page{j:08d}', 'content': content, 'version': j}
+                          for j in range(i, min(i + BATCH, pages))])
+    session = sessionmaker(bind=engine)
+    print(f'{pages} pages with {len(content)} bytes of content')
+    print(f'{"listing":<22} {"ms":>10} {"peak KB":>10}')
+    with session() as db:
+        plan = db.execute(text("EXPLAIN QUERY PLAN SELECT name FROM Pages WHERE name >= 'a' AND name < 'b' "
+                               "AND name > 'a' ORDER BY name LIMIT 101")).all()
+        print('query plan:', plan[0][-1])
+        middle = f'page{pages // 2:08d}'
+        end = f'page{pages - 50:08d}'
+        for label, run in [
+            ('first page', lambda: crud.list_page_names(db, '', None, 101)),
+            ('middle page', lambda: crud.list_page_names(db, '', middle, 101)),
+            ('last page', lambda: crud.list_page_names(db, '', end, 101)),
+            ('prefix', lambda: crud.list_page_names(db, f'page{pages // 3:08d}'[:-2], None, 101)),
+        ]:
+            elapsed, peak = measure(run)
+            print(f'{label:<22} {elapsed:>10.3f} {peak:>10}')
+        if pages <= 1000000:
+            elapsed, peak = measure(lambda: [page.name for page in crud.all_pages(db)], 2)
+            print(f'{"every page (old)":<22} {elapsed:>10.3f} {peak:>10}')
+    engine.dispose()
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+Benchmark for the in-memory page store.
+Fills a scratch db and an in-memory page store with the same pages, then prints the throughput of page reads
+through the crud functions with each, how long the in-memory store takes to rebuild from its snapshot and
+segment, and the memory it holds.
+
+Usage: python scripts/page_store_bench.py <scratch dir> [pages] [content bytes]
+"""
+
+import os
+import random
+import shutil
+import sys
+import tracemalloc
+from time import perf_counter
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app import crud, models
+from app.page_store import MEMORY, MemoryPageStore, StoredPage
+
+BATCH = 10000
+READS = 20000
+# segment records on top of the snapshot when measuring the rebuild
+TAIL = 10000
+
+
+def throughput(run, names: list) -> float:
+    """
+    :param run: Runs one read of a page.
+    :param names: The pages to read.
+    :return: Reads per second.
+    """
+    start = perf_counter()
+    for name in names:
+        run(name)
+    return len(names) / (perf_counter() - start)
+
+
+def main():
+    directory = sys.argv[1]
+    pages = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    content = 'x' * (int(sys.argv[3]) if len(sys.argv) > 3 else 2000)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    rows = [{'name': f'page{i:08d}', 'content': f'{i:08d}{content[8:]}', 'version': i + 1} for i in range(pages)]
+
+    engine = create_engine(f'sqlite:///{os.path.join(directory, "pages.db")}')
+    models.Base.metadata.create_all(bind=engine)
+    for i in range(0, pages, BATCH):
+        with engine.begin() as conn:
+            conn.execute(models.Page.__table__.insert(), rows[i:i + BATCH])
+    path = os.path.join(directory, 'pages.seg')
+    store = MemoryPageStore(path, pages + TAIL + 1)
+    for i in range(0, pages, BATCH):
+        store.write([StoredPage(**row) for row in rows[i:i + BATCH]])
+    store.snapshot()
+    store.write([StoredPage(row['name'], content, row['version'] + pages) for row in rows[:TAIL]])
+    store.close()
+    print(f'{pages} pages with {len(content)} bytes of content')
+
+    rng = random.Random(0)
+    names = [rows[rng.randrange(pages)]['name'] for _ in range(READS)]
+    session = sessionmaker(bind=engine)
+    print(f'{"read":<20} {"sqlite/s":>10} {"memory/s":>10}')
+    with session() as db:
+        for label, run in [
+            ('get_page', lambda name: crud.get_page(db, name)),
+            ('page_version', lambda name: crud.page_version(db, name)),
+            ('list_page_names', lambda name: crud.list_page_names(db, '', name, 101)),
+        ]:
+            MEMORY['store'] = None
+            sqlite = throughput(run, names)
+            MEMORY['store'] = store
+            memory = throughput(run, names)
+            MEMORY['store'] = None
+            print(f'{label:<20} {sqlite:>10.0f} {memory:>10.0f}')
+    engine.dispose()
+
+    start = perf_counter()
+    rebuilt = MemoryPageStore(path, pages + TAIL + 1)
+    print(f'rebuild from {rebuilt.loaded} snapshot and {rebuilt.replayed} segment records: '
+          f'{perf_counter() - start:.2f} s')
+    rebuilt.close()
+    del rebuilt
+    tracemalloc.start()
+    rebuilt = MemoryPageStore(path, pages + TAIL + 1)
+    print(f'memory held by the store: {tracemalloc.get_traced_memory()[0] // 1024 // 1024} MB')
+    tracemalloc.stop()
+    rebuilt.close()
+    print(f'snapshot: {os.path.getsize(path + ".snapshot") // 1024 // 1024} MB, '
+          f'db: {os.path.getsize(os.path.join(directory, "pages.db")) // 1024 // 1024} MB')
+    shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Benchmark for page views on a data server.
+Views pages from several concurrent clients, then prints the client side throughput and latency, and the data
+server's page cache statistics.
+
+Usage: python scripts/read_bench.py <data server ip> [views] [clients] [pages] [edit every]
+The pages bench0..bench<pages - 1> are created first through the 2PC, so the data server must have a user
+named admin, e.g. the first user created. With edit every > 0, every that many views one of the pages is
+edited, which invalidates it in the cache.
+"""
+
+import asyncio
+import random
+import sys
+from time import perf_counter
+
+import httpx
+
+
+async def edit(client: httpx.AsyncClient, server: str, page: str, content: str) -> bool:
+    """
+    Submit one page edit through the data server's edit form.
+    :param client: The HTTP client to use.
+    :param server: The data server IP.
+    :param page: The page to edit.
+    :param content: The new content.
+    :return: If the edit was committed.
+    """
+    response = await client.post(f'http://{server}:8000/edit_page', data={'name': page, 'content': content},
+                                 cookies={'user': 'admin'})
+    return 'failed' not in response.headers.get('location', 'failed')
+
+
+async def run(server: str, views: int = 2000, clients: int = 4, pages: int = 16, edit_every: int = 0):
+    """
+    Run the benchmark and print the results.
+    :param server: The data server IP.
+    :param views: How many page views to send.
+    :param clients: How many views are in flight at once.
+    :param pages: How many distinct pages the views are spread over.
+    :param edit_every: Edit a page every that many views, 0 never edits.
+    :return: None
+    """
+    rng = random.Random(0)
+    queue = list(range(views))
+    latencies = []
+    edits = 0
+
+    async def worker(client: httpx.AsyncClient):
+        nonlocal edits
+        while queue:
+            i = queue.pop()
+            page = f'bench{rng.randrange(pages)}'
+            if edit_every and i % edit_every == 0:
+                await edit(client, server, page, f'edited {i}\n' * 100)
+                edits += 1
+            start = perf_counter()
+            response = await client.get(f'http://{server}:8000/page/{page}')
+            latencies.append(perf_counter() - start)
+            assert response.status_code == 200
+
+    async with httpx.AsyncClient(timeout=30) as client:
+        for p in range(pages):
+            await edit(client, server, f'bench{p}', f'content of page {p}\n' * 100)
+        start = perf_counter()
+        await asyncio.gather(*[worker(client) for _ in range(clients)])
+        elapsed = perf_counter() - start
+        stats = (await client.get(f'http://{server}:8000/cache_stats')).json()
+    latencies.sort()
+    print(f'{views / elapsed:.2f} views/s, {edits} edits')
+    print(f'median latency: {latencies[len(latencies) // 2] * 1000:.2f} ms, '
+          f'p99: {latencies[len(latencies) * 99 // 100] * 1000:.2f} ms')
+    print(f'page cache: {stats}')
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    asyncio.run(run(args[0], *[int(arg) for arg in args[1:]]))
@@ -0,0 +1,122 @@
+"""
+Benchmark for page search.
+Fills a scratch db with synthetic pages, then prints how long the full-text index takes to build, both
+incrementally while the pages are committed and all at once, and the latency of searches through the index
+and through LIKE on the page names and contents.
+
+Usage: python scripts/search_bench.py <scratch db path> [pages] [words per page]
+"""
+
+import os
+import random
+import sys
+from time import perf_counter
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app import crud, models
+from app.search import SEARCH_TABLE, create_search_index, search_pages
+
+VOCABULARY = 20000
+BATCH = 1000
+QUERIES = 50
+
+
+def make_pages(rng: random.Random, pages: int, words: int) -> list:
+    """
+    :param rng: The random source.
+    :param pages: How many pages to make.
+    :param words: How many words of content each page has.
+    :return: The pages as dicts with a name and content. Words are drawn with a Zipf-like distribution.
+    """
+    vocabulary = [f'w{i}' for i in range(VOCABULARY)]
+    weights = [1 / (i + 1) for i in range(VOCABULARY)]
+    return [{'name': f'page{i} {rng.choice(vocabulary)}',
+             'content': ' '.join(rng.choices(vocabulary, weights, k=words)), 'version': i + 1}
+            for i in range(pages)]
+
+
+def fill(engine, pages: list) -> float:
+    """
+    Insert the pages in db transactions of BATCH pages, like batches of page commits.
+    :param engine: The db engine.
+    :param pages: The pages to insert.
+    :return: The time it took in seconds.
+    """
+    start = perf_counter()
+    for i in range(0, len(pages), BATCH):
+        with engine.begin() as conn:
+            conn.execute(models.Page.__table__.insert(), pages[i:i + BATCH])
+    return perf_counter() - start
+
+
+def latency(run, queries: list) -> float:
+    """
+    :param run: Runs one query.
+    :param queries: The queries to run.
+    :return: The average time in milliseconds of a query.
+    """
+    start = perf_counter()
+    for query in queries:
+        run(query)
+    return (perf_counter() - start) / len(queries) * 1000
+
+
+def main():
+    path = sys.argv[1]
+    pages = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    words = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    rng = random.Random(0)
+    corpus = make_pages(rng, pages, words)
+    print(f'{pages} pages of {words} words')
+
+    # the same inserts without an index, then with the index kept up to date by its triggers
+    if os.path.exists(path):
+        os.remove(path)
+    engine = create_engine(f'sqlite:///{path}')
+    models.Base.metadata.create_all(bind=engine)
+    plain = fill(engine, corpus)
+    start = perf_counter()
+    create_search_index(engine)
+    rebuild = perf_counter() - start
+    engine.dispose()
+    os.remove(path)
+    engine = create_engine(f'sqlite:///{path}')
+    models.Base.metadata.create_all(bind=engine)
+    create_search_index(engine)
+    indexed = fill(engine, corpus)
+    print(f'insert without index: {plain:.1f} s, with index: {indexed:.1f} s '
+          f'({(indexed - plain) / pages * 1e6:.0f} us of indexing per page)')
+    print(f'index build over existing pages: {rebuild:.1f} s')
+
+    session = sessionmaker(bind=engine)
+    with session() as db:
+        start = perf_counter()
+        db.execute(text("UPDATE Pages SET content = :content WHERE id = 1"), {'content': corpus[1]['content']})
+        db.commit()
+        print(f'single page update with index: {(perf_counter() - start) * 1000:.2f} ms')
+        common = [f'w{rng.randrange(10)}' for _ in range(QUERIES)]
+        rare = [f'w{rng.randrange(5000, VOCABULARY)}' for _ in range(QUERIES)]
+        pairs = [f'w{rng.randrange(100)} w{rng.randrange(100)}' for _ in range(QUERIES)]
+        print(f'{"query":<28} {"ms":>10}')
+        for label, run, queries in [
+            ('fts common word', lambda q: search_pages(db, q, 0, 20), common),
+            ('fts common word, page 50', lambda q: search_pages(db, q, 980, 20), common),
+            ('fts rare word', lambda q: search_pages(db, q, 0, 20), rare),
+            ('fts two words', lambda q: search_pages(db, q, 0, 20), pairs),
+            ('like on name', lambda q: crud.search_page(db, q, 0, 20), rare),
+            ('like on content', lambda q: db.execute(
+                text("SELECT name FROM Pages WHERE content LIKE :q LIMIT 20"), {'q': f'%{q} %'}).all(), rare),
+        ]:
+            print(f'{label:<28} {latency(run, queries):>10.2f}')
+        size = db.execute(text(f"SELECT count(*) FROM {SEARCH_TABLE}_data")).scalar()
+    engine.dispose()
+    print(f'db size: {os.path.getsize(path) // 1024 // 1024} MB, index data blocks: {size}')
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
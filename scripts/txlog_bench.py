@@ -0,0 +1,68 @@
+"""
+Benchmark for the coordinator's SQLite transaction log.
+Runs the log through the 2PC of every transaction, with every data server voting yes and acknowledging,
+and prints the SQLite statements and commits it took per transaction, counted on the db engine.
+
+Usage: python scripts/txlog_bench.py <scratch name> [transactions] [batch] [data servers]
+The log is kept in sql_app_<scratch name>.db in the current directory, which is removed afterwards.
+"""
+
+import asyncio
+import os
+import sys
+from time import perf_counter
+
+from sqlalchemy import event
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app import models
+from app.database import engine
+from app.txlog import SqlTransactionLog
+
+
+async def run(transactions: int, batch: int, servers: int):
+    """
+    Run the benchmark and print the results.
+    :param transactions: How many transactions to log.
+    :param batch: How many transactions go through the 2PC together.
+    :param servers: How many data servers take part.
+    :return: None
+    """
+    counts = {'statements': 0, 'commits': 0}
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        if statement.split()[0].upper() in ('INSERT', 'UPDATE', 'DELETE'):
+            counts['statements'] += 1
+
+    def count_commit(conn):
+        counts['commits'] += 1
+
+    models.Base.metadata.create_all(bind=engine)
+    event.listen(engine, 'before_cursor_execute', count_statement)
+    event.listen(engine, 'commit', count_commit)
+    txlog = SqlTransactionLog(presumed_abort=False)
+    data_servers = [f'10.0.0.{i}' for i in range(servers)]
+    entry = {'type': 'page', 'name': 'bench', 'content': 'content', 'admin': False}
+    start = perf_counter()
+    for _ in range(transactions // batch):
+        tids = await txlog.begin([entry] * batch, data_servers)
+        await txlog.voted({server_ip: {tid: True for tid in tids} for server_ip in data_servers})
+        await txlog.decided(tids, [], data_servers)
+        await txlog.acknowledged(data_servers, tids, [])
+        await txlog.finished(tids, [])
+    elapsed = perf_counter() - start
+    logged = transactions // batch * batch
+    print(f'{logged} transactions, batches of {batch}, {servers} data servers')
+    print(f'statements per transaction: {counts["statements"] / logged:.2f}')
+    print(f'commits per transaction: {counts["commits"] / logged:.2f}')
+    print(f'ms per transaction: {elapsed / logged * 1000:.3f}')
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    try:
+        asyncio.run(run(*[int(arg) for arg in args[1:]]))
+    finally:
+        engine.dispose()
+        os.remove(f'sql_app_{os.path.basename(args[0])}.db')
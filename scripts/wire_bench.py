@@ -0,0 +1,99 @@
+"""
+Microbenchmark of the 2PC wire encodings and compression codecs.
+Encodes and decodes a page commit batch as JSON and as a frame, uncompressed and compressed, for a range of
+page content sizes, and prints the size on the wire and the time per message to encode, decode and validate it
+with pydantic.
+
+Usage: python scripts/wire_bench.py [commits per batch] [iterations]
+"""
+
+import json
+import os
+import random
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app.schemas import PageCommitBatch
+from app.wire import CODECS, compress, decode_frame, decompress, encode_frame
+
+SIZES = [100, 1_000, 10_000, 100_000, 1_000_000]
+
+WORDS = ['the', 'wiki', 'page', 'server', 'commit', 'replica', '"quoted"', 'café', 'of', 'and', 'a', 'to',
+         'coordinator', 'transaction', 'log', 'is', 'in', 'version', 'edit', 'content']
+
+
+def text(size: int, seed: int) -> str:
+    """
+    :param size: Length of the text.
+    :param seed: Seed of the text, different seeds give different text.
+    :return: Wiki-like text: random words, with quotes, newlines and non-ASCII characters to escape.
+    """
+    rng = random.Random(seed)
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS) + ('\n' if rng.random() < 0.1 else ' ')
+        words.append(word)
+        length += len(word)
+    return ''.join(words)[:size]
+
+
+def encodings() -> list:
+    """
+    :return: The name, encode and decode function of each wire encoding, with each available codec.
+    """
+    plain = [('json', lambda m: json.dumps(m).encode('utf-8'), json.loads), ('frame', encode_frame, decode_frame)]
+    compressed = []
+    for codec in CODECS:
+        level = 3 if codec == 'zstd' else 6
+        for name, encode, decode in plain:
+            compressed.append((f'{name}+{codec}',
+                               lambda m, encode=encode, codec=codec, level=level: compress(codec, encode(m), level),
+                               lambda b, decode=decode, codec=codec: decode(decompress(codec, b))))
+    return plain + compressed
+
+
+def message(size: int, commits: int) -> dict:
+    """
+    :param size: Length of the content of each page commit.
+    :param commits: Number of page commits in the batch.
+    :return: A page commit batch as sent to the data servers.
+    """
+    return PageCommitBatch(commits=[{'transaction_id': tid, 'page': f'page{tid}', 'content': text(size, tid)}
+                                    for tid in range(commits)]).dict()
+
+
+def timed(function, arg, iterations: int):
+    """
+    :param function: The function to time.
+    :param arg: Its argument.
+    :param iterations: How many times to call it.
+    :return: The average time per call in microseconds, and the result of the last call.
+    """
+    start = perf_counter()
+    for _ in range(iterations):
+        result = function(arg)
+    return (perf_counter() - start) / iterations * 1e6, result
+
+
+def main():
+    commits = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    print(f'{commits} commits per batch, microseconds per message')
+    print(f'{"content":>10} {"encoding":>10} {"bytes":>10} {"encode":>10} {"decode":>10} {"validate":>10}')
+    for size in SIZES:
+        data = message(size, commits)
+        runs = max(5, iterations * 1000 // max(size, 1000))
+        for name, encode, decode in encodings():
+            encode_time, body = timed(encode, data, runs)
+            decode_time, decoded = timed(decode, body, runs)
+            assert decoded == data
+            validate_time, _ = timed(PageCommitBatch.parse_obj, decoded, runs)
+            print(f'{size:>10} {name:>10} {len(body):>10} {encode_time:>10.1f} {decode_time:>10.1f} '
+                  f'{validate_time:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
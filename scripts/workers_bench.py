@@ -0,0 +1,76 @@
+"""
+Benchmark for a data server running several worker processes.
+Views pages from several client processes at once, so that the client is not what limits the throughput of a
+data server using several cores, then prints the total throughput and latency.
+
+Usage: python scripts/workers_bench.py <data server ip> [seconds] [client processes] [connections per process] [pages]
+The pages bench0..bench<pages - 1> are created first through the 2PC, so the data server must have a user
+named admin, e.g. the first user created. Run it once per worker count in the data server config, on a host
+with at least as many cores as workers plus client processes.
+"""
+
+import asyncio
+import multiprocessing
+import random
+import sys
+from time import perf_counter
+
+import httpx
+
+
+async def view(server: str, seconds: float, connections: int, pages: int, seed: int) -> list:
+    """
+    View random pages for a while from several connections.
+    :param server: The data server IP.
+    :param seconds: How long to view pages for.
+    :param connections: How many views are in flight at once.
+    :param pages: How many distinct pages the views are spread over.
+    :param seed: The seed of the random pages.
+    :return: The latency of each view in seconds.
+    """
+    rng = random.Random(seed)
+    latencies = []
+    end = perf_counter() + seconds
+
+    async def connection(client: httpx.AsyncClient):
+        while perf_counter() < end:
+            start = perf_counter()
+            response = await client.get(f'http://{server}:8000/page/bench{rng.randrange(pages)}')
+            latencies.append(perf_counter() - start)
+            assert response.status_code == 200
+
+    limits = httpx.Limits(max_connections=connections)
+    async with httpx.AsyncClient(timeout=30, limits=limits) as client:
+        await asyncio.gather(*[connection(client) for _ in range(connections)])
+    return latencies
+
+
+def client_process(args: tuple) -> list:
+    """
+    :param args: The arguments of view.
+    :return: The latency of each view in seconds.
+    """
+    return asyncio.run(view(*args))
+
+
+def main():
+    server = sys.argv[1]
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    processes = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+    connections = int(sys.argv[4]) if len(sys.argv) > 4 else 8
+    pages = int(sys.argv[5]) if len(sys.argv) > 5 else 16
+    with httpx.Client(timeout=30, cookies={'user': 'admin'}) as client:
+        for p in range(pages):
+            response = client.post(f'http://{server}:8000/edit_page',
+                                   data={'name': f'bench{p}', 'content': f'content of page {p}\n' * 100})
+            assert 'failed' not in response.headers.get('location', 'failed'), response.headers
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.map(client_process, [(server, seconds, connections, pages, seed) for seed in range(processes)])
+    latencies = sorted(latency for result in results for latency in result)
+    print(f'{len(latencies) / seconds:.2f} views/s from {processes} x {connections} connections')
+    print(f'median latency: {latencies[len(latencies) // 2] * 1000:.2f} ms, '
+          f'p99: {latencies[len(latencies) * 99 // 100] * 1000:.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,8 @@ import uvicorn
 import toml
 
 from app import main, coordinator
+from app.sharding import coordinators
+from app.workers import worker_count
 
 
 
@@ -20,16 +22,21 @@ def read_config():
 
 """
 Entry point to run the program. Loads the config data and launches as a coordinator if this
-server's IP matches the coordinator's IP. Otherwise launches as a data server.
+server's IP is one of the coordinators' IPs. Otherwise launches as a data server, in as many
+worker processes as the config asks for.
 """
 if __name__ == '__main__':
     conf = read_config()
     IP = conf['this_ip']
     PORT = conf['port']
-    COORD = conf['coordinator']
+    COORDS = coordinators(conf)
     REPLICAS = conf['replicas']
-    if IP == COORD:
+    WORKERS = worker_count(conf)
+    if IP in COORDS:
         uvicorn.run(coordinator.app, host=IP, port=PORT)
+    elif WORKERS > 1:
+        # each worker imports the app and reads the config again
+        uvicorn.run('app.main:app', host=IP, port=PORT, workers=WORKERS)
     else:
         uvicorn.run(main.app, host=IP, port=PORT)
 